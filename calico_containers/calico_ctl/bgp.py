@@ -15,7 +15,7 @@
 Usage:
   calicoctl bgp peer add <PEER_IP> as <AS_NUM>
   calicoctl bgp peer remove <PEER_IP>
-  calicoctl bgp peer show [--ipv4 | --ipv6]
+  calicoctl bgp peer show [--ipv4 | --ipv6] [--output=<FORMAT>]
   calicoctl bgp node-mesh [on|off]
   calicoctl bgp default-node-as [<AS_NUM>]
 
@@ -27,6 +27,8 @@ Description:
 Options:
  --ipv4    Show IPv4 information only.
  --ipv6    Show IPv6 information only.
+ --output=<FORMAT>  Show the peers as a table, or stream them as json, jsonl
+                    or tsv.  [default: table]
 """
 import sys
 from utils import client
@@ -35,6 +37,8 @@ from netaddr import IPAddress
 from utils import check_ip_version
 from prettytable import PrettyTable
 from utils import get_container_ipv_from_arguments
+from utils import get_output_format
+from utils import RowWriter
 
 
 def bgp(arguments):
@@ -53,11 +57,13 @@ def bgp(arguments):
         elif arguments.get("remove"):
             bgp_peer_remove(arguments.get("<PEER_IP>"), ip_version)
         elif arguments.get("show"):
-            if not ip_version:
-                bgp_peer_show("v4")
-                bgp_peer_show("v6")
+            versions = [ip_version] if ip_version else ["v4", "v6"]
+            output_format = get_output_format(arguments)
+            if output_format == "table":
+                for version in versions:
+                    bgp_peer_show(version)
             else:
-                bgp_peer_show(ip_version)
+                bgp_peer_stream(versions, output_format)
 
     elif arguments.get("node-mesh"):
         if arguments.get("on") or arguments.get("off"):
@@ -121,6 +127,21 @@ def bgp_peer_show(version):
         print "No global IP%s BGP Peers defined.\n" % version
 
 
+def bgp_peer_stream(versions, output_format):
+    """
+    Write the global BGP Peers in a machine readable format, a row at a time.
+
+    :param versions: The versions to show: a list of "v4" and "v6".
+    :param output_format: "json", "jsonl" or "tsv".
+    :return: None
+    """
+    with RowWriter(["version", "ip", "as_num"], output_format) as writer:
+        for version in versions:
+            peers = client.get_bgp_peers(version)
+            for peer in sorted(peers, key=lambda peer: peer.ip):
+                writer.write(version, peer.ip, peer.as_num)
+
+
 def set_default_node_as(as_num):
     """
     Set the default node BGP AS Number.
@@ -129,7 +129,7 @@ def container_add(container_name, ip, interface):
         sys.exit(1)
 
     # Assign the IP
-    if not client.assign_address(pool, ip):
+    if not client.assign_address(pool, ip, hostname=hostname):
         print "IP address is already assigned in pool %s " % pool
         sys.exit(1)
 
@@ -179,13 +179,9 @@ def container_remove(container_name):
     # Remove any IP address assignments that this endpoint has
     for net in endpoint.ipv4_nets | endpoint.ipv6_nets:
         assert(net.size == 1)
-        ip = net.ip
-        pools = client.get_ip_pools("v%s" % ip.version)
-        for pool in pools:
-            if ip in pool:
-                # Ignore failure to unassign address, since we're not
-                # enforcing assignments strictly in datastore.py.
-                client.unassign_address(pool, ip)
+        # Ignore failure to unassign address, since we're not
+        # enforcing assignments strictly in datastore.py.
+        client.release_address(net.ip)
 
     # Remove the endpoint
     netns.remove_endpoint(endpoint.endpoint_id)
@@ -234,7 +230,7 @@ def container_ip_add(container_name, ip, version, interface):
 
     # From here, this method starts having side effects. If something
     # fails then at least try to leave the system in a clean state.
-    if not client.assign_address(pool, ip):
+    if not client.assign_address(pool, ip, hostname=hostname):
         print "IP address is already assigned in pool %s " % pool
         sys.exit(1)
 
@@ -284,7 +280,7 @@ def container_ip_remove(container_name, ip, version, interface):
     # The netns manipulations must be done as root.
     enforce_root()
 
-    pool = get_pool_or_exit(address)
+    get_pool_or_exit(address)
 
     info = get_container_info_or_exit(container_name)
     container_id = info["Id"]
@@ -330,24 +326,19 @@ def container_ip_remove(container_name, ip, version, interface):
         print "Error updating networking in container. Aborting."
         sys.exit(1)
 
-    client.unassign_address(pool, ip)
+    client.release_address(address)
 
     print "IP %s removed from %s" % (ip, container_name)
 
 
 def get_pool_or_exit(ip):
     """
-    Get the first allocation pool that an IP is in.
+    Get the allocation pool that an IP is in.
 
     :param ip: The IPAddress to find the pool for.
     :return: The pool or sys.exit
     """
-    pools = client.get_ip_pools("v%s" % ip.version)
-    pool = None
-    for candidate_pool in pools:
-        if ip in candidate_pool:
-            pool = candidate_pool
-            break
+    pool = client.find_pool(ip)
     if pool is None:
         print "%s is not in any configured pools" % ip
         sys.exit(1)
@@ -13,27 +13,56 @@
 # limitations under the License.
 """
 Usage:
-  calicoctl diags [--log-dir=<LOG_DIR>] [--upload]
+  calicoctl diags [--log-dir=<LOG_DIR>] [--upload] [--timeout=<SECONDS>] [--max-log-file-size=<MB>] [--max-log-size=<MB>]
 
 Description:
   Save diagnostic information
 
+  The network state and the datastore are collected in parallel, and each
+  collector is stopped after the timeout.  Logs are copied newest first: a
+  log file bigger than the file limit is cut to its most recent part, and
+  older logs are left out once the total limit is reached.
+
 Options:
-  --log-dir=<LOG_DIR>  The directory for logs [default: /var/log/calico]
-  --upload             Flag, when set, will upload logs to http://transfer.sh
+  --log-dir=<LOG_DIR>       The directory for logs [default: /var/log/calico]
+  --upload                  Flag, when set, will upload logs to http://transfer.sh
+  --timeout=<SECONDS>       How long each collector may run [default: 60]
+  --max-log-file-size=<MB>  The most of each log file to save [default: 20]
+  --max-log-size=<MB>       The most of all the logs to save [default: 100]
 """
 import sys
 from utils import enforce_root
-import sh
+import errno
 import os
 from datetime import datetime
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
 import tarfile
 import socket
 import tempfile
 import subprocess
+import threading
+import time
+from StringIO import StringIO
 from etcd import EtcdException
-from shutil import copytree
+from shutil import rmtree
 from pycalico.datastore import DatastoreClient
+from pycalico.datastore_errors import DataStoreError
+
+COLLECTORS = [
+    # Display all sockets (default: connected), and don't resolve names.
+    ("netstat", [["netstat", "--all", "--numeric"]]),
+    ("route", [["route", "--numeric"],
+               ["ip", "route"],
+               ["ip", "-6", "route"]]),
+    ("iptables", [["iptables-save"]]),
+    # TODO: ipset might not be installed on the host. But we don't want to
+    # gather the diags in the container because it might not be running...
+    ("ipset", [["ipset", "list"]]),
+]
+"""The files of command output to save, and the commands to run for each."""
+
+MB = 1024 * 1024
 
 
 def diags(arguments):
@@ -45,111 +74,227 @@ def diags(arguments):
     :return: None
     """
     enforce_root()
+    limits = {}
+    for option in ("--timeout", "--max-log-file-size", "--max-log-size"):
+        try:
+            limits[option] = int(arguments[option])
+            if limits[option] <= 0:
+                raise ValueError()
+        except ValueError:
+            print "Invalid %s %s." % (option[2:], arguments[option])
+            sys.exit(1)
+
     print("Collecting diags")
-    save_diags(arguments["--log-dir"], arguments["--upload"])
+    save_diags(arguments["--log-dir"], arguments["--upload"],
+               timeout=limits["--timeout"],
+               max_log_file_size=limits["--max-log-file-size"] * MB,
+               max_log_size=limits["--max-log-size"] * MB)
     sys.exit(0)
 
 
-def save_diags(log_dir, upload=False):
-    # Create temp directory
+def save_diags(log_dir, upload=False, timeout=60, max_log_file_size=20 * MB,
+               max_log_size=100 * MB):
+    """
+    Collect the diagnostics into a tar.gz file.
+
+    The collectors write their output to files in a temp dir, and each file
+    is added to the tar.gz once written.  Logs are added straight from the
+    log dir.
+
+    :param log_dir: The directory containing the Calico logs.
+    :param upload: Whether to upload the tar.gz to transfer.sh.
+    :param timeout: How long each collector may run, in seconds.
+    :param max_log_file_size: The most bytes of each log file to save.
+    :param max_log_size: The most bytes of logs to save in total.
+    :return: None
+    """
     temp_dir = tempfile.mkdtemp()
-    temp_diags_dir = os.path.join(temp_dir, 'diagnostics')
-    os.mkdir(temp_diags_dir)
+    collect_dir = os.path.join(temp_dir, "collect")
+    os.mkdir(collect_dir)
     print("Using temp dir: %s" % temp_dir)
 
-    # Write date to file
-    with open(os.path.join(temp_diags_dir, 'date'), 'w') as f:
-        f.write("DATE=%s" % datetime.strftime(datetime.today(),"%Y-%m-%d_%H-%M-%S"))
+    tar_filename = datetime.strftime(datetime.today(),"diags-%d%m%y_%H%M%S.tar.gz")
+    full_tar_path = os.path.join(temp_dir, tar_filename)
+    with tarfile.open(full_tar_path, "w:gz") as tar:
+        _add_string(tar, "diagnostics/date", "DATE=%s" %
+                    datetime.strftime(datetime.today(),"%Y-%m-%d_%H-%M-%S"))
+        _add_string(tar, "diagnostics/hostname", socket.gethostname())
 
-    # Write hostname to file
-    with open(os.path.join(temp_diags_dir, 'hostname'), 'w') as f:
-        f.write("%s" % socket.gethostname())
+        print("Dumping %s and datastore" %
+              ", ".join(name for name, _ in COLLECTORS))
+        tasks = [(name, run_commands, (commands, timeout))
+                 for name, commands in COLLECTORS]
+        tasks.append(("etcd_calico", dump_datastore, ()))
+        pool = ThreadPool(len(tasks))
+        results = [(name, pool.apply_async(
+                        function, (os.path.join(collect_dir, name),) + args))
+                   for name, function, args in tasks]
+        pool.close()
 
-    # Write netstat output to file
-    with open(os.path.join(temp_diags_dir, 'netstat'), 'w') as f:
-        try:
-            print("Dumping netstat output")
-            netstat = sh.Command._create("netstat")
+        # Commands are killed when they time out, but the datastore dump
+        # can't be interrupted, so also stop waiting for a collector that
+        # overruns.  Its output may still be being written, so isn't saved.
+        deadline = time.time() + timeout + 5
+        for name, result in results:
+            try:
+                problems = result.get(max(deadline - time.time(), 0))
+            except TimeoutError:
+                print "Timed out collecting %s" % name
+                continue
+            for problem in problems:
+                print problem
+            tar.add(os.path.join(collect_dir, name),
+                    arcname="diagnostics/" + name)
 
-            f.writelines(netstat(
-                # Display all sockets (default: connected)
-                all=True,
-                # Don't resolve names
-                numeric=True))
+        if os.path.isdir(log_dir):
+            print("Copying Calico logs")
+            add_logs(tar, log_dir, "diagnostics/logs", max_log_file_size,
+                     max_log_size)
+        else:
+            print('No logs found in %s; skipping log copying' % log_dir)
 
-        except sh.CommandNotFound as e:
-            print "Missing command: %s" % e.message
+    rmtree(collect_dir, ignore_errors=True)
+    print("Diags saved to %s" % (full_tar_path))
 
-    # Write routes
-    print("Dumping routes")
-    with open(os.path.join(temp_diags_dir, 'route'), 'w') as f:
-        try:
-            route = sh.Command._create("route")
-            f.write("route --numeric")
-            f.writelines(route(numeric=True))
-            f.write('\n')
-        except sh.CommandNotFound as e:
-            print "Missing command: %s" % e.message
+    if upload:
+        upload_temp_diags(full_tar_path)
 
-        try:
-            ip = sh.Command._create("ip")
-            f.write("ip route")
-            f.writelines(ip("route"))
-            f.write('\n')
-
-            f.write("ip -6 route")
-            f.writelines(ip("-6", "route"))
-            f.write('\n')
-        except sh.CommandNotFound as e:
-            print "Missing command: %s" % e.message
-
-    # Dump iptables
-    with open(os.path.join(temp_diags_dir, 'iptables'), 'w') as f:
-        try:
-            iptables_save = sh.Command._create("iptables-save")
-            print("Dumping iptables")
-            f.writelines(iptables_save())
-        except sh.CommandNotFound as e:
-            print "Missing command: %s" % e.message
 
-    # Dump ipset list
-    # TODO: ipset might not be installed on the host. But we don't want to
-    # gather the diags in the container because it might not be running...
-    with open(os.path.join(temp_diags_dir, 'ipset'), 'w') as f:
-        try:
-            ipset = sh.Command._create("ipset")
-            print("Dumping ipset")
-            f.writelines(ipset("list"))
-        except sh.CommandNotFound as e:
-            print "Missing command: %s" % e.message
-
-    if os.path.isdir(log_dir):
-        print("Copying Calico logs")
-        copytree(log_dir, os.path.join(temp_diags_dir, "logs"))
-    else:
-        print('No logs found in %s; skipping log copying' % log_dir)
-
-    print("Dumping datastore")
-    # TODO: May want to move this into datastore.py as a dump-calico function
+def run_commands(path, commands, timeout):
+    """
+    Run commands one after the other, writing their output to a file.  A
+    command still running when the timeout expires is killed, and the
+    remaining commands are skipped.
+
+    :param path: The file to write to.
+    :param commands: A list of commands, each a list of arguments.
+    :param timeout: How long the commands may run in total, in seconds.
+    :return: A list of messages describing the commands that failed.
+    """
+    deadline = time.time() + timeout
+    problems = []
+    with open(path, "w") as f:
+        for command in commands:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                problems.append("Timed out before running %s" %
+                                " ".join(command))
+                continue
+            if len(commands) > 1:
+                f.write(" ".join(command) + "\n")
+                f.flush()
+            try:
+                process = subprocess.Popen(command, stdout=f,
+                                           stderr=subprocess.STDOUT)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                problems.append("Missing command: %s" % command[0])
+                continue
+
+            timed_out = threading.Event()
+            timer = threading.Timer(remaining, _kill, (process, timed_out))
+            timer.start()
+            process.wait()
+            timer.cancel()
+            if timed_out.is_set():
+                problems.append("Timed out running %s" % " ".join(command))
+            f.write("\n")
+    return problems
+
+
+def _kill(process, timed_out):
+    timed_out.set()
     try:
-        datastore_client = DatastoreClient()
-        datastore_data = datastore_client.etcd_client.read("/calico", recursive=True)
-        with open(os.path.join(temp_diags_dir, 'etcd_calico'), 'w') as f:
-            f.write(str(datastore_data))
-    except EtcdException:
-        print "Unable to dump etcd datastore"
-
-    # Create tar and upload
-    tar_filename = datetime.strftime(datetime.today(),"diags-%d%m%y_%H%M%S.tar.gz")
-    full_tar_path = os.path.join(temp_dir, tar_filename)
-    with tarfile.open(full_tar_path, "w:gz") as tar:
-        # pass in arcname, otherwise zip contains layers of subfolders
-        tar.add(temp_dir, arcname="")
+        process.kill()
+    except OSError:
+        # Already exited.
+        pass
 
-    print("Diags saved to %s" % (full_tar_path))
 
-    if upload:
-        upload_temp_diags(full_tar_path)
+def dump_datastore(path):
+    """
+    Dump the Calico datastore to a file, a key at a time.
+
+    :param path: The file to write to.
+    :return: A list of messages describing any failure.
+    """
+    with open(path, "w") as f:
+        try:
+            DatastoreClient().dump_data(f)
+        except (EtcdException, DataStoreError):
+            return ["Unable to dump etcd datastore"]
+    return []
+
+
+def add_logs(tar, log_dir, arcname, max_file_size, max_size):
+    """
+    Add the files in a log directory to a tar, newest first.  Only the end
+    of a file bigger than max_file_size is added, and files are left out
+    once max_size bytes have been added.
+
+    :param tar: The TarFile to add to.
+    :param log_dir: The log directory.
+    :param arcname: The name of the directory in the tar.
+    :param max_file_size: The most bytes to add from each file.
+    :param max_size: The most bytes to add in total.
+    :return: None
+    """
+    logs = []
+    for directory, _, names in os.walk(log_dir):
+        for name in names:
+            path = os.path.join(directory, name)
+            if os.path.isfile(path) and not os.path.islink(path):
+                logs.append((os.path.getmtime(path), path))
+
+    remaining = max_size
+    skipped = 0
+    for _, path in sorted(logs, reverse=True):
+        name = os.path.join(arcname, os.path.relpath(path, log_dir))
+        tarinfo = tar.gettarinfo(path, name)
+        size = min(tarinfo.size, max_file_size, remaining)
+        if size <= 0:
+            skipped += 1
+            continue
+        if size < tarinfo.size:
+            print "Saving only the last %d bytes of %s" % (size, path)
+        with open(path, "rb") as f:
+            f.seek(tarinfo.size - size)
+            tarinfo.size = size
+            tar.addfile(tarinfo, _FixedSizeReader(f, size))
+        remaining -= size
+
+    if skipped:
+        print "Skipped %d older log files; the log size limit was reached" % \
+              skipped
+
+
+class _FixedSizeReader(object):
+    """
+    Reads exactly size bytes from a file, padding with NULs if the file is
+    truncated while being read, as a rotated log may be.  The tar header has
+    already been written with the size, so a short read would corrupt the
+    tar.
+    """
+
+    def __init__(self, f, size):
+        self._file = f
+        self._remaining = size
+
+    def read(self, size=-1):
+        if size < 0 or size > self._remaining:
+            size = self._remaining
+        data = self._file.read(size)
+        data += "\0" * (size - len(data))
+        self._remaining -= size
+        return data
+
+
+def _add_string(tar, name, data):
+    tarinfo = tarfile.TarInfo(name)
+    tarinfo.size = len(data)
+    tarinfo.mtime = time.time()
+    tar.addfile(tarinfo, StringIO(data))
 
 
 def upload_temp_diags(diags_path):
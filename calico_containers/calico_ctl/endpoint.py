@@ -13,9 +13,9 @@
 # limitations under the License.
 """
 Usage:
-  calicoctl endpoint show [--host=<HOSTNAME>] [--orchestrator=<ORCHESTRATOR_ID>] [--workload=<WORKLOAD_ID>] [--endpoint=<ENDPOINT_ID>] [--detailed]
+  calicoctl endpoint show [--host=<HOSTNAME>] [--orchestrator=<ORCHESTRATOR_ID>] [--workload=<WORKLOAD_ID>] [--endpoint=<ENDPOINT_ID>] [--detailed] [--output=<FORMAT>]
   calicoctl endpoint <ENDPOINT_ID> profile (append|remove|set) [--host=<HOSTNAME>] [--orchestrator=<ORCHESTRATOR_ID>] [--workload=<WORKLOAD_ID>]  [<PROFILES>...]
-  calicoctl endpoint <ENDPOINT_ID> profile show [--host=<HOSTNAME>] [--orchestrator=<ORCHESTRATOR_ID>] [--workload=<WORKLOAD_ID>]
+  calicoctl endpoint <ENDPOINT_ID> profile show [--host=<HOSTNAME>] [--orchestrator=<ORCHESTRATOR_ID>] [--workload=<WORKLOAD_ID>] [--output=<FORMAT>]
 
 Description:
   Configure or show endpoints assigned to existing containers
@@ -26,11 +26,16 @@ Options:
  --orchestrator=<ORCHESTRATOR_ID>   Filters endpoints created on a specific orchestrator
  --workload=<WORKLOAD_ID>           Filters endpoints on a specific workload
  --endpoint=<ENDPOINT_ID>           Filters endpoints with a specific endpoint ID
+ --output=<FORMAT>                  Show the results as a table, or stream them
+                                    as json, jsonl or tsv [default: table]
 
 Examples:
     Show all endpoints belonging to 'host1':
         $ calicoctl endpoint show --host=host1
 
+    List every endpoint's addresses, one JSON object per line:
+        $ calicoctl endpoint show --detailed --output=jsonl
+
     Add a profile called 'profile-A' to the endpoint a1b2c3d4:
         $ calicoctl endpoint a1b2c3d4 profile append profile-A
 
@@ -46,6 +51,8 @@ from pycalico.datastore_errors import MultipleEndpointsMatch
 from pycalico.datastore_errors import ProfileNotInEndpoint
 from utils import client
 from utils import print_paragraph
+from utils import get_output_format
+from utils import RowWriter
 
 
 def endpoint(arguments):
@@ -80,18 +87,20 @@ def endpoint(arguments):
             endpoint_profile_show(arguments.get("--host"),
                                   arguments.get("--orchestrator"),
                                   arguments.get("--workload"),
-                                  arguments.get("<ENDPOINT_ID>"))
+                                  arguments.get("<ENDPOINT_ID>"),
+                                  get_output_format(arguments))
     else:
         # calicoctl endpoint show
         endpoint_show(arguments.get("--host"),
                       arguments.get("--orchestrator"),
                       arguments.get("--workload"),
                       arguments.get("--endpoint"),
-                      arguments.get("--detailed"))
+                      arguments.get("--detailed"),
+                      get_output_format(arguments))
 
 
 def endpoint_show(hostname, orchestrator_id, workload_id, endpoint_id,
-                  detailed):
+                  detailed, output_format="table"):
     """
     List the profiles for a given endpoint. All parameters will be used to
     filter down which endpoints should be shown.
@@ -102,6 +111,8 @@ def endpoint_show(hostname, orchestrator_id, workload_id, endpoint_id,
     :param hostname: The hostname.
     :param detailed: Optional flag, when set to True, will provide more
     information in the shown table
+    :param output_format: "table", or "json", "jsonl" or "tsv" to write the
+    rows as they are produced.
     :return: Nothing
     """
     endpoints = client.get_endpoints(hostname=hostname,
@@ -109,6 +120,10 @@ def endpoint_show(hostname, orchestrator_id, workload_id, endpoint_id,
                                      workload_id=workload_id,
                                      endpoint_id=endpoint_id)
 
+    if output_format != "table":
+        endpoint_stream(endpoints, detailed, output_format)
+        return
+
     if detailed:
         headings = ["Hostname",
                     "Orchestrator ID",
@@ -179,6 +194,49 @@ def endpoint_show(hostname, orchestrator_id, workload_id, endpoint_id,
     print str(x) + "\n"
 
 
+def endpoint_stream(endpoints, detailed, output_format):
+    """
+    Write endpoints in a machine readable format, a row at a time.
+
+    :param endpoints: The Endpoints to show.
+    :param detailed: Write a row per endpoint, rather than the number of
+    workloads and endpoints for each host and orchestrator.
+    :param output_format: "json", "jsonl" or "tsv".
+    :return: None
+    """
+    if detailed:
+        fields = ["hostname", "orchestrator_id", "workload_id",
+                  "endpoint_id", "addresses", "mac", "profiles", "state"]
+        with RowWriter(fields, output_format) as writer:
+            for endpoint in endpoints:
+                addresses = sorted(endpoint.ipv4_nets) + \
+                            sorted(endpoint.ipv6_nets)
+                writer.write(endpoint.hostname,
+                             endpoint.orchestrator_id,
+                             endpoint.workload_id,
+                             endpoint.endpoint_id,
+                             addresses,
+                             endpoint.mac,
+                             endpoint.profile_ids,
+                             endpoint.state)
+    else:
+        # {(hostname, orchestrator_id): set of workload IDs} and
+        # {(hostname, orchestrator_id): number of endpoints}
+        workloads = {}
+        counts = {}
+        for endpoint in endpoints:
+            key = (endpoint.hostname, endpoint.orchestrator_id)
+            workloads.setdefault(key, set()).add(endpoint.workload_id)
+            counts[key] = counts.get(key, 0) + 1
+
+        fields = ["hostname", "orchestrator_id", "num_workloads",
+                  "num_endpoints"]
+        with RowWriter(fields, output_format) as writer:
+            for key in sorted(counts):
+                writer.write(key[0], key[1], len(workloads[key]),
+                             counts[key])
+
+
 def endpoint_profile_append(hostname, orchestrator_id, workload_id,
                             endpoint_id, profile_names):
     """
@@ -307,7 +365,8 @@ def endpoint_profile_remove(hostname, orchestrator_id, workload_id,
         sys.exit(1)
 
 
-def endpoint_profile_show(hostname, orchestrator_id, workload_id, endpoint_id):
+def endpoint_profile_show(hostname, orchestrator_id, workload_id, endpoint_id,
+                          output_format="table"):
     """
     List the profiles assigned to a particular endpoint.
 
@@ -315,6 +374,7 @@ def endpoint_profile_show(hostname, orchestrator_id, workload_id, endpoint_id):
     :param orchestrator_id: The orchestrator ID.
     :param workload_id: The workload ID.
     :param endpoint_id: The endpoint ID.
+    :param output_format: "table", "json", "jsonl" or "tsv".
 
     :return: None
     """
@@ -334,7 +394,11 @@ def endpoint_profile_show(hostname, orchestrator_id, workload_id, endpoint_id):
         print_paragraph("Endpoint %s is unknown to Calico.\n" % endpoint_id)
         sys.exit(1)
 
-    if endpoint.profile_ids:
+    if output_format != "table":
+        with RowWriter(["name"], output_format) as writer:
+            for name in endpoint.profile_ids:
+                writer.write(name)
+    elif endpoint.profile_ids:
         x = PrettyTable(["Name"], sortby="Name")
         for name in endpoint.profile_ids:
             x.add_row([name])
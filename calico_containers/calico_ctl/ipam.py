@@ -0,0 +1,111 @@
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Usage:
+  calicoctl ipam gc [--dry-run] [--grace=<SECONDS>]
+
+Description:
+  Manage IP address assignments
+
+Options:
+  --dry-run          Report leaked assignments without releasing them.
+  --grace=<SECONDS>  Time to wait before re-checking the endpoints, so that
+                     addresses assigned to endpoints that are still being
+                     created are not released [default: 30]
+
+Examples:
+  Release IP addresses that are assigned but not used by any endpoint:
+  $ calicoctl ipam gc
+"""
+import sys
+import time
+from prettytable import PrettyTable
+from utils import client
+
+
+def ipam(arguments):
+    """
+    Main dispatcher for ipam commands. Calls the corresponding helper
+    function.
+
+    :param arguments: A dictionary of arguments already processed through
+    this file's docstring with docopt
+    :return: None
+    """
+    if arguments.get("gc"):
+        try:
+            grace = int(arguments.get("--grace"))
+            if grace <= 0:
+                raise ValueError()
+        except ValueError:
+            print "Invalid grace period %s." % arguments.get("--grace")
+            sys.exit(1)
+        ipam_gc(arguments.get("--dry-run"), grace)
+
+
+def ipam_gc(dry_run, grace):
+    """
+    Release address assignments that are not used by any endpoint.
+
+    Leaks are found by cross-referencing one read of the assignments of each
+    IP version with one read of the endpoints.  The check is repeated after
+    the grace period and only assignments that are leaked both times, and
+    have not been modified in between, are released.
+
+    :param dry_run: Report the leaked assignments without releasing them.
+    :param grace: The grace period in seconds.
+    :return: None.
+    """
+    endpoints = client.get_endpoints()
+    leaked = set()
+    for version in ("v4", "v6"):
+        leaked.update(client.get_leaked_assignments(version, endpoints))
+
+    if leaked:
+        print "Found %d possibly leaked assignments, re-checking in %d " \
+              "seconds" % (len(leaked), grace)
+        time.sleep(grace)
+        endpoints = client.get_endpoints()
+        still_leaked = set()
+        for version in ("v4", "v6"):
+            still_leaked.update(client.get_leaked_assignments(version,
+                                                              endpoints))
+        # The Assignment includes the etcd index, so this also discards
+        # addresses that were released and re-assigned in the meantime.
+        leaked &= still_leaked
+
+    if not leaked:
+        print "No leaked assignments found."
+        return
+
+    x = PrettyTable(["Pool", "Address", "Host", "Released"])
+    released = 0
+    for assignment in leaked:
+        if dry_run:
+            freed = False
+        else:
+            freed = client.release_assignment(assignment)
+            released += freed
+        x.add_row([str(assignment.pool),
+                   str(assignment.address),
+                   assignment.hostname or "(unknown)",
+                   "yes" if freed else "no"])
+    print x.get_string(sortby="Address")
+
+    if dry_run:
+        print "Found %d leaked assignments (dry run, nothing released)." % \
+              len(leaked)
+    else:
+        print "Released %d of %d leaked assignments." % (released,
+                                                        len(leaked))
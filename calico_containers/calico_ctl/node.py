@@ -15,14 +15,28 @@
 Usage:
   calicoctl node [--ip=<IP>] [--ip6=<IP6>] [--node-image=<DOCKER_IMAGE_NAME>] [--as=<AS_NUM>] [--log-dir=<LOG_DIR>]
   calicoctl node stop [--force]
+  calicoctl node reconcile [--dry-run] [--settle=<SECONDS>]
+  calicoctl node drain
   calicoctl node bgp peer add <PEER_IP> as <AS_NUM>
   calicoctl node bgp peer remove <PEER_IP>
-  calicoctl node bgp peer show [--ipv4 | --ipv6]
+  calicoctl node bgp peer show [--ipv4 | --ipv6] [--output=<FORMAT>]
 
 Description:
   Configure the main calico/node container as well as default BGP information
   for this node.
 
+  The reconcile command deletes the host ends of veths whose endpoints no
+  longer exist.  A link is only deleted if it has no endpoint both before and
+  after the settle period, so that veths being created aren't deleted.  To
+  reconcile periodically in the calico/node container, set
+  CALICO_RECONCILE_INTERVAL to the number of seconds between passes before
+  running calicoctl node.
+
+  The drain command removes all the docker endpoints on this host, releasing
+  their IP addresses and deleting their veths.  The calico/node container is
+  left running.  The Calico libnetwork plugin can do the same with a POST to
+  its /Calico.Drain route.
+
 Options:
   --force                  Stop the node process even if it has active endpoints.
   --node-image=<DOCKER_IMAGE_NAME>    Docker image to use for Calico's per-node
@@ -33,6 +47,11 @@ Options:
   --as=<AS_NUM>            The default AS number for this node.
   --ipv4                   Show IPv4 information only.
   --ipv6                   Show IPv6 information only.
+  --output=<FORMAT>        Show the peers as a table, or stream them as json,
+                           jsonl or tsv.  [default: table]
+  --dry-run                List the orphaned links without deleting them.
+  --settle=<SECONDS>       How long a link must be without an endpoint before
+                           it is deleted [default: 5]
 """
 import sys
 import os
@@ -40,12 +59,15 @@ import sh
 import docker
 import netaddr
 import socket
+import time
 
 from pycalico.datastore_datatypes import IPPool
+from pycalico.reconcile import VethReconciler, drain_host
 from utils import ORCHESTRATOR_ID
 from utils import hostname
 from utils import client
 from utils import docker_client
+from utils import enforce_root
 from pycalico.datastore_datatypes import BGPPeer
 from pycalico.datastore import (ETCD_AUTHORITY_ENV,
                                 ETCD_AUTHORITY_DEFAULT)
@@ -54,10 +76,16 @@ from utils import check_ip_version
 from netaddr import IPAddress
 from prettytable import PrettyTable
 from utils import get_container_ipv_from_arguments
+from utils import get_output_format
+from utils import RowWriter
 
 DEFAULT_IPV4_POOL = IPPool("192.168.0.0/16")
 DEFAULT_IPV6_POOL = IPPool("fd80:24e2:f998:72d6::/64")
 
+PLUGIN_ENV_VARS = ["CALICO_PLUGIN_WORKERS", "CALICO_PLUGIN_THREADS",
+                   "CALICO_RECONCILE_INTERVAL"]
+"""Environment variables passed through to the node container."""
+
 
 def node(arguments):
     """
@@ -76,13 +104,26 @@ def node(arguments):
             elif arguments.get("remove"):
                 node_bgppeer_remove(arguments.get("<PEER_IP>"), ip_version)
             elif arguments.get("show"):
-                if not ip_version:
-                    node_bgppeer_show("v4")
-                    node_bgppeer_show("v6")
+                versions = [ip_version] if ip_version else ["v4", "v6"]
+                output_format = get_output_format(arguments)
+                if output_format == "table":
+                    for version in versions:
+                        node_bgppeer_show(version)
                 else:
-                    node_bgppeer_show(ip_version)
+                    node_bgppeer_stream(versions, output_format)
     elif arguments.get("stop"):
         node_stop(arguments.get("--force"))
+    elif arguments.get("drain"):
+        node_drain()
+    elif arguments.get("reconcile"):
+        try:
+            settle = float(arguments.get("--settle"))
+            if settle < 0:
+                raise ValueError()
+        except ValueError:
+            print "Invalid settle period %s." % arguments.get("--settle")
+            sys.exit(1)
+        node_reconcile(arguments.get("--dry-run"), settle)
     else:
         node_start(ip=arguments.get("--ip"),
                    node_image=arguments['--node-image'],
@@ -170,6 +211,11 @@ def node_start(node_image, log_dir, ip="", ip6="", as_num=None):
         "FELIX_ETCDADDR=%s" % etcd_authority,  # etcd host:port
     ]
 
+    # Pass through the plugin and reconciler settings, if they're set.
+    for env_var in PLUGIN_ENV_VARS:
+        if os.getenv(env_var) is not None:
+            environment.append("%s=%s" % (env_var, os.getenv(env_var)))
+
     binds = {
         "/proc":
             {
@@ -181,6 +227,13 @@ def node_start(node_image, log_dir, ip="", ip6="", as_num=None):
                 "bind": "/var/log/calico",
                 "ro": False
             },
+        # The plugin's journals must outlive the container, so that the
+        # endpoint creations they record can be rolled back.
+        "/var/lib/calico":
+            {
+                "bind": "/var/lib/calico",
+                "ro": False
+            },
         "/usr/share/docker/plugins/": #TODO make this an optional node
         # parameter like log_dir
         #"/run/docker/plugins/":
@@ -205,6 +258,7 @@ def node_start(node_image, log_dir, ip="", ip6="", as_num=None):
         host_config=host_config,
         volumes=["/proc_host",
                  "/var/log/calico",
+                 "/var/lib/calico",
                  "/usr/share/docker/plugins"])
     cid = container["Id"]
 
@@ -228,6 +282,46 @@ def node_stop(force):
               " Force with --force"
 
 
+def node_drain():
+    """
+    Remove all the docker endpoints on this host.
+
+    :return: None.
+    """
+    # Deleting the host's links must be done as root.
+    enforce_root()
+    endpoints = drain_host(client, hostname)
+    print "Removed %d endpoints from %s." % (len(endpoints), hostname)
+
+
+def node_reconcile(dry_run, settle):
+    """
+    Delete the Calico links on this host that don't belong to an endpoint.
+
+    :param dry_run: List the orphaned links without deleting them.
+    :param settle: The time in seconds between the two passes a link must be
+    orphaned in.
+    :return: None.
+    """
+    # Deleting the host's links must be done as root.
+    enforce_root()
+    reconciler = VethReconciler(client, hostname)
+    reconciler.find_orphans()
+    time.sleep(settle)
+    orphans = reconciler.reconcile(dry_run=dry_run)
+
+    if not orphans:
+        print "No orphaned links found."
+    elif dry_run:
+        print "Found %d orphaned links:" % len(orphans)
+        for name in orphans:
+            print "  %s" % name
+    else:
+        print "Deleted %d orphaned links:" % len(orphans)
+        for name in orphans:
+            print "  %s" % name
+
+
 def node_bgppeer_add(ip, version, as_num):
     """
     Add a new BGP peer with the supplied IP address and AS Number to this node.
@@ -277,6 +371,22 @@ def node_bgppeer_show(version):
         print "No IP%s BGP Peers defined for this node.\n" % version
 
 
+def node_bgppeer_stream(versions, output_format):
+    """
+    Write the BGP Peers for this node in a machine readable format, a row at
+    a time.
+
+    :param versions: The versions to show: a list of "v4" and "v6".
+    :param output_format: "json", "jsonl" or "tsv".
+    :return: None
+    """
+    with RowWriter(["version", "ip", "as_num"], output_format) as writer:
+        for version in versions:
+            peers = client.get_bgp_peers(version, hostname=hostname)
+            for peer in sorted(peers, key=lambda peer: peer.ip):
+                writer.write(version, peer.ip, peer.as_num)
+
+
 def get_host_ips(version):
     """
     Gets all IP addresses assigned to this host.
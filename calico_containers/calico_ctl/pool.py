@@ -14,7 +14,7 @@
 """
 Usage:
   calicoctl pool (add|remove) <CIDR> [--ipip] [--nat-outgoing]
-  calicoctl pool show [--ipv4 | --ipv6]
+  calicoctl pool show [--ipv4 | --ipv6] [--usage] [--output=<FORMAT>]
 
 Description:
   Configure IP Pools
@@ -24,6 +24,10 @@ Options:
   --ipv6          Show IPv6 information only
   --nat-outgoing  Apply NAT to outgoing traffic
   --ipip          Use IP-over-IP encapsulation across hosts
+  --usage         Show the number of addresses assigned from each pool, and
+                  by which hosts
+  --output=<FORMAT>  Show the pools as a table, or stream them as json,
+                     jsonl or tsv.  [default: table]
  """
 import sys
 from netaddr import IPNetwork
@@ -32,6 +36,8 @@ from pycalico.datastore_datatypes import IPPool
 from utils import get_container_ipv_from_arguments
 from utils import client
 from utils import check_ip_version
+from utils import get_output_format
+from utils import RowWriter
 
 
 def pool(arguments):
@@ -51,11 +57,14 @@ def pool(arguments):
     elif arguments.get("remove"):
         ip_pool_remove(arguments.get("<CIDR>"), ip_version)
     elif arguments.get("show"):
-        if not ip_version:
-            ip_pool_show("v4")
-            ip_pool_show("v6")
+        usage = arguments.get("--usage")
+        versions = [ip_version] if ip_version else ["v4", "v6"]
+        output_format = get_output_format(arguments)
+        if output_format == "table":
+            for version in versions:
+                ip_pool_show(version, usage)
         else:
-            ip_pool_show(ip_version)
+            ip_pool_stream(versions, usage, output_format)
 
 
 def ip_pool_add(cidr_pool, version, ipip, masquerade):
@@ -91,23 +100,74 @@ def ip_pool_remove(cidr_pool, version):
         print "%s is not a configured pool." % cidr_pool
 
 
-def ip_pool_show(version):
+def ip_pool_show(version, usage=False):
     """
     Print a list of IP allocation pools.
+    :param version: v4 or v6
+    :param usage: Also show the assigned and free addresses in each pool, and
+    a per-host breakdown of the assignments.
     :return: None
     """
     assert version in ("v4", "v6")
     headings = ["IP%s CIDR" % version, "Options"]
+    if usage:
+        headings += ["Assigned", "Free", "Used"]
+        host_table = PrettyTable(["IP%s CIDR" % version, "Host", "Assigned"])
     pools = client.get_ip_pools(version)
     x = PrettyTable(headings)
     for pool in pools:
-        enabled_options = []
-        if version == "v4":
-            if pool.ipip:
-                enabled_options.append("ipip")
-            if pool.masquerade:
-                enabled_options.append("nat-outgoing")
         # convert option array to string
-        row = [str(pool.cidr), ','.join(enabled_options)]
+        row = [str(pool.cidr), ','.join(_pool_options(version, pool))]
+        if usage:
+            pool_usage = client.get_pool_usage(pool)
+            used = (100.0 * pool_usage.assigned / pool_usage.capacity
+                    if pool_usage.capacity else 0.0)
+            row += [pool_usage.assigned,
+                    pool_usage.capacity - pool_usage.assigned,
+                    "%.1f%%" % used]
+            for host, count in pool_usage.hosts.iteritems():
+                host_table.add_row([str(pool.cidr), host or "(unknown)",
+                                    count])
         x.add_row(row)
     print x.get_string(sortby=headings[0])
+    if usage and pools:
+        print host_table.get_string(sortby=headings[0])
+
+
+def ip_pool_stream(versions, usage, output_format):
+    """
+    Write the IP allocation pools in a machine readable format, a row at a
+    time.
+    :param versions: The versions to show: a list of "v4" and "v6".
+    :param usage: Also show the assigned, free and total addresses in each
+    pool, and the number of addresses assigned to each host.
+    :param output_format: "json", "jsonl" or "tsv".
+    :return: None
+    """
+    fields = ["version", "cidr", "options"]
+    if usage:
+        fields += ["assigned", "free", "capacity", "hosts"]
+    with RowWriter(fields, output_format) as writer:
+        for version in versions:
+            pools = client.get_ip_pools(version)
+            for pool in sorted(pools, key=lambda pool: pool.cidr):
+                row = [version, pool.cidr, _pool_options(version, pool)]
+                if usage:
+                    pool_usage = client.get_pool_usage(pool)
+                    hosts = dict((host or "(unknown)", count) for host, count
+                                 in pool_usage.hosts.iteritems())
+                    row += [pool_usage.assigned,
+                            pool_usage.capacity - pool_usage.assigned,
+                            pool_usage.capacity,
+                            hosts]
+                writer.write(*row)
+
+
+def _pool_options(version, pool):
+    enabled_options = []
+    if version == "v4":
+        if pool.ipip:
+            enabled_options.append("ipip")
+        if pool.masquerade:
+            enabled_options.append("nat-outgoing")
+    return enabled_options
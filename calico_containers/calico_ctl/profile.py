@@ -13,9 +13,13 @@
 # limitations under the License.
 """
 Usage:
-  calicoctl profile show [--detailed]
+  calicoctl profile show [--detailed | --counts] [--output=<FORMAT>]
   calicoctl profile (add|remove) <PROFILE>
-  calicoctl profile <PROFILE> tag show
+  calicoctl profile find-tag <TAG>
+  calicoctl profile batch [<FILE>]
+  calicoctl profile export [<FILE>]
+  calicoctl profile import [--concurrency=<N>] [<FILE>]
+  calicoctl profile <PROFILE> tag show [--output=<FORMAT>]
   calicoctl profile <PROFILE> tag (add|remove) <TAG>
   calicoctl profile <PROFILE> rule add (inbound|outbound) [--at=<POSITION>]
     (allow|deny) [(
@@ -40,28 +44,75 @@ Usage:
   calicoctl profile <PROFILE> rule show
   calicoctl profile <PROFILE> rule json
   calicoctl profile <PROFILE> rule update
+  calicoctl profile <PROFILE> rule optimize [--dry-run]
 
 Description:
   Modify available profiles and configure rules or tags.
 
+  The batch command reads rule add and remove commands, one per line and
+  without the leading "calicoctl profile", from <FILE> or standard input.
+  The changes to each profile are applied together in a single atomic update.
+
+  The find-tag command lists the profiles that carry <TAG>, and the rules
+  that match on <TAG>, to show what would be affected by changing it.
+
+  The export command writes every profile's name, tags and rules as one line
+  of JSON per profile, to <FILE> or standard output.  The import command
+  reads the same format from <FILE> or standard input, creating or updating
+  each profile.  Profiles whose tags and rules are already correct are not
+  rewritten.
+
+  The rule optimize command replaces the rules on a profile with an
+  equivalent, smaller set: rules that can never match are removed, and
+  neighbouring rules that differ only in a CIDR or port list are merged.
+
 Options:
-  --detailed        Show additional information.
-  --at=<POSITION>   Specify the position in the chain where the rule should
-                    be placed. Default: append at end.
+  --detailed         Show additional information.
+  --counts           Show the number of endpoints and hosts using each
+                     profile.
+  --dry-run          Show the optimized rules without updating the profile.
+  --concurrency=<N>  The number of profiles to import at once. [default: 10]
+  --output=<FORMAT>  Show the results as a table, or stream them as json,
+                     jsonl or tsv.  The rules of a profile are shown as JSON
+                     by the rule json command. [default: table]
+  --at=<POSITION>    Specify the position in the chain where the rule should
+                     be placed. Default: append at end.
 
 Examples:
   Add and set up a rule to prevent all inbound traffic except pings from the 192.168/16 subnet
   $ calicoctl profile add only-local-pings
   $ calicoctl profile only-local-pings rule add inbound deny icmp
   $ calicoctl profile only-local-pings rule add inbound --at=0 allow from 192.168.0.0/16
+
+  Apply several rule changes from a file:
+  $ cat rules.txt
+  web rule add inbound allow tcp to ports 80,443
+  web rule remove outbound deny
+  db rule add inbound allow tcp to ports 5432
+  $ calicoctl profile batch rules.txt
+
+  Copy all profiles to another Calico cluster:
+  $ calicoctl profile export profiles.json
+  $ ETCD_AUTHORITY=other:4001 calicoctl profile import profiles.json
 """
 import sys
 import re
+import shlex
+import time
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+from docopt import docopt, DocoptExit
+from netaddr import AddrFormatError
 from prettytable import PrettyTable
 from pycalico.datastore import Rule
 from pycalico.datastore import Rules
+from pycalico.datastore_datatypes import Profile
+from pycalico.datastore_errors import DataStoreError, ProfileRulesConflict
 from utils import client
 from utils import print_paragraph
+from utils import get_output_format
+from utils import RowWriter
+from utils import validate_arguments
 
 def profile(arguments):
     """
@@ -72,9 +123,12 @@ def profile(arguments):
     this file's docstring with docopt
     :return: None
     """
-    if arguments.get("tag") and not arguments.get("rule"):
+    if arguments.get("find-tag"):
+        profile_find_tag(arguments.get("<TAG>"))
+    elif arguments.get("tag") and not arguments.get("rule"):
         if arguments.get("show"):
-            profile_tag_show(arguments.get("<PROFILE>"))
+            profile_tag_show(arguments.get("<PROFILE>"),
+                             get_output_format(arguments))
         elif arguments.get("add"):
             profile_tag_add(arguments.get("<PROFILE>"),
                             arguments.get("<TAG>"))
@@ -90,49 +144,28 @@ def profile(arguments):
                               human_readable=False)
         elif arguments.get("update"):
             profile_rule_update(arguments.get("<PROFILE>"))
+        elif arguments.get("optimize"):
+            profile_rule_optimize(arguments.get("<PROFILE>"),
+                                  arguments.get("--dry-run"))
         elif arguments.get("add") or arguments.get("remove"):
-            operation = "add" if arguments.get("add") else "remove"
-            action = "allow" if arguments.get("allow") else "deny"
-            direction = ("inbound" if arguments.get("inbound")
-                         else "outbound")
-            if arguments.get("tcp"):
-                protocol = "tcp"
-            elif arguments.get("udp"):
-                protocol = "udp"
-            elif arguments.get("icmp"):
-                protocol = "icmp"
-            else:
-                protocol = None
-            src_ports = parse_ports(arguments.get("<SRCPORTS>"))
-            dst_ports = parse_ports(arguments.get("<DSTPORTS>"))
-            position = arguments.get("--at")
-            if position is not None:
-                try:
-                    position = int(position)
-                except ValueError:
-                    sys.exit(1)
-            profile_rule_add_remove(
-                operation,
-                arguments.get("<PROFILE>"),
-                position,
-                action,
-                direction,
-                protocol=protocol,
-                icmp_type=arguments.get("<ICMPTYPE>"),
-                icmp_code=arguments.get("<ICMPCODE>"),
-                src_net=arguments.get("<SRCCIDR>"),
-                src_tag=arguments.get("<SRCTAG>"),
-                src_ports=src_ports,
-                dst_net=arguments.get("<DSTCIDR>"),
-                dst_tag=arguments.get("<DSTTAG>"),
-                dst_ports=dst_ports,
-            )
+            operation, name, position, direction, rule = \
+                parse_rule_arguments(arguments)
+            profile_rule_add_remove(operation, name, position, direction,
+                                    rule)
+    elif arguments.get("batch"):
+        profile_batch(arguments.get("<FILE>"))
+    elif arguments.get("export"):
+        profile_export(arguments.get("<FILE>"))
+    elif arguments.get("import"):
+        profile_import(arguments.get("<FILE>"),
+                       arguments.get("--concurrency"))
     elif arguments.get("add"):
         profile_add(arguments.get("<PROFILE>"))
     elif arguments.get("remove"):
         profile_remove(arguments.get("<PROFILE>"))
     elif arguments.get("show"):
-        profile_show(arguments.get("--detailed"))
+        profile_show(arguments.get("--detailed"), arguments.get("--counts"),
+                     get_output_format(arguments))
 
 
 def profile_add(profile_name):
@@ -160,10 +193,19 @@ def profile_remove(profile_name):
         print "Deleted profile %s" % profile_name
 
 
-def profile_show(detailed):
+def profile_show(detailed, counts=False, output_format="table"):
     profiles = client.get_profile_names()
 
-    if detailed:
+    if output_format != "table":
+        profile_stream(sorted(profiles), detailed, counts, output_format)
+        return
+
+    if counts:
+        member_counts = client.get_profile_member_counts()
+        x = PrettyTable(["Name", "Endpoints", "Hosts"])
+        for name in profiles:
+            x.add_row([name] + list(member_counts.get(name, (0, 0))))
+    elif detailed:
         x = PrettyTable(["Name", "Host", "Orchestrator ID", "Workload ID",
                          "Endpoint ID", "State"])
         for name in profiles:
@@ -187,7 +229,80 @@ def profile_show(detailed):
     print x.get_string(sortby="Name")
 
 
-def profile_tag_show(name):
+def profile_stream(profiles, detailed, counts, output_format):
+    """
+    Write profiles in a machine readable format, a row at a time.
+
+    :param profiles: The names of the profiles to show.
+    :param detailed: Write a row for each endpoint using each profile.
+    :param counts: Write the number of endpoints and hosts using each
+    profile.
+    :param output_format: "json", "jsonl" or "tsv".
+    :return: None.
+    """
+    if counts:
+        member_counts = client.get_profile_member_counts()
+        with RowWriter(["name", "endpoints", "hosts"],
+                       output_format) as writer:
+            for name in profiles:
+                writer.write(name, *member_counts.get(name, (0, 0)))
+    elif detailed:
+        # Read the endpoints once, rather than once per profile.
+        members = {}
+        for endpoint in client.get_endpoints():
+            for name in endpoint.profile_ids:
+                members.setdefault(name, []).append(endpoint)
+
+        fields = ["name", "hostname", "orchestrator_id", "workload_id",
+                  "endpoint_id", "state"]
+        with RowWriter(fields, output_format) as writer:
+            for name in profiles:
+                if name not in members:
+                    writer.write(name, None, None, None, None, None)
+                for endpoint in members.get(name, []):
+                    writer.write(name,
+                                 endpoint.hostname,
+                                 endpoint.orchestrator_id,
+                                 endpoint.workload_id,
+                                 endpoint.endpoint_id,
+                                 endpoint.state)
+    else:
+        with RowWriter(["name"], output_format) as writer:
+            for name in profiles:
+                writer.write(name)
+
+
+def profile_find_tag(tag):
+    """
+    Show the profiles that carry a tag and the rules that refer to it.
+
+    :param tag: The tag to look for.
+    :return: None.
+    """
+    index = client.get_tag_index()
+
+    profiles = index.profiles_with_tag(tag)
+    references = index.rules_referencing(tag)
+    if not profiles and not references:
+        print "No profiles use tag %s." % tag
+        return
+
+    print "Profiles with tag %s:" % tag
+    x = PrettyTable(["Name"])
+    for name in profiles:
+        x.add_row([name])
+    print str(x)
+
+    print "Rules referring to tag %s:" % tag
+    x = PrettyTable(["Profile", "Direction", "Position", "Rule"])
+    x.align["Rule"] = "l"
+    for reference in references:
+        x.add_row([reference.profile, reference.direction,
+                   reference.position, reference.rule.pprint()])
+    print str(x)
+
+
+def profile_tag_show(name, output_format="table"):
     """Show the tags on the profile."""
     try:
         profile = client.get_profile(name)
@@ -195,6 +310,12 @@ def profile_tag_show(name):
         print "Profile %s not found." % name
         sys.exit(1)
 
+    if output_format != "table":
+        with RowWriter(["tag"], output_format) as writer:
+            for tag in profile.tags:
+                writer.write(tag)
+        return
+
     for tag in profile.tags:
         print tag
 
@@ -280,62 +401,144 @@ def profile_rule_update(name):
     print "Successfully updated rules on profile %s" % name
 
 
-def profile_rule_add_remove(
-        operation,
-        name, position, action, direction,
-        protocol=None,
-        icmp_type=None, icmp_code=None,
-        src_net=None, src_tag=None, src_ports=None,
-        dst_net=None, dst_tag=None, dst_ports=None):
+def profile_rule_optimize(name, dry_run=False):
     """
-    Add or remove a rule from a profile.
+    Replace the rules on a profile with an equivalent optimized set, and
+    report how many rules were removed.
 
-    Arguments not documented below are passed through to the rule.
-
-    :param operation: "add" or "remove".
     :param name: Name of the profile.
-    :param position: Position to insert/remove rule or None for the default.
-    :param action: Rule action: "allow" or "deny".
-    :param direction: "inbound" or "outbound".
+    :param dry_run: If True, print the optimized rules rather than updating
+    the profile.
+    :return: None.
+    """
+    def modify(rules):
+        optimized = rules.optimize()
+        counts = (len(rules.inbound_rules), len(optimized.inbound_rules),
+                  len(rules.outbound_rules), len(optimized.outbound_rules))
+        if not dry_run:
+            rules.inbound_rules[:] = optimized.inbound_rules
+            rules.outbound_rules[:] = optimized.outbound_rules
+        return optimized, counts
 
-    :return:
+    try:
+        if dry_run:
+            profile = client.get_profile(name)
+            optimized, counts = modify(profile.rules)
+        else:
+            (optimized, counts), _ = client.modify_profile_rules(name, modify)
+    except KeyError:
+        print "Profile %s not found." % name
+        sys.exit(1)
+    except ProfileRulesConflict:
+        print "Profile %s is being modified by another client, " \
+              "try again." % name
+        sys.exit(1)
+
+    x = PrettyTable(["Direction", "Before", "After"])
+    x.add_row(["inbound", counts[0], counts[1]])
+    x.add_row(["outbound", counts[2], counts[3]])
+    print str(x)
+
+    if dry_run:
+        print "Inbound rules:"
+        for i, rule in enumerate(optimized.inbound_rules, start=1):
+            print " %3d %s" % (i, rule.pprint())
+        print "Outbound rules:"
+        for i, rule in enumerate(optimized.outbound_rules, start=1):
+            print " %3d %s" % (i, rule.pprint())
+    else:
+        print "Successfully optimized rules on profile %s" % name
+
+
+def parse_rule_arguments(arguments):
     """
+    Convert the docopt arguments of a rule add or remove command into a Rule.
+
+    :param arguments: A dictionary of arguments already processed through
+    this file's docstring with docopt.
+    :return: A tuple of (operation, profile name, position, direction, rule)
+    where rule is None if the rule is only identified by position.
+    """
+    operation = "add" if arguments.get("add") else "remove"
+    direction = "inbound" if arguments.get("inbound") else "outbound"
+    position = arguments.get("--at")
+    if position is not None:
+        try:
+            position = int(position)
+        except ValueError:
+            sys.exit(1)
+
+    # A remove by position does not specify a rule.
+    if not (arguments.get("allow") or arguments.get("deny")):
+        return operation, arguments.get("<PROFILE>"), position, direction, \
+               None
+
+    action = "allow" if arguments.get("allow") else "deny"
+    if arguments.get("tcp"):
+        protocol = "tcp"
+    elif arguments.get("udp"):
+        protocol = "udp"
+    elif arguments.get("icmp"):
+        protocol = "icmp"
+    else:
+        protocol = None
+    src_ports = parse_ports(arguments.get("<SRCPORTS>"))
+    dst_ports = parse_ports(arguments.get("<DSTPORTS>"))
+    icmp_type = arguments.get("<ICMPTYPE>")
     if icmp_type is not None:
         icmp_type = int(icmp_type)
+    icmp_code = arguments.get("<ICMPCODE>")
     if icmp_code is not None:
         icmp_code = int(icmp_code)
 
-    # Convert the input into a Rule.
-    rule_dict = {k: v for (k, v) in locals().iteritems()
-                 if k in Rule.ALLOWED_KEYS and v is not None}
-    rule_dict["action"] = action
     if (protocol not in ("tcp", "udp")) and (src_ports is not None or
                                              dst_ports is not None):
         print "Ports are not valid with protocol %r" % protocol
         sys.exit(1)
-    rule = Rule(**rule_dict)
 
-    # Get the profile.
-    try:
-        profile = client.get_profile(name)
-    except KeyError:
-        print "Profile %s not found." % name
-        sys.exit(1)
+    rule_dict = {"action": action,
+                 "protocol": protocol,
+                 "icmp_type": icmp_type,
+                 "icmp_code": icmp_code,
+                 "src_net": arguments.get("<SRCCIDR>"),
+                 "src_tag": arguments.get("<SRCTAG>"),
+                 "src_ports": src_ports,
+                 "dst_net": arguments.get("<DSTCIDR>"),
+                 "dst_tag": arguments.get("<DSTTAG>"),
+                 "dst_ports": dst_ports}
+    rule = Rule(**{k: v for (k, v) in rule_dict.iteritems()
+                   if v is not None})
+    return operation, arguments.get("<PROFILE>"), position, direction, rule
+
+
+def apply_rule_change(rules, operation, position, direction, rule):
+    """
+    Add or remove a rule from a set of rules.
 
+    Raises ValueError if a rule to be removed is not found.
+
+    :param rules: The Rules to modify in place.
+    :param operation: "add" or "remove".
+    :param position: Position to insert/remove rule or None for the default.
+    :param direction: "inbound" or "outbound".
+    :param rule: The Rule to add or remove, or None if removing by position.
+    :return: A list of warning messages.
+    """
+    warnings = []
     if direction == "inbound":
-        rules = profile.rules.inbound_rules
+        rules = rules.inbound_rules
     else:
-        rules = profile.rules.outbound_rules
+        rules = rules.outbound_rules
 
     if operation == "add":
         if position is None:
             # Default to append.
             position = len(rules) + 1
         if not 0 < position <= len(rules) + 1:
-            print "Position %s is out-of-range." % position
+            warnings.append("Position %s is out-of-range." % position)
         if rule in rules:
-            print "Rule already present, skipping."
-            return
+            warnings.append("Rule already present, skipping.")
+            return warnings
         rules.insert(position - 1, rule)  # Accepts 0 and len(rules).
     else:
         # Remove.
@@ -345,15 +548,294 @@ def profile_rule_add_remove(
             if 0 < position <= len(rules):  # 1-indexed
                 rules.pop(position - 1)
             else:
-                print "Rule position out-of-range."
+                warnings.append("Rule position out-of-range.")
         else:
             # Attempt to match the rule.
             try:
                 rules.remove(rule)
             except ValueError:
-                print "Rule not found."
-                sys.exit(1)
-    client.profile_update_rules(profile)
+                raise ValueError("Rule not found.")
+    return warnings
+
+
+def profile_rule_add_remove(operation, name, position, direction, rule):
+    """
+    Add or remove a rule from a profile.
+
+    The profile is updated atomically, so concurrent changes to the same
+    profile are not lost.
+
+    :param operation: "add" or "remove".
+    :param name: Name of the profile.
+    :param position: Position to insert/remove rule or None for the default.
+    :param direction: "inbound" or "outbound".
+    :param rule: The Rule to add or remove, or None if removing by position.
+    :return: None.
+    """
+    def modify(rules):
+        return apply_rule_change(rules, operation, position, direction, rule)
+
+    try:
+        warnings, _ = client.modify_profile_rules(name, modify)
+    except KeyError:
+        print "Profile %s not found." % name
+        sys.exit(1)
+    except ValueError as e:
+        print e.message
+        sys.exit(1)
+    except ProfileRulesConflict:
+        print "Profile %s is being modified by another client, " \
+              "try again." % name
+        sys.exit(1)
+
+    for warning in warnings:
+        print warning
+
+
+def profile_batch(filename):
+    """
+    Apply rule add and remove commands read from a file.
+
+    All of the commands are parsed before any profile is changed.  The
+    commands for each profile are then applied together in one atomic update
+    of that profile, which is retried if it conflicts with another client.
+
+    :param filename: The file to read, or None (or "-") for standard input.
+    :return: None.
+    """
+    if filename in (None, "-"):
+        lines = sys.stdin.readlines()
+    else:
+        try:
+            with open(filename) as f:
+                lines = f.readlines()
+        except IOError as e:
+            print "Unable to read %s: %s" % (filename, e.strerror)
+            sys.exit(1)
+
+    # Parse every line up front, grouping the changes by profile.
+    changes = OrderedDict()
+    for line_num, line in enumerate(lines, start=1):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        try:
+            arguments = docopt(__doc__, argv=["profile"] + shlex.split(line))
+        except DocoptExit:
+            arguments = {}
+        if not (arguments.get("rule") and
+                (arguments.get("add") or arguments.get("remove"))):
+            print "Line %d is not a rule add or remove command: %s" % \
+                  (line_num, line)
+            sys.exit(1)
+        try:
+            # The same checks as a single command, which also normalize the
+            # CIDRs.
+            validate_arguments(arguments)
+        except SystemExit:
+            print "Line %d is not a valid rule: %s" % (line_num, line)
+            sys.exit(1)
+        try:
+            operation, name, position, direction, rule = \
+                parse_rule_arguments(arguments)
+        except (AddrFormatError, ValueError):
+            print "Line %d is not a valid rule: %s" % (line_num, line)
+            sys.exit(1)
+        changes.setdefault(name, []).append(
+            (line_num, operation, position, direction, rule))
+
+    start = time.time()
+    updated = 0
+    retries = 0
+    failed = 0
+    for name, profile_changes in changes.iteritems():
+        def modify(rules):
+            warnings = []
+            for line_num, operation, position, direction, rule in \
+                    profile_changes:
+                try:
+                    messages = apply_rule_change(rules, operation, position,
+                                                 direction, rule)
+                except ValueError as e:
+                    messages = [e.message]
+                warnings.extend("Line %d: %s" % (line_num, message)
+                                for message in messages)
+            return warnings
+
+        try:
+            warnings, attempts = client.modify_profile_rules(name, modify)
+        except KeyError:
+            print "Profile %s not found." % name
+            failed += 1
+            continue
+        except ProfileRulesConflict:
+            print "Profile %s is being modified by another client, " \
+                  "skipping." % name
+            failed += 1
+            continue
+
+        for warning in warnings:
+            print warning
+        updated += 1
+        retries += attempts - 1
+
+    print "Updated %d profiles (%d conflicts retried, %d failed) in %.2fs" % \
+          (updated, retries, failed, time.time() - start)
+    if failed:
+        sys.exit(1)
+
+
+def profile_export(filename):
+    """
+    Write every profile as a line of JSON.
+
+    :param filename: The file to write, or None (or "-") for standard output.
+    :return: None.
+    """
+    if filename in (None, "-"):
+        out = sys.stdout
+    else:
+        try:
+            out = open(filename, "w")
+        except IOError as e:
+            print "Unable to write %s: %s" % (filename, e.strerror)
+            sys.exit(1)
+
+    profiles = client.get_profiles()
+    for name in sorted(profiles):
+        out.write(profiles[name].to_json() + "\n")
+
+    if out is not sys.stdout:
+        out.close()
+
+
+def profile_import(filename, concurrency):
+    """
+    Create or update the profiles read from lines of JSON, as written by
+    profile_export.
+
+    Every line is parsed before any profile is changed.  The profiles are
+    then imported concurrently.
+
+    :param filename: The file to read, or None (or "-") for standard input.
+    :param concurrency: The number of profiles to import at once.
+    :return: None.
+    """
+    try:
+        concurrency = int(concurrency)
+        if concurrency <= 0:
+            raise ValueError()
+    except ValueError:
+        print "Invalid concurrency %s." % concurrency
+        sys.exit(1)
+
+    if filename in (None, "-"):
+        lines = sys.stdin.readlines()
+    else:
+        try:
+            with open(filename) as f:
+                lines = f.readlines()
+        except IOError as e:
+            print "Unable to read %s: %s" % (filename, e.strerror)
+            sys.exit(1)
+
+    profiles = OrderedDict()
+    for line_num, line in enumerate(lines, start=1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            profile = Profile.from_json(line)
+        except (ValueError, KeyError, TypeError, AddrFormatError):
+            print "Line %d is not a valid profile: %s" % (line_num, line)
+            sys.exit(1)
+        if profile.rules.id != profile.name:
+            print 'Line %d: rules "id"=%s doesn\'t match profile name %s.' % \
+                  (line_num, profile.rules.id, profile.name)
+            sys.exit(1)
+        try:
+            # The same checks as profile add and tag add.
+            validate_arguments({"<PROFILE>": profile.name})
+            for tag in profile.tags:
+                validate_arguments({"<TAG>": tag})
+        except SystemExit:
+            print "Line %d is not a valid profile: %s" % (line_num, line)
+            sys.exit(1)
+        if profile.name in profiles:
+            print "Line %d: profile %s is repeated." % (line_num, profile.name)
+            sys.exit(1)
+        profiles[profile.name] = profile
+
+    start = time.time()
+    existing = client.get_profiles(profiles.keys())
+    pool = ThreadPool(concurrency)
+    try:
+        # The thread pool doesn't pickle, so a lambda is fine here.
+        results = dict(pool.imap_unordered(
+            lambda args: import_profile(*args),
+            [(profile, existing.get(name))
+             for name, profile in profiles.iteritems()]))
+    finally:
+        pool.close()
+        pool.join()
+
+    changes = PrettyTable(["Profile", "Change"])
+    changes.align = "l"
+    counts = {"created": 0, "updated": 0, "unchanged": 0, "failed": 0}
+    for name in profiles:
+        status, detail = results[name]
+        counts[status] += 1
+        if status != "unchanged":
+            changes.add_row([name, detail])
+    if counts["created"] or counts["updated"] or counts["failed"]:
+        print str(changes)
+
+    print "Imported %d profiles in %.2fs: %d created, %d updated, " \
+          "%d unchanged, %d failed" % \
+          (len(profiles), time.time() - start, counts["created"],
+           counts["updated"], counts["unchanged"], counts["failed"])
+    if counts["failed"]:
+        sys.exit(1)
+
+
+def import_profile(profile, existing):
+    """
+    Create or update a profile to match the given Profile, writing only the
+    tags and rules that differ.  The rules are updated atomically, so rules
+    changed by another client since they were read are not overwritten.
+
+    :param profile: The Profile to import.
+    :param existing: The Profile as read from the datastore, or None if it
+    does not exist.
+    :return: A tuple of (the profile name, (status, detail)), where status is
+    one of "created", "updated", "unchanged" or "failed", and detail
+    describes the change.
+    """
+    try:
+        if existing is None:
+            client.profile_update_tags(profile)
+            client.profile_update_rules(profile, atomic=True)
+            return profile.name, ("created", "created")
+
+        changed = []
+        if existing.tags != profile.tags:
+            added = profile.tags - existing.tags
+            removed = existing.tags - profile.tags
+            existing.tags = profile.tags
+            client.profile_update_tags(existing)
+            changed.append("tags +%d -%d" % (len(added), len(removed)))
+        if existing.rules.to_json_dict() != profile.rules.to_json_dict():
+            existing.rules = profile.rules
+            client.profile_update_rules(existing, atomic=True)
+            changed.append("rules")
+    except ProfileRulesConflict:
+        return profile.name, ("failed", "rules modified by another client")
+    except DataStoreError as e:
+        return profile.name, ("failed", e.message)
+
+    if not changed:
+        return profile.name, ("unchanged", "")
+    return profile.name, ("updated", "updated " + ", ".join(changed))
 
 
 def parse_ports(ports_str):
@@ -13,14 +13,28 @@
 # limitations under the License.
 """
 Usage:
-  calicoctl status
+  calicoctl status [--watch] [--interval=<SECONDS>]
 
 Description:
   Print current status information regarding calico-node container
   and the BIRD routing daemon.
+
+  With --watch, instead show the endpoints on this host, the rate at which
+  they are being created and removed, and the usage of each IP pool, updated
+  live from the datastore until interrupted.
+
+Options:
+  --watch                 Show live datastore status.
+  --interval=<SECONDS>    Seconds between updates with --watch. [default: 5]
 """
 import re
+import sys
+import time
+from prettytable import PrettyTable
+from pycalico.inventory import Inventory
+from utils import client
 from utils import docker_client
+from utils import hostname
 
 
 def status(arguments):
@@ -32,6 +46,18 @@ def status(arguments):
     this file's docstring with docopt
     :return: None
     """
+    if arguments.get("--watch"):
+        try:
+            interval = float(arguments.get("--interval"))
+            # Also rejects nan.
+            if not interval > 0:
+                raise ValueError()
+        except ValueError:
+            print "Invalid interval %s." % arguments.get("--interval")
+            sys.exit(1)
+        status_watch(interval)
+        return
+
     calico_node_info = filter(lambda container: "/calico-node" in
                               container["Names"],
                               docker_client.containers())
@@ -60,3 +86,34 @@ def status(arguments):
                                      "birdc6 -s "
                                      "/etc/service/bird6/bird6.ctl"])
         print docker_client.exec_start(bird6_cmd)
+
+
+def status_watch(interval):
+    """
+    Print the endpoint count, endpoint churn and IP pool usage every
+    interval seconds until interrupted.  The datastore is read once, and
+    then kept up to date by watching for changes.
+
+    :param interval: The number of seconds between updates.
+    :return: None.
+    """
+    inventory = Inventory(client, hostname)
+    inventory.start()
+    try:
+        while True:
+            print time.strftime("%H:%M:%S"), "Host %s: %d endpoints, " \
+                  "%.1f endpoints created or removed per minute, " \
+                  "%d changes seen" % (hostname, inventory.endpoint_count(),
+                                       inventory.churn_rate(),
+                                       inventory.events)
+            x = PrettyTable(["CIDR", "Size", "Assigned", "Used",
+                             "Assigned by this host"])
+            for usage in inventory.pool_usage():
+                used = 100.0 * usage.assigned / usage.capacity \
+                    if usage.capacity else 0
+                x.add_row([usage.cidr, usage.capacity, usage.assigned,
+                           "%.1f%%" % used, usage.hosts.get(hostname, 0)])
+            print str(x)
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
@@ -11,31 +11,86 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import json
 import socket
 import os
+import re
 import sys
-import sh
-import docker
 import textwrap
+import threading
 import netaddr
-import docker.errors
+from collections import OrderedDict
 
-from pycalico.ipam import IPAMClient
 from netaddr.core import AddrFormatError
 
 
 DOCKER_VERSION = "1.16"
 ORCHESTRATOR_ID = "docker"
 hostname = socket.gethostname()
-client = IPAMClient()
-docker_client = docker.Client(version=DOCKER_VERSION,
-                              base_url=os.getenv("DOCKER_HOST",
-                                                 "unix://var/run/docker.sock"))
 
-try:
-    sysctl = sh.Command._create("sysctl")
-except sh.CommandNotFound as e:
-    print "Missing command: %s" % e.message
+OUTPUT_FORMATS = ("table", "json", "jsonl", "tsv")
+"""The values of the --output option of the show commands."""
+
+
+class LazyObject(object):
+    """
+    Stands in for an object that is expensive to create or to import the
+    code for, creating it on first use.  Attribute access and calls are
+    forwarded to the object.
+    """
+
+    def __init__(self, factory):
+        """
+        Constructor.
+        :param factory: Called with no arguments to create the object.
+        """
+        object.__setattr__(self, "_factory", factory)
+        object.__setattr__(self, "_object", None)
+        object.__setattr__(self, "_lock", threading.Lock())
+
+    def _get_object(self):
+        if self._object is None:
+            with self._lock:
+                if self._object is None:
+                    object.__setattr__(self, "_object", self._factory())
+        return self._object
+
+    def __getattr__(self, name):
+        return getattr(self._get_object(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._get_object(), name, value)
+
+    def __call__(self, *args, **kwargs):
+        return self._get_object()(*args, **kwargs)
+
+
+def _create_client():
+    from pycalico.ipam import IPAMClient
+    return IPAMClient()
+
+
+def _create_docker_client():
+    import docker
+    return docker.Client(version=DOCKER_VERSION,
+                         base_url=os.getenv("DOCKER_HOST",
+                                            "unix://var/run/docker.sock"))
+
+
+def _create_sysctl():
+    import sh
+    try:
+        return sh.Command._create("sysctl")
+    except sh.CommandNotFound as e:
+        print "Missing command: %s" % e.message
+        sys.exit(1)
+
+
+# The clients are created when first used, so that commands that don't need
+# them don't pay for importing and connecting them.
+client = LazyObject(_create_client)
+docker_client = LazyObject(_create_docker_client)
+sysctl = LazyObject(_create_sysctl)
 
 
 def check_ip_version(ip, version, cls):
@@ -79,6 +134,90 @@ def print_paragraph(msg):
     print
 
 
+def validate_arguments(arguments):
+    """
+    Validate common argument values.
+
+    :param arguments: Docopt processed arguments.
+    """
+    # List of valid characters that Felix permits
+    valid_chars = '[a-zA-Z0-9_\.\-]'
+
+    # Validate Profiles
+    profile_ok = True
+    if "<PROFILES>" in arguments or "<PROFILE>" in arguments:
+        profiles = arguments.get("<PROFILES>") or arguments.get("<PROFILE>")
+        if profiles:
+            for profile in profiles:
+                if not re.match("^%s+$" % valid_chars, profile):
+                    profile_ok = False
+                    break
+
+    # Validate tags
+    tag_ok = (arguments.get("<TAG>") is None or
+              re.match("^%s+$" % valid_chars, arguments["<TAG>"]))
+
+    # Validate IPs
+    ip_ok = arguments.get("--ip") is None or netaddr.valid_ipv4(arguments.get("--ip"))
+    ip6_ok = arguments.get("--ip6") is None or \
+             netaddr.valid_ipv6(arguments.get("--ip6"))
+    container_ip_ok = arguments.get("<IP>") is None or \
+                      netaddr.valid_ipv4(arguments["<IP>"]) or \
+                      netaddr.valid_ipv6(arguments["<IP>"])
+    peer_ip_ok = arguments.get("<PEER_IP>") is None or \
+                 netaddr.valid_ipv4(arguments["<PEER_IP>"]) or \
+                 netaddr.valid_ipv6(arguments["<PEER_IP>"])
+    cidr_ok = True
+    for arg in ["<CIDR>", "<SRCCIDR>", "<DSTCIDR>"]:
+        if arguments.get(arg):
+            try:
+                arguments[arg] = str(netaddr.IPNetwork(arguments[arg]))
+            except (AddrFormatError, ValueError):
+                # Some versions of Netaddr have a bug causing them to return a
+                # ValueError rather than an AddrFormatError, so catch both.
+                cidr_ok = False
+    icmp_ok = True
+    for arg in ["<ICMPCODE>", "<ICMPTYPE>"]:
+        if arguments.get(arg) is not None:
+            try:
+                value = int(arguments[arg])
+                if not (0 <= value < 255):  # Felix doesn't support 255
+                    raise ValueError("Invalid %s: %s" % (arg, value))
+            except ValueError:
+                icmp_ok = False
+    asnum_ok = True
+    if arguments.get("<AS_NUM>") or arguments.get("--as"):
+        try:
+            asnum = int(arguments["<AS_NUM>"] or arguments["--as"])
+            asnum_ok = 0 <= asnum <= 4294967295
+        except ValueError:
+            asnum_ok = False
+
+    if not profile_ok:
+        print_paragraph("Profile names must be < 40 character long and can "
+                        "only contain numbers, letters, dots, dashes and "
+                        "underscores.")
+    if not tag_ok:
+        print_paragraph("Tags names can only contain numbers, letters, dots, "
+                        "dashes and underscores.")
+    if not ip_ok:
+        print "Invalid IPv4 address specified with --ip argument."
+    if not ip6_ok:
+        print "Invalid IPv6 address specified with --ip6 argument."
+    if not container_ip_ok or not peer_ip_ok:
+        print "Invalid IP address specified."
+    if not cidr_ok:
+        print "Invalid CIDR specified."
+    if not icmp_ok:
+        print "Invalid ICMP type or code specified."
+    if not asnum_ok:
+        print "Invalid AS Number specified."
+
+    if not (profile_ok and ip_ok and ip6_ok and tag_ok and peer_ip_ok and
+                container_ip_ok and cidr_ok and icmp_ok and asnum_ok):
+        sys.exit(1)
+
+
 def get_container_ipv_from_arguments(arguments):
     """
     Determine the container IP version from the arguments.
@@ -100,6 +239,98 @@ def get_container_ipv_from_arguments(arguments):
     return version
 
 
+def get_output_format(arguments):
+    """
+    Determine the output format of a show command from the arguments.
+
+    :param arguments: Docopt processed arguments.
+    :return: One of OUTPUT_FORMATS.  Exits if the format is invalid.
+    """
+    output_format = arguments.get("--output") or "table"
+    if output_format not in OUTPUT_FORMATS:
+        print "Invalid output format %s.  Choose from: %s." % \
+              (output_format, ", ".join(OUTPUT_FORMATS))
+        sys.exit(1)
+    return output_format
+
+
+class RowWriter(object):
+    """
+    Writes rows to stdout in a machine readable format as they are added,
+    rather than buffering them like a PrettyTable.
+
+    The formats are:
+     - json: a JSON array of objects, one per row
+     - jsonl: one JSON object per line
+     - tsv: a header line of the field names, then one line per row.  Tabs,
+       newlines and backslashes in values are escaped with a backslash, and
+       lists are joined with commas.
+
+    Use as a context manager, so that the JSON array is closed.
+    """
+
+    def __init__(self, fields, output_format):
+        """
+        Constructor.
+        :param fields: The field names, in order.
+        :param output_format: "json", "jsonl" or "tsv".
+        """
+        assert output_format in ("json", "jsonl", "tsv")
+        self.fields = fields
+        self.output_format = output_format
+        self.rows = 0
+        # Looked up here rather than bound at import, so that the output of a
+        # batched command can be captured.
+        self._stream = sys.stdout
+        if output_format == "json":
+            self._stream.write("[")
+        elif output_format == "tsv":
+            self._stream.write("\t".join(fields) + "\n")
+
+    def write(self, *values):
+        """
+        Write a row.
+        :param values: The value of each field, in order.  Lists, dicts,
+        numbers, booleans and None are written as themselves in JSON; other
+        values are converted to strings.
+        :return: None.
+        """
+        if self.output_format == "tsv":
+            line = "\t".join(_tsv_value(value) for value in values) + "\n"
+        else:
+            line = json.dumps(OrderedDict(zip(self.fields, values)),
+                              default=str)
+            if self.output_format == "json":
+                line = ("\n" if self.rows == 0 else ",\n") + line
+            else:
+                line += "\n"
+        self._stream.write(line)
+        self.rows += 1
+
+    def close(self):
+        if self.output_format == "json":
+            self._stream.write("\n]\n" if self.rows else "]\n")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def _tsv_value(value):
+    if value is None:
+        return ""
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, dict):
+        value = ",".join("%s=%s" % item for item in sorted(value.items()))
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        value = ",".join(str(item) for item in value)
+    return str(value).replace("\\", "\\\\").replace("\t", "\\t") \
+        .replace("\n", "\\n")
+
+
 class Vividict(dict):
     # From http://stackoverflow.com/a/19829714
     def __missing__(self, key):
@@ -27,114 +27,162 @@ Usage: calicoctl <command> [<args>...]
     profile           Configure endpoint profiles
     endpoint          Configure the endpoints assigned to existing containers
     pool              Configure ip-pools
+    ipam              Manage IP address assignments
     bgp               Configure global bgp
     checksystem       Check for incompatabilities on the host system
     diags             Save diagnostic information
+    batch             Run many commands in one process
 
 See 'calicoctl <command> --help' to read about a specific subcommand.
 """
 import sys
 import traceback
-import netaddr
-from netaddr import AddrFormatError
-import re
+import importlib
+import json
+import shlex
+from StringIO import StringIO
 from docopt import docopt
 from pycalico.datastore_errors import DataStoreError
 
-import calico_ctl.node
-import calico_ctl.container
-import calico_ctl.profile
-import calico_ctl.endpoint
-import calico_ctl.pool
-import calico_ctl.bgp
-import calico_ctl.checksystem
-import calico_ctl.status
-import calico_ctl.diags
 from calico_ctl.utils import print_paragraph
+from calico_ctl.utils import validate_arguments
+
+COMMANDS = ["status", "node", "container", "profile", "endpoint", "pool",
+            "ipam", "bgp", "checksystem", "diags"]
+"""The subcommands.  Only the module for the command being run is imported,
+so these must also be passed to PyInstaller as hidden imports."""
+
+BATCH_DOC = """
+Usage:
+  calicoctl batch [--json] [--stop-on-error] [<FILE>]
+
+Description:
+  Run calicoctl commands, one per line, in a single process.  This saves the
+  cost of starting calicoctl and connecting to etcd and Docker for each
+  command.  The commands are read from FILE, or from standard input if FILE
+  is omitted or is -.  Blank lines and lines starting with # are skipped, and
+  the leading "calicoctl" on each line is optional.
+
+  The output of each command is printed separately, followed by its exit
+  status.  The batch exits with status 1 if any command failed.
+
+Options:
+  --json           Print one JSON object per command, with the line number,
+                   command, exit status and output.
+  --stop-on-error  Don't run any more commands after one fails.
+
+Examples:
+  $ printf "pool show\\nprofile show\\n" | calicoctl batch
+"""
 
 
-def validate_arguments(arguments):
-        """
-        Validate common argument values.
-
-        :param arguments: Docopt processed arguments.
-        """
-        # List of valid characters that Felix permits
-        valid_chars = '[a-zA-Z0-9_\.\-]'
-
-        # Validate Profiles
-        profile_ok = True
-        if "<PROFILES>" in arguments or "<PROFILE>" in arguments:
-            profiles = arguments.get("<PROFILES>") or arguments.get("<PROFILE>")
-            if profiles:
-                for profile in profiles:
-                    if not re.match("^%s+$" % valid_chars, profile):
-                        profile_ok = False
-                        break
-
-        # Validate tags
-        tag_ok = (arguments.get("<TAG>") is None or
-                  re.match("^%s+$" % valid_chars, arguments["<TAG>"]))
-
-        # Validate IPs
-        ip_ok = arguments.get("--ip") is None or netaddr.valid_ipv4(arguments.get("--ip"))
-        ip6_ok = arguments.get("--ip6") is None or \
-                 netaddr.valid_ipv6(arguments.get("--ip6"))
-        container_ip_ok = arguments.get("<IP>") is None or \
-                          netaddr.valid_ipv4(arguments["<IP>"]) or \
-                          netaddr.valid_ipv6(arguments["<IP>"])
-        peer_ip_ok = arguments.get("<PEER_IP>") is None or \
-                     netaddr.valid_ipv4(arguments["<PEER_IP>"]) or \
-                     netaddr.valid_ipv6(arguments["<PEER_IP>"])
-        cidr_ok = True
-        for arg in ["<CIDR>", "<SRCCIDR>", "<DSTCIDR>"]:
-            if arguments.get(arg):
-                try:
-                    arguments[arg] = str(netaddr.IPNetwork(arguments[arg]))
-                except (AddrFormatError, ValueError):
-                    # Some versions of Netaddr have a bug causing them to return a
-                    # ValueError rather than an AddrFormatError, so catch both.
-                    cidr_ok = False
-        icmp_ok = True
-        for arg in ["<ICMPCODE>", "<ICMPTYPE>"]:
-            if arguments.get(arg) is not None:
-                try:
-                    value = int(arguments[arg])
-                    if not (0 <= value < 255):  # Felix doesn't support 255
-                        raise ValueError("Invalid %s: %s" % (arg, value))
-                except ValueError:
-                    icmp_ok = False
-        asnum_ok = True
-        if arguments.get("<AS_NUM>") or arguments.get("--as"):
-            try:
-                asnum = int(arguments["<AS_NUM>"] or arguments["--as"])
-                asnum_ok = 0 <= asnum <= 4294967295
-            except ValueError:
-                asnum_ok = False
-
-        if not profile_ok:
-            print_paragraph("Profile names must be < 40 character long and can "
-                            "only contain numbers, letters, dots, dashes and "
-                            "underscores.")
-        if not tag_ok:
-            print_paragraph("Tags names can only contain numbers, letters, dots, "
-                            "dashes and underscores.")
-        if not ip_ok:
-            print "Invalid IPv4 address specified with --ip argument."
-        if not ip6_ok:
-            print "Invalid IPv6 address specified with --ip6 argument."
-        if not container_ip_ok or not peer_ip_ok:
-            print "Invalid IP address specified."
-        if not cidr_ok:
-            print "Invalid CIDR specified."
-        if not icmp_ok:
-            print "Invalid ICMP type or code specified."
-        if not asnum_ok:
-            print "Invalid AS Number specified."
-
-        if not (profile_ok and ip_ok and ip6_ok and tag_ok and peer_ip_ok and
-                    container_ip_ok and cidr_ok and icmp_ok and asnum_ok):
-            sys.exit(1)
+def run_command(argv):
+    """
+    Run a calicoctl command.
+
+    :param argv: The command and its arguments, without "calicoctl".
+    :return: The exit status of the command.
+    """
+    command = argv[0] if argv else None
+    if command not in COMMANDS:
+        print "Unknown command %s.  See 'calicoctl --help'." % command
+        return 1
+
+    try:
+        # Import the python file in the calico_ctl module which
+        # shares the same name as the input command
+        command_module = importlib.import_module("calico_ctl.%s" % command)
+
+        # docopt the arguments through that module's docstring
+        arguments = docopt(command_module.__doc__, argv=argv)
+        validate_arguments(arguments)
+
+        # Call the dispatch function in that module which should also have
+        # the same name
+        getattr(command_module, command)(arguments)
+    except SystemExit as e:
+        # docopt exits with the usage message, and commands with a status.
+        if e.code is None or isinstance(e.code, int):
+            return e.code or 0
+        print >> sys.stderr, e.code
+        return 1
+    except DataStoreError as e:
+        print_paragraph(e.message)
+        return 1
+    except KeyboardInterrupt:
+        raise
+    except BaseException as e:
+        print "Unexpected error executing command.\n"
+        traceback.print_exc()
+        return 1
+    return 0
+
+
+def capture_command(argv):
+    """
+    Run a calicoctl command, capturing what it prints.
+
+    :param argv: The command and its arguments, without "calicoctl".
+    :return: A tuple of (the output, the exit status).
+    """
+    stdout, stderr = sys.stdout, sys.stderr
+    sys.stdout = sys.stderr = captured = StringIO()
+    try:
+        status = run_command(argv)
+    finally:
+        sys.stdout, sys.stderr = stdout, stderr
+    return captured.getvalue(), status
+
+
+def batch(arguments):
+    """
+    Run calicoctl commands read from a file, keeping each command's output
+    and exit status separate.
+
+    :param arguments: Docopt processed arguments for BATCH_DOC.
+    :return: The exit status of the batch.
+    """
+    filename = arguments.get("<FILE>")
+    if filename in (None, "-"):
+        lines = sys.stdin
+    else:
+        try:
+            lines = open(filename)
+        except IOError as e:
+            print "Unable to read %s: %s" % (filename, e.strerror)
+            return 1
+
+    failed = False
+    for line_num, line in enumerate(lines, start=1):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        try:
+            argv = shlex.split(line)
+        except ValueError as e:
+            output, status = "Invalid command: %s\n" % e, 1
+        else:
+            if argv[0] == "calicoctl":
+                argv = argv[1:]
+            if argv and argv[0] == "batch":
+                output, status = "Batches can't be nested.\n", 1
+            else:
+                output, status = capture_command(argv)
+
+        if arguments.get("--json"):
+            print json.dumps({"line": line_num, "command": line,
+                              "status": status, "output": output})
+        else:
+            print "==> %d: %s" % (line_num, line)
+            sys.stdout.write(output)
+            print "<== %d: exit status %d" % (line_num, status)
+        sys.stdout.flush()
+
+        if status:
+            failed = True
+            if arguments.get("--stop-on-error"):
+                break
+    return 1 if failed else 0
 
 
 if __name__ == '__main__':
@@ -161,29 +209,10 @@ if __name__ == '__main__':
     argv = [command_args['<command>']] + command_args['<args>']
 
     # Dispatch the appropriate subcommand
-    try:
-        command = command_args['<command>']
-
-        # Look for a python file in the calico_ctl module which
-        # shares the same name as the input command
-        command_module = getattr(calico_ctl, command)
-
-        # docopt the arguments through that module's docstring
-        arguments = docopt(command_module.__doc__, argv=argv)
-        validate_arguments(arguments)
-
-        # Call the dispatch function in that module which should also have
-        # the same name
-        getattr(command_module, command)(arguments)
-    except AttributeError:
+    command = command_args['<command>']
+    if command == "batch":
+        sys.exit(batch(docopt(BATCH_DOC, argv=argv)))
+    if command not in COMMANDS:
         # Unrecognized submodule. Show main help message
         docopt(__doc__, options_first=True, argv=['--help'])
-    except SystemExit:
-        raise
-    except DataStoreError as e:
-        print_paragraph(e.message)
-        sys.exit(1)
-    except BaseException as e:
-        print "Unexpected error executing command.\n"
-        traceback.print_exc()
-        sys.exit(1)
+    sys.exit(run_command(argv))
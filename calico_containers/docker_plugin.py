@@ -13,31 +13,294 @@
 # limitations under the License.
 
 from flask import Flask, jsonify, abort, request
+try:
+    import ujson as json_codec
+except ImportError:
+    import json as json_codec
+from collections import OrderedDict
 import os
 import socket
 import logging
 import sys
+import threading
+import time
 
+from etcd import EtcdException
 from subprocess32 import check_call, CalledProcessError, call
-from werkzeug.exceptions import HTTPException, default_exceptions
+from werkzeug.exceptions import HTTPException, default_exceptions, \
+    BadRequest
+from werkzeug.http import HTTP_STATUS_CODES
 from netaddr import IPAddress, IPNetwork
 
-from pycalico.datastore import IF_PREFIX
-from pycalico.datastore_errors import DataStoreError
+from pycalico.datastore import IF_PREFIX, LIBNETWORK_ORCHESTRATOR_ID, \
+    LIBNETWORK_WORKLOAD_ID
+from pycalico.datastore_errors import DataStoreError, \
+    AllocationRetriesExceeded
 from pycalico.datastore_datatypes import Endpoint
-from pycalico.ipam import SequentialAssignment, IPAMClient
+from pycalico.inventory import Inventory
+from pycalico.journal import IntentJournal, read_journal, claim_journals
+from pycalico.reconcile import drain_host
+from pycalico.ipam import IPAMClient, get_assigner_class
 
 FIXED_MAC = "EE:EE:EE:EE:EE:EE"
 
-CONTAINER_NAME = "libnetwork"
+CONTAINER_NAME = LIBNETWORK_WORKLOAD_ID
 
-ORCHESTRATOR_ID = "docker"
+ORCHESTRATOR_ID = LIBNETWORK_ORCHESTRATOR_ID
 # How long to wait (seconds) for IP commands to complete.
 IP_CMD_TIMEOUT = 5
 
+# The number of created endpoints to remember, and for how long (seconds), so
+# that Join and DeleteEndpoint don't need to read them from the datastore.
+ENDPOINT_CACHE_SIZE = 1000
+ENDPOINT_CACHE_TTL = 600
+
+# Where each worker journals the phases of CreateEndpoint, so that the IPs
+# and veths of a request interrupted by the worker dying can be cleaned up.
+JOURNAL_DIR_ENV = "CALICO_PLUGIN_JOURNAL_DIR"
+JOURNAL_DIR_DEFAULT = "/var/lib/calico/plugin_journal"
+
 hostname = socket.gethostname()
 client = IPAMClient()
 
+# The IP allocation strategy, selected by the CALICO_IPAM_STRATEGY environment
+# variable.  Looked up once here, so that an invalid strategy stops the plugin
+# starting rather than failing every request.
+assigner_class = get_assigner_class()
+
+# A watch-backed view of the IP pools and this host's next hops, shared by the
+# request handlers.  Only set when the plugin runs under gunicorn with the
+# hooks in gunicorn_config.py; otherwise the handlers read the datastore.
+inventory = None
+
+# This process's IntentJournal, if it journals CreateEndpoint requests.
+journal = None
+
+
+def snapshot_datastore():
+    """
+    Snapshot the IP pools and this host's next hops into the inventory.
+
+    Called once in the gunicorn master after the app is preloaded, so that
+    every worker forked from it starts with the same state without reading it
+    from etcd again.  If etcd can't be read, the inventory starts empty, and
+    each worker takes its own snapshot once etcd is reachable.
+    """
+    global inventory
+    inventory = Inventory(client, hostname, track_assignments=False)
+    try:
+        inventory.snapshot()
+    except (EtcdException, DataStoreError) as e:
+        app.logger.exception(e)
+    else:
+        app.logger.info("Snapshot of datastore taken at etcd index %s",
+                        inventory.index)
+
+
+def open_journal():
+    """
+    Start journalling CreateEndpoint requests handled by this process.
+
+    Called in each gunicorn worker after it is forked.
+    """
+    global journal
+    journal = IntentJournal(os.getenv(JOURNAL_DIR_ENV, JOURNAL_DIR_DEFAULT))
+
+
+def recover_journals(startup=False):
+    """
+    Roll back the CreateEndpoint requests that were interrupted by the death
+    of the process handling them.
+
+    :param startup: Whether the plugin is starting up, in which case every
+    journal is from a previous run.  Otherwise, only the journals of
+    processes that are no longer running are recovered.
+    """
+    directory = os.getenv(JOURNAL_DIR_ENV, JOURNAL_DIR_DEFAULT)
+    for path in claim_journals(directory, skip_pids=[os.getpid()],
+                               live=startup):
+        try:
+            operations = read_journal(path)
+            if operations:
+                app.logger.info("Rolling back %d interrupted endpoint "
+                                "creations from %s", len(operations), path)
+            for ep_id, records in operations.iteritems():
+                rollback_endpoint(ep_id, records)
+        except (DataStoreError, IOError, OSError) as e:
+            # Leave the journal to be recovered on the next startup.
+            app.logger.exception(e)
+        else:
+            os.remove(path)
+
+
+def rollback_endpoint(ep_id, records):
+    """
+    Roll back the journalled phases of an interrupted CreateEndpoint.
+    :param ep_id: The endpoint ID.
+    :param records: The journal records for the endpoint.
+    """
+    # If the endpoint reached the datastore, the request completed.
+    if find_endpoint(ep_id) is not None:
+        return
+
+    for record in records:
+        if record["phase"] == "ips":
+            for ip in record["ips"]:
+                if not unassign_ip(IPAddress(ip)):
+                    app.logger.warn("Failed to unassign IP %s", ip)
+        elif record["phase"] == "veth":
+            remove_veth(Endpoint(hostname, "docker", CONTAINER_NAME, ep_id,
+                                 "active", FIXED_MAC))
+
+
+def journal_phase(ep_id, phase, **data):
+    """
+    Durably record a phase of CreateEndpoint, if this process journals.
+    :param ep_id: The endpoint ID.
+    :param phase: "ips" or "veth".
+    :param data: The data needed to roll the phase back.
+    """
+    if journal is not None:
+        journal.sync(journal.record(ep_id, phase, **data))
+
+
+def journal_complete(ep_id):
+    """
+    Record that CreateEndpoint has finished or been rolled back, if this
+    process journals.
+    :param ep_id: The endpoint ID.
+    """
+    if journal is not None:
+        journal.complete(ep_id)
+
+
+def start_datastore_watch():
+    """
+    Keep this process's copy of the inventory up to date.
+
+    Called in each gunicorn worker after it is forked.  The etcd connections
+    inherited from the master are dropped first, so that workers never share
+    a socket.
+    """
+    client.etcd_client.http.clear()
+    if inventory is not None:
+        inventory.start(snapshot=False)
+
+
+class EndpointCache(object):
+    """
+    A bounded table of the endpoints recently created by this process, keyed
+    by endpoint ID.
+
+    Entries expire ttl seconds after they are added, and the oldest entries
+    are evicted once there are max_size of them.
+    """
+
+    def __init__(self, max_size=ENDPOINT_CACHE_SIZE, ttl=ENDPOINT_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._endpoints = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, ep):
+        """
+        Add an endpoint, replacing any endpoint with the same ID.
+        :param ep: The Endpoint.
+        """
+        with self._lock:
+            self._endpoints.pop(ep.endpoint_id, None)
+            self._endpoints[ep.endpoint_id] = (time.time() + self.ttl, ep)
+
+            # Every entry has the same TTL, so the entries are in order of
+            # expiry as well as insertion.
+            now = time.time()
+            while self._endpoints and \
+                    (len(self._endpoints) > self.max_size or
+                     self._endpoints.itervalues().next()[0] < now):
+                self._endpoints.popitem(last=False)
+
+    def get(self, ep_id):
+        """
+        :param ep_id: The endpoint ID.
+        :return: The Endpoint, or None if it is not cached or has expired.
+        """
+        with self._lock:
+            entry = self._endpoints.get(ep_id)
+            if entry is None:
+                return None
+            if entry[0] < time.time():
+                del self._endpoints[ep_id]
+                return None
+            return entry[1]
+
+    def remove(self, ep_id):
+        """
+        Remove an endpoint, if it is cached.
+        :param ep_id: The endpoint ID.
+        """
+        with self._lock:
+            self._endpoints.pop(ep_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._endpoints.clear()
+
+    def __len__(self):
+        return len(self._endpoints)
+
+endpoint_cache = EndpointCache()
+
+
+class InFlightRequests(object):
+    """
+    Runs at most one operation at a time for each key.  A caller that asks
+    for an operation that is already running waits for it, and gets its
+    result (or exception) instead of running it again.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._operations = {}
+
+    def run(self, key, function):
+        """
+        Run function, unless an operation for key is already running.
+        :param key: Identifies the operation.
+        :param function: Called with no arguments to perform the operation.
+        :return: The return value of the function.  Raises the exception it
+        raised, if any.
+        """
+        with self._lock:
+            operation = self._operations.get(key)
+            owner = operation is None
+            if owner:
+                operation = {"done": threading.Event(), "waiters": 0}
+                self._operations[key] = operation
+            else:
+                operation["waiters"] += 1
+
+        if not owner:
+            operation["done"].wait()
+        else:
+            try:
+                operation["result"] = function()
+            except BaseException:
+                operation["exc_info"] = sys.exc_info()
+            finally:
+                with self._lock:
+                    del self._operations[key]
+                operation["done"].set()
+
+        if "exc_info" in operation:
+            raise operation["exc_info"][0], operation["exc_info"][1], \
+                operation["exc_info"][2]
+        return operation["result"]
+
+    def __len__(self):
+        return len(self._operations)
+
+in_flight_creates = InFlightRequests()
+
 # Return all errors as JSON. From http://flask.pocoo.org/snippets/83/
 def make_json_app(import_name, **kwargs):
     """
@@ -63,23 +326,116 @@ def make_json_app(import_name, **kwargs):
 
     return app
 
+
+class PluginDispatcher(object):
+    """
+    A lean WSGI dispatcher for the plugin API.
+
+    libnetwork POSTs small JSON messages to a fixed set of paths.  Those
+    requests are parsed and answered here, without building Flask request
+    and response objects.  Anything else is passed on to the Flask app, so
+    unknown paths and methods get the same JSON errors as before.  Errors
+    raised by the handlers are returned the way make_json_app returns them.
+    """
+
+    def __init__(self, flask_app):
+        """
+        Constructor.  Installs the dispatcher in front of the Flask app.
+        :param flask_app: The app from make_json_app().
+        """
+        self.app = flask_app
+        self.fallback = flask_app.wsgi_app
+        self.handlers = {}
+        flask_app.wsgi_app = self
+
+    def route(self, path, parse=True):
+        """
+        Decorator to handle POSTs to a path.
+
+        The handler is called with the request's JSON, and returns the
+        response, either as an object to encode or as a string of JSON.
+        It can abort() like a Flask view.
+
+        :param path: The path.
+        :param parse: Whether to parse the request body.  If False, the
+        handler is passed None.
+        """
+        def decorator(handler):
+            self.handlers[path] = (handler, parse)
+
+            # Registered with Flask too, so other methods get a 405.
+            def view():
+                status, body = self.handle(path, request.get_data())
+                return self.app.response_class(body, status=status,
+                                               mimetype="application/json")
+            self.app.add_url_rule(path, handler.__name__, view,
+                                  methods=["POST"])
+            return handler
+        return decorator
+
+    def handle(self, path, data):
+        """
+        :param path: A path with a handler.
+        :param data: The request body.
+        :return: A tuple of (HTTP status code, response body).
+        """
+        handler, parse = self.handlers[path]
+        try:
+            json_data = None
+            if parse:
+                try:
+                    json_data = json_codec.loads(data)
+                except ValueError:
+                    # As request.get_json(force=True) does.
+                    raise BadRequest()
+            response = handler(json_data)
+            if not isinstance(response, basestring):
+                response = json_codec.dumps(response)
+            return 200, response
+        except HTTPException as e:
+            return e.code, json_codec.dumps({"message": str(e)})
+        except Exception as e:
+            # As make_json_app's handler does for routes served by Flask.
+            self.app.logger.exception("Exception on %s [POST]", path)
+            return 500, json_codec.dumps({"message": str(e)})
+
+    def __call__(self, environ, start_response):
+        path = environ.get("PATH_INFO")
+        if environ.get("REQUEST_METHOD") != "POST" or \
+                path not in self.handlers:
+            return self.fallback(environ, start_response)
+
+        length = int(environ.get("CONTENT_LENGTH") or 0)
+        data = environ["wsgi.input"].read(length) if length > 0 else ""
+        status, body = self.handle(path, data)
+        start_response("%d %s" % (status, HTTP_STATUS_CODES[status]),
+                       [("Content-Type", "application/json"),
+                        ("Content-Length", str(len(body)))])
+        return [body]
+
+
 app = make_json_app(__name__)
 app.logger.addHandler(logging.StreamHandler(sys.stdout))
 app.logger.setLevel(logging.INFO)
+plugin = PluginDispatcher(app)
 
 app.logger.info("Application started")
 
-@app.route('/Plugin.Activate', methods=['POST'])
-def activate():
-    return jsonify({"Implements": ["NetworkDriver"]})
+# The responses that never change are encoded once.
+ACTIVATE_RESPONSE = json_codec.dumps({"Implements": ["NetworkDriver"]})
+EMPTY_RESPONSE = "{}"
+OPER_INFO_RESPONSE = json_codec.dumps({"Value": {}})
+
 
+@plugin.route('/Plugin.Activate', parse=False)
+def activate(json_data):
+    return ACTIVATE_RESPONSE
 
-@app.route('/NetworkDriver.CreateNetwork', methods=['POST'])
-def create_network():
-    # force is required since the request doesn't have the correct mimetype
+
+@plugin.route('/NetworkDriver.CreateNetwork')
+def create_network(json_data):
     # If the JSON is malformed, then a BadRequest exception is raised,
     # which returns a HTTP 400 response.
-    json_data = request.get_json(force=True)
 
     # Create the "network" as a profile. The network ID is somewhat unwieldy
     # so in future we might want to obtain a human readable name for it.
@@ -87,12 +443,11 @@ def create_network():
     app.logger.info("Creating profile %s", network_id)
     client.create_profile(network_id)
 
-    return jsonify({})
+    return EMPTY_RESPONSE
 
 
-@app.route('/NetworkDriver.DeleteNetwork', methods=['POST'])
-def delete_network():
-    json_data = request.get_json(force=True)
+@plugin.route('/NetworkDriver.DeleteNetwork')
+def delete_network(json_data):
 
     # Remove the network. We don't raise an error if the profile is still
     # being used by endpoints. We assume libnetwork will enforce this.
@@ -103,15 +458,51 @@ def delete_network():
     app.logger.info("Removing profile %s", network_id)
     client.remove_profile(network_id)
 
-    return jsonify({})
+    return EMPTY_RESPONSE
 
 
-@app.route('/NetworkDriver.CreateEndpoint', methods=['POST'])
-def create_endpoint():
-    json_data = request.get_json(force=True)
+@plugin.route('/NetworkDriver.CreateEndpoint')
+def create_endpoint(json_data):
     ep_id = json_data["EndpointID"]
     net_id = json_data["NetworkID"]
 
+    # libnetwork retries a CreateEndpoint that times out.  If the endpoint
+    # has already been created, return it rather than assigning new IPs and
+    # failing to create the veth again.  Retries that arrive while the
+    # original request is still running wait for it and share its result.
+    ep = find_endpoint(ep_id)
+    if ep is not None:
+        app.logger.info("Endpoint %s already exists", ep_id)
+    else:
+        ep = in_flight_creates.run(ep_id,
+                                   lambda: add_endpoint(ep_id, net_id))
+
+    # Everything worked, create the JSON and return it to libnetwork.
+    assert len(ep.ipv4_nets) == 1
+    assert len(ep.ipv6_nets) <= 1
+    iface_json = {"ID": 0,
+                  "Address": str(list(ep.ipv4_nets)[0]),
+                  "MacAddress": ep.mac}
+
+    if ep.ipv6_nets:
+        iface_json["AddressIPv6"] = str(list(ep.ipv6_nets)[0])
+
+    return {"Interfaces": [iface_json]}
+
+
+def add_endpoint(ep_id, net_id):
+    """
+    Assign IPs to a new endpoint, create its veth and write it to the
+    datastore.  Aborts the request if this fails.
+    :param ep_id: The endpoint ID.
+    :param net_id: The network ID, which is the endpoint's profile.
+    :return: The Endpoint.
+    """
+    # A request for the same endpoint may have finished since we looked.
+    ep = endpoint_cache.get(ep_id)
+    if ep is not None:
+        return ep
+
     # Create a calico endpoint object which we can populate and return to
     # libnetwork at the end of this method.
     ep = Endpoint(hostname, "docker", CONTAINER_NAME, ep_id, "active",
@@ -123,60 +514,62 @@ def create_endpoint():
     # 2) Creating VETHs
     # 3) Writing the endpoint to the datastore.
     #
-    # A failure in a later phase attempts to roll back the effects of
-    # the earlier phases.
-
-    # First up is IP assignment. By default we assign both IPv4 and IPv6
-    # addresses.
-    # IPv4 failures may abort the request if the address couldn't be assigned.
-    ipv4_and_gateway(ep)
-    # IPv6 is currently best effort and won't abort the request.
-    ipv6_and_gateway(ep)
-
-    # Next, create the veth.
+    # Any failure rolls back the effects of the earlier phases, so that no IP
+    # is leaked and the journal record is completed.
+    #
+    # Each address is journalled as soon as it is assigned, and the veth
+    # before it is created, so that if this process dies, the effects so far
+    # can be rolled back when the plugin recovers.
+    veth_started = False
     try:
+        # First up is IP assignment. By default we assign both IPv4 and IPv6
+        # addresses.
+        # IPv4 failures may abort the request if the address couldn't be
+        # assigned.
+        ipv4_and_gateway(ep)
+        # IPv6 is currently best effort and won't abort the request.
+        ipv6_and_gateway(ep)
+
+        # Next, create the veth.
+        journal_phase(ep_id, "veth", name=ep.name)
+        veth_started = True
         create_veth(ep)
-    except CalledProcessError as e:
-        # Failed to create or configure the veth.
-        # Back out the IP assignments and the veth creation.
-        app.logger.exception(e)
-        backout_ip_assignments(ep)
-        remove_veth(ep)
-        abort(500)
 
-    # Finally, write the endpoint to the datastore.
-    try:
+        # Finally, write the endpoint to the datastore.
         client.set_endpoint(ep)
-    except DataStoreError as e:
-        # We've failed to write the endpoint to the datastore.
-        # Back out the IP assignments and the veth creation.
-        app.logger.exception(e)
+    except Exception as e:
+        exc_info = sys.exc_info()
+        if not isinstance(e, HTTPException):
+            app.logger.exception(e)
         backout_ip_assignments(ep)
-        remove_veth(ep)
-        abort(500)
-
-    # Everything worked, create the JSON and return it to libnetwork.
-    assert len(ep.ipv4_nets) == 1
-    assert len(ep.ipv6_nets) <= 1
-    iface_json = {"ID": 0,
-                  "Address": str(list(ep.ipv4_nets)[0]),
-                  "MacAddress": ep.mac}
-
-    if ep.ipv6_nets:
-        iface_json["AddressIPv6"] = str(list(ep.ipv6_nets)[0])
-
-    return jsonify({"Interfaces": [iface_json]})
-
-
-@app.route('/NetworkDriver.DeleteEndpoint', methods=['POST'])
-def delete_endpoint():
-    json_data = request.get_json(force=True)
+        if veth_started:
+            remove_veth(ep)
+        journal_complete(ep_id)
+        if isinstance(e, (CalledProcessError, DataStoreError)):
+            # Failed to create or configure the veth, or to write the
+            # endpoint to the datastore.
+            abort(500)
+        raise exc_info[0], exc_info[1], exc_info[2]
+    journal_complete(ep_id)
+
+    # Remember the endpoint for Join, DeleteEndpoint and retries.
+    endpoint_cache.add(ep)
+    return ep
+
+
+@plugin.route('/NetworkDriver.DeleteEndpoint')
+def delete_endpoint(json_data):
     ep_id = json_data["EndpointID"]
     app.logger.info("Removing endpoint %s", ep_id)
 
     # Remove the endpoint from the datastore, the IPs that were assigned to
     # it and the veth. Even if one fails, try to do the others.
+    #
+    # The endpoint is always read from the datastore rather than the cache:
+    # it may have been removed by another process (for example by
+    # "calicoctl node drain") since it was cached, and its IPs reassigned.
     ep = None
+    endpoint_cache.remove(ep_id)
     try:
         ep = client.get_endpoint(hostname=hostname,
                                  orchestrator_id="docker",
@@ -200,29 +593,39 @@ def delete_endpoint():
     if ep:
         remove_veth(ep)
 
-    return jsonify({})
+    return EMPTY_RESPONSE
+
+
+@plugin.route('/Calico.Drain', parse=False)
+def drain(json_data):
+    """
+    Admin route to remove all the docker endpoints on this host at once,
+    for example before the host is taken out of service.
+    """
+    app.logger.info("Draining endpoints from %s", hostname)
+    endpoints = drain_host(client, hostname)
+    for ep in endpoints:
+        endpoint_cache.remove(ep.endpoint_id)
+    app.logger.info("Drained %d endpoints", len(endpoints))
+
+    return {"EndpointIDs": [ep.endpoint_id for ep in endpoints]}
 
 
-@app.route('/NetworkDriver.EndpointOperInfo', methods=['POST'])
-def endpoint_oper_info():
-    json_data = request.get_json(force=True)
+@plugin.route('/NetworkDriver.EndpointOperInfo')
+def endpoint_oper_info(json_data):
     ep_id = json_data["EndpointID"]
     app.logger.info("Endpoint operation info requested for %s", ep_id)
 
     # Nothing is supported yet, just pass blank data.
-    return jsonify({"Value": {}})
+    return OPER_INFO_RESPONSE
 
 
-@app.route('/NetworkDriver.Join', methods=['POST'])
-def join():
-    json_data = request.get_json(force=True)
+@plugin.route('/NetworkDriver.Join')
+def join(json_data):
     ep_id = json_data["EndpointID"]
     app.logger.info("Joining endpoint %s", ep_id)
 
-    ep = client.get_endpoint(hostname=hostname,
-                             orchestrator_id="docker",
-                             workload_id=CONTAINER_NAME,
-                             endpoint_id=ep_id)
+    ep = get_endpoint(ep_id)
     ret_json = {
         "InterfaceNames": [{
             "SrcName": ep.temp_interface_name(),
@@ -245,18 +648,45 @@ def join():
             "InterfaceID": 0  # 1st interface created in EndpointCreate
             })
 
-    return jsonify(ret_json)
+    return ret_json
 
 
-@app.route('/NetworkDriver.Leave', methods=['POST'])
-def leave():
-    json_data = request.get_json(force=True)
+@plugin.route('/NetworkDriver.Leave')
+def leave(json_data):
     ep_id = json_data["EndpointID"]
     app.logger.info("Leaving endpoint %s", ep_id)
 
     # Noop. There's nothing to do.
 
-    return jsonify({})
+    return EMPTY_RESPONSE
+
+
+def get_endpoint(ep_id):
+    """
+    Get an endpoint on this host, from the cache of endpoints created by this
+    process if possible, otherwise from the datastore.
+    :param ep_id: The endpoint ID.
+    :return: The Endpoint.  Raises KeyError if it doesn't exist.
+    """
+    ep = endpoint_cache.get(ep_id)
+    if ep is None:
+        ep = client.get_endpoint(hostname=hostname,
+                                 orchestrator_id="docker",
+                                 workload_id=CONTAINER_NAME,
+                                 endpoint_id=ep_id)
+    return ep
+
+
+def find_endpoint(ep_id):
+    """
+    Get an endpoint on this host if it exists.
+    :param ep_id: The endpoint ID.
+    :return: The Endpoint, or None if it doesn't exist.
+    """
+    try:
+        return get_endpoint(ep_id)
+    except KeyError:
+        return None
 
 
 def assign_ip(version):
@@ -270,35 +700,64 @@ def assign_ip(version):
 
     assert version in ["v4", "v6"]
     # For each configured pool, attempt to assign an IP before giving up.
-    for pool in client.get_ip_pools(version):
-        assigner = SequentialAssignment()
-        ip = assigner.allocate(pool)
+    assigner = assigner_class()
+    for pool in get_ip_pools(version):
+        try:
+            ip = assigner.allocate(pool)
+        except AllocationRetriesExceeded as e:
+            # This pool is heavily contended.  Try the next one rather than
+            # adding to the load on this one.
+            app.logger.warning(e.message)
+            ip = None
+            continue
         if ip is not None:
             ip = IPAddress(ip)
             break
+
+    if assigner.collisions:
+        app.logger.info("IP%s assignment collided %d times in %d attempts, "
+                        "waited %.3fs", version, assigner.collisions,
+                        assigner.attempts, assigner.wait_time)
     return ip
 
 
+def get_ip_pools(version):
+    """
+    Get the configured pools, from the inventory if it has a snapshot.
+    :param version: "v4" for IPv4, "v6" for IPv6.
+    :return: A list of IPPools.
+    """
+    if inventory is not None and inventory.has_snapshot():
+        return inventory.ip_pools(version)
+    return client.get_ip_pools(version)
+
+
+def get_default_next_hops():
+    """
+    Get the next hops for default routes on this host, from the inventory if
+    it has a snapshot.
+    :return: Dict of {ip_version: IPAddress}.  Raises KeyError if the host's
+    BIRD configuration has not been set.
+    """
+    if inventory is not None and inventory.has_snapshot():
+        return inventory.next_hops()
+    return client.get_default_next_hops(hostname)
+
+
 def unassign_ip(ip):
     """
     Unassign a IP address from the configured pools.
     :param ip: IPAddress to unassign.
     :return: True if the unassignment succeeded. False otherwise.
     """
-    # For each configured pool, attempt to unassign the IP before giving up.
-    version = "v%d" % ip.version
-    for pool in client.get_ip_pools(version):
-        if ip in pool:
-            if client.unassign_address(pool, ip):
-                return True
-    return False
+    return client.release_address(ip)
 
 
 def ipv4_and_gateway(ep):
     # Get the gateway before trying to assign an address. This will avoid
     # needing to backout the assignment if fetching the gateway fails.
     try:
-        next_hop = client.get_default_next_hops(hostname)[4]
+        next_hop = get_default_next_hops()[4]
     except KeyError as e:
         app.logger.exception(e)
         abort(500)
@@ -311,6 +770,7 @@ def ipv4_and_gateway(ep):
                          ep.endpoint_id)
         abort(500)
 
+    journal_phase(ep.endpoint_id, "ips", ips=[str(ip)])
     ip = IPNetwork(ip)
     ep.ipv4_nets.add(ip)
     ep.ipv4_gateway = next_hop
@@ -318,7 +778,7 @@ def ipv4_and_gateway(ep):
 
 def ipv6_and_gateway(ep):
     try:
-        next_hop6 = client.get_default_next_hops(hostname)[6]
+        next_hop6 = get_default_next_hops()[6]
     except KeyError:
         app.logger.info("Couldn't find IPv6 gateway for endpoint %s. "
                         "Skipping IPv6 assignment.",
@@ -326,6 +786,7 @@ def ipv6_and_gateway(ep):
     else:
         ip6 = assign_ip("v6")
         if ip6:
+            journal_phase(ep.endpoint_id, "ips", ips=[str(ip6)])
             ip6 = IPNetwork(ip6)
             ep.ipv6_gateway = next_hop6
             ep.ipv6_nets.add(ip6)
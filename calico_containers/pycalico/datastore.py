@@ -14,15 +14,19 @@
 
 import json
 import os
+import re
+import time
 import etcd
-from etcd import EtcdKeyNotFound, EtcdException
+from etcd import EtcdKeyNotFound, EtcdException, EtcdCompareFailed, \
+    EtcdAlreadyExist
 
 from netaddr import IPNetwork, IPAddress, AddrFormatError
 
 from pycalico.datastore_datatypes import Rules, BGPPeer, IPPool, \
-    Endpoint, Profile, Rule
+    IPPoolIndex, Endpoint, Profile, Rule, TagIndex
 from pycalico.datastore_errors import DataStoreError, \
-    ProfileNotInEndpoint, ProfileAlreadyInEndpoint, MultipleEndpointsMatch
+    ProfileNotInEndpoint, ProfileAlreadyInEndpoint, MultipleEndpointsMatch, \
+    ProfileRulesConflict
 
 ETCD_AUTHORITY_DEFAULT = "127.0.0.1:4001"
 ETCD_AUTHORITY_ENV = "ETCD_AUTHORITY"
@@ -56,9 +60,25 @@ prefix that appears in all Calico interface names in the root namespace. e.g.
 cali123456789ab.
 """
 
+LIBNETWORK_ORCHESTRATOR_ID = "docker"
+LIBNETWORK_WORKLOAD_ID = "libnetwork"
+"""The orchestrator and workload IDs of every endpoint created by the
+libnetwork plugin.  get_endpoint() tries these first when it is only given
+the hostname and endpoint ID."""
+
 # The default node AS number
 DEFAULT_AS_NUM = 64511
 
+# How many times to re-read and re-apply a change to a profile's rules when it
+# conflicts with a concurrent update.
+PROFILE_UPDATE_ATTEMPTS = 5
+
+POOL_INDEX_TTL = 5
+"""
+How long (seconds) a cached IPPoolIndex is used before the pools are re-read.
+Changes made through this client invalidate the cache immediately.
+"""
+
 
 def handle_errors(fn):
     """
@@ -77,6 +97,45 @@ def handle_errors(fn):
     return wrapped
 
 
+PROFILE_IDS_MATCH = re.compile(r'"profile_ids":\s*(\[[^\]]*\])')
+"""Finds the profile_ids list in endpoint JSON without decoding the rest."""
+
+
+def _profile_ids_from_json(json_str):
+    """
+    Get the profile IDs from an endpoint's JSON.
+
+    :param json_str: The endpoint JSON.
+    :return: A set of profile IDs.
+    """
+    match = PROFILE_IDS_MATCH.search(json_str)
+    if match:
+        try:
+            return set(json.loads(match.group(1)))
+        except ValueError:
+            # A profile ID contains "]", so decode the whole endpoint.
+            pass
+    return set(json.loads(json_str).get("profile_ids", []))
+
+
+def _load_profile_value(profile, key, value):
+    """
+    Set the tags or rules on a Profile from the value of one of the
+    profile's keys in the data store.
+
+    :param profile: The Profile to update.
+    :param key: The last component of the key, "tags" or "rules".  Other keys
+    are ignored.
+    :param value: The value of the key.
+    :return: None.
+    """
+    if key == "tags":
+        profile.tags = set(json.loads(value))
+    elif key == "rules":
+        profile.rules = Rules.from_json(value)
+        profile._original_rules_json = value
+
+
 class DatastoreClient(object):
     """
     An datastore client that exposes high level Calico operations needed by the
@@ -88,6 +147,10 @@ class DatastoreClient(object):
         (host, port) = etcd_authority.split(":", 1)
         self.etcd_client = etcd.Client(host=host, port=int(port))
 
+        # Cached IPPoolIndex objects, keyed on IP version.  Each value is a
+        # tuple of (expiry time, index).
+        self._pool_indexes = {}
+
     @handle_errors
     def ensure_global_config(self):
         """
@@ -200,6 +263,47 @@ class DatastoreClient(object):
 
         return pools
 
+    @handle_errors
+    def get_ip_pool_index(self, version):
+        """
+        Get an index of the configured IP pools.  The index is cached for
+        POOL_INDEX_TTL seconds, or until the pools are changed through this
+        client.
+
+        :param version: "v4" for IPv4, "v6" for IPv6
+        :return: An IPPoolIndex.
+        """
+        assert version in ("v4", "v6")
+        now = time.time()
+        cached = self._pool_indexes.get(version)
+        if cached is not None and cached[0] > now:
+            return cached[1]
+
+        index = IPPoolIndex(self.get_ip_pools(version))
+        self._pool_indexes[version] = (now + POOL_INDEX_TTL, index)
+        return index
+
+    def find_pool(self, ip):
+        """
+        Find the configured pool containing an IP address.  If pools are
+        nested, the most specific pool is returned.
+
+        :param ip: The IPAddress to look up.
+        :return: The IPPool containing the address, or None if the address
+        is not in any configured pool.
+        """
+        return self.get_ip_pool_index("v%d" % ip.version).find(ip)
+
+    def find_pools(self, ip):
+        """
+        Find every configured pool containing an IP address.
+
+        :param ip: The IPAddress to look up.
+        :return: A list of the IPPools containing the address, from the most
+        specific to the least.
+        """
+        return self.get_ip_pool_index("v%d" % ip.version).find_all(ip)
+
     @handle_errors
     def get_ip_pool_config(self, version, cidr):
         """
@@ -243,6 +347,7 @@ class DatastoreClient(object):
         key = IP_POOL_KEY % {"version": version,
                              "pool": str(pool.cidr).replace("/", "-")}
         self.etcd_client.write(key, pool.to_json())
+        self._pool_indexes.pop(version, None)
 
     @handle_errors
     def remove_ip_pool(self, version, cidr):
@@ -262,6 +367,7 @@ class DatastoreClient(object):
 
         key = IP_POOL_KEY % {"version": version,
                              "pool": str(cidr).replace("/", "-")}
+        self._pool_indexes.pop(version, None)
         try:
             self.etcd_client.delete(key)
         except EtcdKeyNotFound:
@@ -412,13 +518,13 @@ class DatastoreClient(object):
     @handle_errors
     def get_profile_names(self):
         """
-        Get the all configured profiles.
+        Get the all configured profiles.  Only the profile keys are read, not
+        the tags and rules of each profile.
         :return: a set of profile names
         """
         profiles = set()
         try:
-            etcd_profiles = self.etcd_client.read(PROFILES_PATH,
-                                                  recursive=True).children
+            etcd_profiles = self.etcd_client.read(PROFILES_PATH).children
             for child in etcd_profiles:
                 packed = child.key.split("/")
                 if len(packed) > 5:
@@ -440,28 +546,56 @@ class DatastoreClient(object):
         """
         profile_path = PROFILE_PATH % {"profile_id": name}
         try:
-            _ = self.etcd_client.read(profile_path)
-            profile = Profile(name)
+            result = self.etcd_client.read(profile_path, recursive=True)
         except EtcdKeyNotFound:
             raise KeyError("%s is not a configured profile." % name)
 
-        tags_path = TAGS_PATH % {"profile_id": name}
-        try:
-            tags_result = self.etcd_client.read(tags_path)
-            tags = json.loads(tags_result.value)
-            profile.tags = set(tags)
-        except EtcdKeyNotFound:
-            pass
+        profile = Profile(name)
+        for child in result.children:
+            _load_profile_value(profile, child.key[len(profile_path):],
+                                child.value)
+        return profile
+
+    @handle_errors
+    def get_profiles(self, names=None):
+        """
+        Get Profile objects for several profiles with a single read of the
+        data store.
 
-        rules_path = RULES_PATH % {"profile_id": name}
+        :param names: An iterable of profile names, or None to get every
+        profile.
+        :return: A dict of profile name to Profile object.  Profiles that do
+        not exist are not included.
+        """
+        wanted = None if names is None else set(names)
         try:
-            rules_result = self.etcd_client.read(rules_path)
-            rules = Rules.from_json(rules_result.value)
-            profile.rules = rules
+            etcd_profiles = self.etcd_client.read(PROFILES_PATH,
+                                                  recursive=True).children
         except EtcdKeyNotFound:
-            pass
+            return {}
+
+        profiles = {}
+        for child in etcd_profiles:
+            packed = child.key.split("/")
+            if len(packed) < 6:
+                continue
+            name = packed[5]
+            if wanted is not None and name not in wanted:
+                continue
+            if name not in profiles:
+                profiles[name] = Profile(name)
+            if len(packed) > 6:
+                _load_profile_value(profiles[name], packed[6], child.value)
+        return profiles
 
-        return profile
+    def get_tag_index(self):
+        """
+        Get an index of which profiles carry each tag, and which profile
+        rules refer to each tag, from a single read of every profile.
+
+        :return: A TagIndex.
+        """
+        return TagIndex(self.get_profiles().values())
 
     @handle_errors
     def get_profile_members(self, profile_name):
@@ -474,6 +608,37 @@ class DatastoreClient(object):
         return [endpoint for endpoint in self.get_endpoints()
                 if profile_name in endpoint.profile_ids]
 
+    @handle_errors
+    def get_profile_member_counts(self):
+        """
+        Count the endpoints, and the hosts with endpoints, that are members of
+        each profile.
+
+        This reads every endpoint but only extracts its profile IDs, so it is
+        much cheaper than building the Endpoint objects.
+
+        :return: A dict of profile name to a tuple of (number of endpoints,
+        number of hosts).  Profiles with no members are not included.
+        """
+        try:
+            leaves = self.etcd_client.read(HOSTS_PATH, recursive=True).leaves
+        except EtcdKeyNotFound:
+            return {}
+
+        endpoints = {}
+        hosts = {}
+        for leaf in leaves:
+            match = Endpoint.ENDPOINT_KEY_MATCH.match(leaf.key)
+            if not match:
+                continue
+            hostname = match.group("hostname")
+            for profile_id in _profile_ids_from_json(leaf.value):
+                endpoints[profile_id] = endpoints.get(profile_id, 0) + 1
+                hosts.setdefault(profile_id, set()).add(hostname)
+
+        return dict((name, (count, len(hosts[name])))
+                    for name, count in endpoints.iteritems())
+
     @handle_errors
     def profile_update_tags(self, profile):
         """
@@ -486,15 +651,64 @@ class DatastoreClient(object):
         self.etcd_client.write(tags_path, json.dumps(list(profile.tags)))
 
     @handle_errors
-    def profile_update_rules(self, profile):
+    def profile_update_rules(self, profile, atomic=False):
         """
         Write the rules on the Profile to the data store.  This creates the
-        profile if it doesn't exist and is idempotent.
+        profile if it doesn't exist.
+
+        By default the rules are overwritten.  If atomic is True, the write
+        only succeeds if the rules have not been changed since the Profile
+        was read from the datastore, or, if the Profile had no rules when
+        read (or wasn't read), if no rules have been written since.  Raises
+        ProfileRulesConflict otherwise.
+
         :param profile: The Profile object to update, with rules stored on it.
+        :param atomic: Whether to fail rather than overwrite rules written
+        by another client.
         :return: None
         """
         rules_path = RULES_PATH % {"profile_id": profile.name}
-        self.etcd_client.write(rules_path, profile.rules.to_json())
+        new_json = profile.rules.to_json()
+        try:
+            if not atomic:
+                self.etcd_client.write(rules_path, new_json)
+            elif profile._original_rules_json is None:
+                self.etcd_client.write(rules_path, new_json, prevExist=False)
+            else:
+                self.etcd_client.write(
+                    rules_path, new_json,
+                    prevValue=profile._original_rules_json)
+        except (EtcdCompareFailed, EtcdAlreadyExist):
+            raise ProfileRulesConflict(profile.name)
+        profile._original_rules_json = new_json
+
+    def modify_profile_rules(self, name, modify,
+                             attempts=PROFILE_UPDATE_ATTEMPTS):
+        """
+        Atomically read, modify and write the rules on a profile, retrying if
+        the rules are changed concurrently by another client.
+
+        Raises KeyError if the profile does not exist, and
+        ProfileRulesConflict if every attempt conflicted.
+
+        :param name: The name of the profile.
+        :param modify: A function taking the profile's Rules, which it
+        modifies in place.  It may be called once per attempt, each time with
+        freshly read rules.  Its return value is returned from this method.
+        :param attempts: The maximum number of attempts.
+        :return: A tuple of (the return value from modify, the number of
+        attempts made).
+        """
+        for attempt in range(1, attempts + 1):
+            profile = self.get_profile(name)
+            result = modify(profile.rules)
+            try:
+                self.profile_update_rules(profile, atomic=True)
+            except ProfileRulesConflict:
+                if attempt == attempts:
+                    raise
+            else:
+                return result, attempt
 
     @handle_errors
     def append_profiles_to_endpoint(self, profile_names, **kwargs):
@@ -624,17 +838,36 @@ class DatastoreClient(object):
     def get_endpoint(self, hostname=None, orchestrator_id=None,
                      workload_id=None, endpoint_id=None):
         """
-        Calls through to get_endpoints to find an endpoint matching the
-        passed-in criteria.
+        Find an endpoint matching the passed-in criteria.
         Raises a MultipleEndpointsMatch exception if more than one endpoint
         matches.
 
+        If every ID is given, the endpoint is read directly from its key.  If
+        only the hostname and endpoint ID are given, the endpoint is first
+        read from the key it would have if it were created by the libnetwork
+        plugin.  Otherwise, this calls through to get_endpoints.
+
         :param hostname: The hostname that the endpoint lives on.
         :param orchestrator_id: The workload that the endpoint belongs to.
         :param workload_id: The workload that the endpoint belongs to.
         :param endpoint_id: The ID of the endpoint
         :return: An Endpoint Object
         """
+        if hostname and endpoint_id:
+            if orchestrator_id and workload_id:
+                return self._read_endpoint(hostname, orchestrator_id,
+                                           workload_id, endpoint_id)
+            if orchestrator_id in (None, LIBNETWORK_ORCHESTRATOR_ID) and \
+                    workload_id in (None, LIBNETWORK_WORKLOAD_ID):
+                try:
+                    return self._read_endpoint(hostname,
+                                               LIBNETWORK_ORCHESTRATOR_ID,
+                                               LIBNETWORK_WORKLOAD_ID,
+                                               endpoint_id)
+                except KeyError:
+                    # Not a libnetwork endpoint, so search for it.
+                    pass
+
         eps = self.get_endpoints(hostname=hostname,
                                  orchestrator_id=orchestrator_id,
                                  workload_id=workload_id,
@@ -651,6 +884,26 @@ class DatastoreClient(object):
         else:
             return eps.pop()
 
+    def _read_endpoint(self, hostname, orchestrator_id, workload_id,
+                       endpoint_id):
+        """
+        Read a single endpoint from its key.  Raises KeyError if it doesn't
+        exist.
+
+        :return: An Endpoint object.
+        """
+        ep_path = ENDPOINT_PATH % {"hostname": hostname,
+                                   "orchestrator_id": orchestrator_id,
+                                   "workload_id": workload_id,
+                                   "endpoint_id": endpoint_id}
+        try:
+            result = self.etcd_client.read(ep_path)
+        except EtcdKeyNotFound:
+            raise KeyError("No endpoint found at %s" % ep_path)
+        return Endpoint.from_ids_and_json(hostname, orchestrator_id,
+                                          workload_id, endpoint_id,
+                                          result.value)
+
     @handle_errors
     def set_endpoint(self, endpoint):
         """
@@ -746,6 +999,46 @@ class DatastoreClient(object):
         except EtcdKeyNotFound:
             pass
 
+    @handle_errors
+    def dump_data(self, output, path="/calico"):
+        """
+        Write every key under a path to a file, as one JSON object per line
+        with the key, value, modifiedIndex and ttl.
+
+        The tree is read a directory at a time, rather than with one
+        recursive read, so only one directory's keys are held in memory at
+        once.  A directory deleted while the tree is being read is skipped.
+
+        :param output: The file to write to.
+        :param path: The directory or key to dump.
+        :return: The number of keys written.
+        """
+        count = 0
+        directories = [path]
+        while directories:
+            directory = directories.pop()
+            try:
+                result = self.etcd_client.read(directory)
+            except EtcdKeyNotFound:
+                continue
+
+            subdirectories = []
+            for node in result.leaves:
+                if node.dir:
+                    # An empty directory is returned as its own leaf.
+                    if node.key != result.key:
+                        subdirectories.append(node.key)
+                    continue
+                output.write(json.dumps({"key": node.key,
+                                         "value": node.value,
+                                         "modifiedIndex": node.modifiedIndex,
+                                         "ttl": node.ttl},
+                                        sort_keys=True) + "\n")
+                count += 1
+            # Visit the subdirectories in order.
+            directories.extend(sorted(subdirectories, reverse=True))
+        return count
+
     @handle_errors
     def remove_workload(self, hostname, orchestrator_id, workload_id):
         """
@@ -12,25 +12,39 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from bisect import bisect_right
 from collections import namedtuple
 import copy
+import itertools
 import json
 import re
 
-from netaddr import IPAddress, IPNetwork
+from netaddr import IPAddress, IPNetwork, cidr_merge
 
 VETH_NAME = "eth1"
 """The name to give to the veth in the target container's namespace. Default
 to eth1 because eth0 could be in use"""
 
+MAX_PORTS_PER_RULE = 15
+"""The most port entries Rules.optimize() will put in a single rule when
+combining rules.  This is the iptables multiport match limit."""
+
 # The various datatype classes used by datastore.py are collected here.
 
 class Rules(namedtuple("Rules", ["id", "inbound_rules", "outbound_rules"])):
     """
     A set of Calico rules describing inbound and outbound network traffic
     policy.
+
+    The inbound and outbound rules are held as RuleLists, so that checking
+    whether a rule is present does not compare it against every rule.
     """
 
+    def __new__(cls, id, inbound_rules, outbound_rules):
+        return super(Rules, cls).__new__(cls, id,
+                                         RuleList(inbound_rules),
+                                         RuleList(outbound_rules))
+
     def to_json(self, indent=None):
         """
         Convert the Rules object to a JSON string.
@@ -40,12 +54,21 @@ class Rules(namedtuple("Rules", ["id", "inbound_rules", "outbound_rules"])):
         using 1 for human-readable strings.
         :return:  A JSON string representation of this object.
         """
+        return json.dumps(self.to_json_dict(), indent=indent)
+
+    def to_json_dict(self):
+        """
+        Convert the Rules object to a dict that can be directly converted to
+        JSON.
+
+        :return: A dict containing valid JSON types.
+        """
         json_dict = self._asdict()
         rules = json_dict["inbound_rules"]
         json_dict["inbound_rules"] = [rule.to_json_dict() for rule in rules]
         rules = json_dict["outbound_rules"]
         json_dict["outbound_rules"] = [rule.to_json_dict() for rule in rules]
-        return json.dumps(json_dict, indent=indent)
+        return json_dict
 
     @classmethod
     def from_json(cls, json_str):
@@ -55,7 +78,16 @@ class Rules(namedtuple("Rules", ["id", "inbound_rules", "outbound_rules"])):
         :param json_str: A JSON string representation of a Rules object.
         :return: A Rules object.
         """
-        json_dict = json.loads(json_str)
+        return cls.from_json_dict(json.loads(json_str))
+
+    @classmethod
+    def from_json_dict(cls, json_dict):
+        """
+        Create a Rules object from a dict decoded from JSON.
+
+        :param json_dict: A dict representation of a Rules object.
+        :return: A Rules object.
+        """
         inbound_rules = []
         for rule in json_dict["inbound_rules"]:
             inbound_rules.append(Rule(**rule))
@@ -67,6 +99,176 @@ class Rules(namedtuple("Rules", ["id", "inbound_rules", "outbound_rules"])):
                     outbound_rules=outbound_rules)
         return rules
 
+    def optimize(self):
+        """
+        Compile the rules into an equivalent, smaller set of rules.
+
+        Rules are matched in order and the first match wins, so the following
+        rewrites do not change which traffic is allowed or denied:
+          -  rules that can never match because every packet they match is
+             matched by an earlier rule are dropped
+          -  port lists are coalesced into ranges
+          -  consecutive rules with the same action that differ only in a
+             source or destination CIDR are replaced by the merged CIDRs
+          -  consecutive rules with the same action that differ only in a
+             source or destination port list are combined.
+
+        :return: A new Rules object with the optimized inbound and outbound
+        rules.
+        """
+        return Rules(id=self.id,
+                     inbound_rules=_optimize_rules(self.inbound_rules),
+                     outbound_rules=_optimize_rules(self.outbound_rules))
+
+
+class RuleList(list):
+    """
+    An ordered list of Rules that keeps an index of the canonical form of
+    each rule (see Rule.canonical()).  Membership tests are constant time and
+    finding a rule's position only scans the list once after each change.
+
+    The index is kept up to date by the list's own methods.  Rules must not
+    be modified in place while they are in the list.
+    """
+
+    def __init__(self, rules=()):
+        super(RuleList, self).__init__(rules)
+        self._reindex()
+
+    def __reduce__(self):
+        # Rebuild the index when copied or pickled, rather than restoring it
+        # and then re-adding every rule to it.
+        return RuleList, (list(self),)
+
+    def _reindex(self):
+        self._counts = {}
+        self._positions = None
+        for rule in self:
+            self._add_key(rule)
+
+    @staticmethod
+    def _key(rule):
+        return rule.canonical() if isinstance(rule, Rule) else None
+
+    def _add_key(self, rule):
+        key = self._key(rule)
+        self._counts[key] = self._counts.get(key, 0) + 1
+        self._positions = None
+
+    def _remove_key(self, rule):
+        key = self._key(rule)
+        count = self._counts[key] - 1
+        if count:
+            self._counts[key] = count
+        else:
+            del self._counts[key]
+        self._positions = None
+
+    def __contains__(self, rule):
+        if not isinstance(rule, Rule):
+            return super(RuleList, self).__contains__(rule)
+        return rule.canonical() in self._counts
+
+    def index(self, rule, *args):
+        """
+        Return the position of the first occurrence of a rule.  Raises
+        ValueError if the rule is not present.
+        """
+        if args or not isinstance(rule, Rule):
+            return super(RuleList, self).index(rule, *args)
+        if self._positions is None:
+            self._positions = {}
+            for position, existing in enumerate(self):
+                self._positions.setdefault(self._key(existing), position)
+        try:
+            return self._positions[rule.canonical()]
+        except KeyError:
+            raise ValueError("Rule is not in list")
+
+    def count(self, rule):
+        if not isinstance(rule, Rule):
+            return super(RuleList, self).count(rule)
+        return self._counts.get(rule.canonical(), 0)
+
+    def dedupe(self):
+        """
+        Remove all but the first occurrence of each rule, preserving order.
+
+        :return: The number of rules removed.
+        """
+        seen = set()
+        unique = []
+        for rule in self:
+            key = self._key(rule)
+            if key is None or key not in seen:
+                seen.add(key)
+                unique.append(rule)
+        removed = len(self) - len(unique)
+        if removed:
+            self[:] = unique
+        return removed
+
+    def append(self, rule):
+        super(RuleList, self).append(rule)
+        self._add_key(rule)
+
+    def insert(self, position, rule):
+        super(RuleList, self).insert(position, rule)
+        self._add_key(rule)
+
+    def extend(self, rules):
+        rules = list(rules)
+        super(RuleList, self).extend(rules)
+        for rule in rules:
+            self._add_key(rule)
+
+    def __iadd__(self, rules):
+        self.extend(rules)
+        return self
+
+    def remove(self, rule):
+        del self[self.index(rule)]
+
+    def pop(self, *args):
+        rule = super(RuleList, self).pop(*args)
+        self._remove_key(rule)
+        return rule
+
+    def __setitem__(self, index, value):
+        if isinstance(index, slice):
+            super(RuleList, self).__setitem__(index, value)
+            self._reindex()
+        else:
+            old = self[index]
+            super(RuleList, self).__setitem__(index, value)
+            self._remove_key(old)
+            self._add_key(value)
+
+    def __delitem__(self, index):
+        if isinstance(index, slice):
+            super(RuleList, self).__delitem__(index)
+            self._reindex()
+        else:
+            old = self[index]
+            super(RuleList, self).__delitem__(index)
+            self._remove_key(old)
+
+    # Python 2 lists implement simple slices with these methods, bypassing
+    # __setitem__ and __delitem__.
+    def __setslice__(self, i, j, rules):
+        self.__setitem__(slice(max(i, 0), max(j, 0)), list(rules))
+
+    def __delslice__(self, i, j):
+        self.__delitem__(slice(max(i, 0), max(j, 0)))
+
+    def sort(self, *args, **kwargs):
+        super(RuleList, self).sort(*args, **kwargs)
+        self._positions = None
+
+    def reverse(self):
+        super(RuleList, self).reverse()
+        self._positions = None
+
 
 class BGPPeer(object):
     """
@@ -169,6 +371,142 @@ class IPPool(object):
         return str(self.cidr)
 
 
+class IPPoolIndex(object):
+    """
+    An index of IPPools for quickly finding the pool containing an address.
+
+    The pools are held as integer ranges sorted by start address, so a lookup
+    is a binary search rather than a containment test against every pool.
+    Pools are CIDRs, so any two are either disjoint or nested; each range
+    records the range that encloses it, and a lookup that lands on a nested
+    range that ends too early walks out to the enclosing ranges.
+    """
+
+    def __init__(self, pools):
+        """
+        Constructor.
+        :param pools: An iterable of IPPool objects, all of the same IP
+        version.
+        """
+        # Sort by start address, and for equal starts put the larger range
+        # first so that it encloses the smaller one.
+        ordered = sorted(pools, key=lambda pool: (pool.cidr.first,
+                                                  -pool.cidr.last))
+        self._pools = ordered
+        self._starts = [pool.cidr.first for pool in ordered]
+        self._ends = [pool.cidr.last for pool in ordered]
+
+        # Find the index of the enclosing range of each range, or -1.
+        self._parents = []
+        stack = []
+        for index, pool in enumerate(ordered):
+            while stack and self._ends[stack[-1]] < pool.cidr.first:
+                stack.pop()
+            self._parents.append(stack[-1] if stack else -1)
+            stack.append(index)
+
+    def find(self, ip):
+        """
+        Find the most specific pool containing an address.
+
+        :param ip: The IPAddress (or address string) to look up.
+        :return: The IPPool containing the address, or None.
+        """
+        value = int(IPAddress(ip))
+        index = bisect_right(self._starts, value) - 1
+        while index >= 0 and self._ends[index] < value:
+            index = self._parents[index]
+        if index < 0:
+            return None
+        return self._pools[index]
+
+    def find_all(self, ip):
+        """
+        Find every pool containing an address.
+
+        :param ip: The IPAddress (or address string) to look up.
+        :return: A list of the IPPools containing the address, from the most
+        specific to the least.
+        """
+        value = int(IPAddress(ip))
+        index = bisect_right(self._starts, value) - 1
+        pools = []
+        # Every pool containing the address encloses the range found, so is
+        # one of its enclosing ranges.
+        while index >= 0:
+            if self._ends[index] >= value:
+                pools.append(self._pools[index])
+            index = self._parents[index]
+        return pools
+
+    def __len__(self):
+        return len(self._pools)
+
+    def __iter__(self):
+        return iter(self._pools)
+
+
+TagReference = namedtuple("TagReference", ["profile", "direction",
+                                           "position", "rule"])
+"""A rule that refers to a tag: the name of the profile, "inbound" or
+"outbound", the 1-based position of the rule and the Rule itself."""
+
+
+class TagIndex(object):
+    """
+    An index from tags to the profiles that carry them, and to the profile
+    rules that refer to them as a src_tag or dst_tag.
+    """
+
+    def __init__(self, profiles):
+        """
+        Constructor.
+        :param profiles: An iterable of Profile objects.
+        """
+        self._tagged = {}
+        self._references = {}
+        for profile in sorted(profiles, key=lambda profile: profile.name):
+            for tag in profile.tags:
+                self._tagged.setdefault(tag, []).append(profile.name)
+            for direction, rules in (
+                    ("inbound", profile.rules.inbound_rules),
+                    ("outbound", profile.rules.outbound_rules)):
+                for position, rule in enumerate(rules, start=1):
+                    reference = TagReference(profile.name, direction,
+                                             position, rule)
+                    tags = set((rule.get("src_tag"), rule.get("dst_tag")))
+                    tags.discard(None)
+                    for tag in tags:
+                        self._references.setdefault(tag, []).append(
+                            reference)
+
+    def profiles_with_tag(self, tag):
+        """
+        Get the profiles that carry a tag.
+
+        :param tag: The tag.
+        :return: A sorted list of profile names.
+        """
+        return list(self._tagged.get(tag, []))
+
+    def rules_referencing(self, tag):
+        """
+        Get the rules that refer to a tag.
+
+        :param tag: The tag.
+        :return: A list of TagReferences, ordered by profile name, direction
+        and position.
+        """
+        return list(self._references.get(tag, []))
+
+    def tags(self):
+        """
+        :return: The set of tags that are carried by, or referred to by, any
+        profile.
+        """
+        return set(self._tagged) | set(self._references)
+
+
 class Endpoint(object):
     """
     Class encapsulating an Endpoint.
@@ -228,11 +566,26 @@ class Endpoint(object):
         if not match:
             return None
 
-        hostname = match.group("hostname")
-        orchestrator_id = match.group("orchestrator_id")
-        workload_id = match.group("workload_id")
-        endpoint_id = match.group("endpoint_id")
+        return cls.from_ids_and_json(match.group("hostname"),
+                                     match.group("orchestrator_id"),
+                                     match.group("workload_id"),
+                                     match.group("endpoint_id"),
+                                     json_str)
 
+    @classmethod
+    def from_ids_and_json(cls, hostname, orchestrator_id, workload_id,
+                          endpoint_id, json_str):
+        """
+        Create an Endpoint from the endpoint raw JSON and its IDs, when the
+        IDs are already known and the endpoint key doesn't need parsing.
+
+        :param hostname: The hostname that the endpoint lives on.
+        :param orchestrator_id: The orchestrator ID.
+        :param workload_id: The workload ID.
+        :param endpoint_id: The endpoint ID.
+        :param json_str: The raw endpoint JSON data.
+        :return: An Endpoint object.
+        """
         json_dict = json.loads(json_str)
         ep = cls(hostname, orchestrator_id, workload_id, endpoint_id,
                  json_dict["state"], json_dict["mac"])
@@ -321,6 +674,39 @@ class Profile(object):
         # Default to empty lists of rules.
         self.rules = Rules(name, [], [])
 
+        # The rules JSON as read from the datastore, used to make updates to
+        # the rules atomic.  None if the profile was not read from the
+        # datastore, or had no rules.
+        self._original_rules_json = None
+
+    def to_json(self):
+        """
+        Convert the Profile to a JSON string containing its name, tags and
+        rules.
+
+        :return: A JSON string.
+        """
+        json_dict = {"name": self.name,
+                     "tags": sorted(self.tags),
+                     "rules": self.rules.to_json_dict()}
+        return json.dumps(json_dict, sort_keys=True)
+
+    @classmethod
+    def from_json(cls, json_str):
+        """
+        Convert the JSON string into a Profile object.  The tags and rules are
+        optional, and default to those of a new Profile.
+
+        :param json_str: The JSON string representing a Profile.
+        :return: A Profile object.
+        """
+        json_dict = json.loads(json_str)
+        profile = cls(json_dict["name"])
+        profile.tags = set(json_dict.get("tags", []))
+        if "rules" in json_dict:
+            profile.rules = Rules.from_json_dict(json_dict["rules"])
+        return profile
+
 
 class Rule(dict):
     """
@@ -354,6 +740,17 @@ class Rule(dict):
             raise ValueError("'%s' is not allowed for key 'action'" % value)
         super(Rule, self).__setitem__(key, value)
 
+    def canonical(self):
+        """
+        Get a hashable, canonical representation of the rule.  Two rules are
+        equal if and only if their canonical representations are equal.
+
+        :return: A tuple of sorted (key, value) pairs, with lists converted to
+        tuples and networks to their (version, first, last) address range.
+        """
+        return tuple(sorted((key, _canonical_value(value))
+                            for key, value in self.iteritems()))
+
     def to_json(self):
         """
         Convert the Rule object to a JSON string.
@@ -407,4 +804,180 @@ class Rule(dict):
         if "dst_net" in self:
             out.append(str(self["dst_net"]))
 
-        return " ".join(out)
\ No newline at end of file
+        return " ".join(out)
+
+
+def _canonical_value(value):
+    """
+    Convert a Rule value to a hashable value that compares equal exactly when
+    the original values do.
+    """
+    if isinstance(value, IPNetwork):
+        return ("net", value.version, value.first, value.last)
+    elif isinstance(value, (list, tuple)):
+        return tuple(_canonical_value(item) for item in value)
+    return value
+
+
+_EXACT_MATCH_KEYS = ("protocol", "src_tag", "dst_tag", "icmp_type", "icmp_code")
+"""Rule keys that only match the same value (or anything, if absent)."""
+
+_NET_KEYS = ("src_net", "dst_net")
+_PORT_KEYS = ("src_ports", "dst_ports")
+
+
+def _optimize_rules(rules):
+    """
+    Optimize an ordered list of rules.  See Rules.optimize().
+
+    :param rules: A list of Rule objects.
+    :return: A RuleList of equivalent rules.
+    """
+    rules = [_coalesce_ports(rule) for rule in rules]
+    while True:
+        count = len(rules)
+        rules = _drop_shadowed(rules)
+        for key in _NET_KEYS + _PORT_KEYS:
+            rules = _merge_runs(rules, key)
+        if len(rules) == count:
+            return RuleList(rules)
+
+
+def _port_ranges(ports):
+    """
+    Convert a list of ports and "min:max" port ranges to a sorted list of
+    non-overlapping, non-adjacent (min, max) tuples.
+    """
+    ranges = []
+    for port in ports:
+        if isinstance(port, basestring) and ":" in port:
+            low, high = port.split(":")
+            ranges.append((int(low), int(high)))
+        else:
+            ranges.append((int(port), int(port)))
+    ranges.sort()
+
+    merged = []
+    for low, high in ranges:
+        if merged and low <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(high, merged[-1][1]))
+        else:
+            merged.append((low, high))
+    return merged
+
+
+def _ports_from_ranges(ranges):
+    """
+    Convert (min, max) tuples back to the port list format used in a Rule.
+    """
+    return [low if low == high else "%d:%d" % (low, high)
+            for low, high in ranges]
+
+
+def _coalesce_ports(rule):
+    """
+    Return a copy of the rule with its port lists coalesced into ranges
+    where that makes them shorter.
+    """
+    rule = Rule(**rule)
+    for key in _PORT_KEYS:
+        if key in rule:
+            ports = _ports_from_ranges(_port_ranges(rule[key]))
+            if len(ports) < len(rule[key]):
+                rule[key] = ports
+    return rule
+
+
+def _covers(rule, other):
+    """
+    Check whether every packet matched by other is also matched by rule.
+    """
+    for key in _EXACT_MATCH_KEYS:
+        if key in rule and (key not in other or rule[key] != other[key]):
+            return False
+    for key in _NET_KEYS:
+        if key in rule and (key not in other or other[key] not in rule[key]):
+            return False
+    for key in _PORT_KEYS:
+        if key in rule:
+            if key not in other:
+                return False
+            ranges = _port_ranges(rule[key])
+            for low, high in _port_ranges(other[key]):
+                if not any(r_low <= low and high <= r_high
+                           for r_low, r_high in ranges):
+                    return False
+    return True
+
+
+def _drop_shadowed(rules):
+    """
+    Remove rules that are covered by an earlier rule, whatever its action.
+
+    Earlier rules are bucketed by their exact match fields, so each rule is
+    only compared against rules that match the same protocol, tags and ICMP
+    type, or a wildcard of them.
+    """
+    kept = []
+    buckets = {}
+    for rule in rules:
+        exact = tuple(rule.get(key) for key in _EXACT_MATCH_KEYS)
+        choices = [(value, None) if value is not None else (None,)
+                   for value in exact]
+        shadowed = any(_covers(earlier, rule)
+                       for bucket in itertools.product(*choices)
+                       for earlier in buckets.get(bucket, ()))
+        if not shadowed:
+            kept.append(rule)
+            buckets.setdefault(exact, []).append(rule)
+    return kept
+
+
+def _merge_runs(rules, key):
+    """
+    Merge runs of consecutive rules that are identical apart from the value
+    of key.  Rules in such a run have the same action and no rule comes
+    between them, so they can be replaced by any set of rules matching the
+    union of their values.
+
+    :param rules: A list of Rule objects.
+    :param key: One of the net or ports keys.
+    :return: A list of Rule objects.
+    """
+    merged = []
+    run = []
+
+    def flush():
+        if len(run) > 1:
+            if key in _NET_KEYS:
+                values = cidr_merge([rule[key] for rule in run])
+            else:
+                ranges = _port_ranges([port for rule in run
+                                       for port in rule[key]])
+                ports = _ports_from_ranges(ranges)
+                values = [ports[i:i + MAX_PORTS_PER_RULE]
+                          for i in range(0, len(ports), MAX_PORTS_PER_RULE)]
+            if len(values) < len(run):
+                for value in values:
+                    rule = Rule(**run[0])
+                    rule[key] = value
+                    merged.append(rule)
+                return
+        merged.extend(run)
+
+    def rest(rule):
+        return tuple(sorted((k, _canonical_value(v))
+                            for k, v in rule.iteritems() if k != key))
+
+    for rule in rules:
+        if key in rule and run and rest(rule) == rest(run[0]):
+            run.append(rule)
+            continue
+        flush()
+        if key in rule:
+            run = [rule]
+        else:
+            run = []
+            merged.append(rule)
+    flush()
+    return merged
@@ -47,8 +47,32 @@ class ProfileAlreadyInEndpoint(Exception):
         self.profile_name = profile_name
 
 
+class ProfileRulesConflict(Exception):
+    """
+    The rules on a profile were modified by another client since they were
+    read, so the update was not applied.
+    """
+    def __init__(self, profile_name):
+        super(ProfileRulesConflict, self).__init__(
+            "Rules on profile %s were modified concurrently" % profile_name)
+        self.profile_name = profile_name
+
+
 class MultipleEndpointsMatch(Exception):
     """
     More than one endpoint was found for the specified criteria.
     """
-    pass
\ No newline at end of file
+    pass
+
+
+class AllocationRetriesExceeded(DataStoreError):
+    """
+    An IP allocation gave up because every attempt allowed by the retry
+    policy collided with a concurrent allocator.
+    """
+    def __init__(self, pool, attempts):
+        super(AllocationRetriesExceeded, self).__init__(
+            "Gave up allocating from pool %s after %d attempts" %
+            (pool, attempts))
+        self.pool = pool
+        self.attempts = attempts
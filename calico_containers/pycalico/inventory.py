@@ -0,0 +1,367 @@
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from collections import deque
+import logging
+import re
+import threading
+import time
+
+from etcd import EtcdKeyNotFound, EtcdEventIndexCleared, EtcdException
+from netaddr import IPAddress, AddrFormatError
+
+from pycalico.datastore import CALICO_V_PATH, HOST_PATH, IP_POOLS_PATH
+from pycalico.datastore_datatypes import Endpoint, IPPool
+from pycalico.ipam import PoolUsage, _host_range
+
+_log = logging.getLogger(__name__)
+
+IPAM_PATH = CALICO_V_PATH + "/ipam/"
+
+POOL_KEY_MATCH = re.compile(CALICO_V_PATH + "/ipam/(?P<version>v[46])/pool/"
+                            "(?P<pool>[^/]+)$")
+ASSIGNMENT_KEY_MATCH = re.compile(CALICO_V_PATH +
+                                  "/ipam/(?P<version>v[46])/assignment/"
+                                  "(?P<pool>[^/]+)/(?P<address>[^/]+)$")
+
+CHURN_WINDOW = 60
+"""The period in seconds over which Inventory.churn_rate() is measured."""
+
+WATCH_RETRY_DELAY = 1
+"""Seconds to wait before re-establishing a failed watch."""
+
+DELETE_ACTIONS = ("delete", "expire", "compareAndDelete")
+
+
+class Inventory(object):
+    """
+    A live view of the endpoints and BGP next hops of a host, and the IP
+    pools and their assignments, kept up to date by applying etcd watch
+    events to a single snapshot of the data store.
+
+    Only the subtrees in the snapshot are watched, so changes elsewhere in
+    the data store, such as other hosts' endpoints, cost nothing.
+
+    The view can be updated from a background thread (see start()); the
+    accessors are safe to call at any time.
+    """
+
+    def __init__(self, client, hostname, churn_window=CHURN_WINDOW,
+                 track_assignments=True):
+        """
+        Constructor.
+        :param client: The DatastoreClient to read and watch with.
+        :param hostname: The host whose endpoints are tracked.
+        :param churn_window: The period in seconds over which endpoint churn
+        is measured.
+        :param track_assignments: Whether to track the IP assignments in
+        each pool.  If False, pool_usage() reports no assignments, and the
+        snapshot is much smaller.
+        """
+        self.client = client
+        self.hostname = hostname
+        self.churn_window = churn_window
+        self.track_assignments = track_assignments
+        self._host_path = HOST_PATH % {"hostname": hostname}
+        if track_assignments:
+            self.paths = [self._host_path, IPAM_PATH]
+        else:
+            self.paths = [self._host_path,
+                          IP_POOLS_PATH % {"version": "v4"},
+                          IP_POOLS_PATH % {"version": "v6"}]
+
+        # The etcd index following the last snapshot or event, or None before
+        # the first snapshot.
+        self.index = None
+
+        # {path: the etcd index to watch the path from}, and the number of
+        # snapshots taken, so that events read from before a snapshot are
+        # not applied after it.
+        self._watch_indexes = {}
+        self._generation = 0
+
+        # Whether the view needs a new snapshot before watching can continue.
+        self._needs_snapshot = True
+
+        # The number of watch events applied since the last snapshot.
+        self.events = 0
+
+        self._lock = threading.Lock()
+        self._snapshot_lock = threading.Lock()
+        self._endpoints = set()
+        self._next_hops = {}
+        self._pools = {}
+        self._assignments = {}
+        self._churn = deque()
+        self._threads = []
+
+    def snapshot(self):
+        """
+        Replace the view with a fresh read of the host's tree and of the IPAM
+        tree (or only the pools, if assignments aren't tracked).
+
+        Watching continues from the oldest of the reads, so any change made
+        between them is applied again.  Applying a change is idempotent, so
+        this is harmless.
+
+        :return: None.
+        """
+        reads = []
+        for path in self.paths:
+            try:
+                reads.append(self.client.etcd_client.read(path,
+                                                          recursive=True))
+            except EtcdKeyNotFound:
+                pass
+
+        with self._lock:
+            self._endpoints.clear()
+            self._next_hops.clear()
+            self._pools.clear()
+            self._assignments.clear()
+            self._churn.clear()
+            self.events = 0
+            for result in reads:
+                for leaf in result.leaves:
+                    if not leaf.dir:
+                        self._set(leaf.key, leaf.value, churn=False)
+            if reads:
+                self.index = min(result.etcd_index for result in reads) + 1
+            else:
+                self.index = None
+            self._watch_indexes = dict.fromkeys(self.paths, self.index)
+            self._generation += 1
+            self._needs_snapshot = False
+
+    def has_snapshot(self):
+        """
+        :return: Whether a snapshot has been taken, so that the view can be
+        used.
+        """
+        with self._lock:
+            return not self._needs_snapshot
+
+    def apply(self, event, path=None, generation=None):
+        """
+        Apply an etcd watch event to the view.
+
+        :param event: The EtcdResult returned by the watch.
+        :param path: The watched path the event was read from, if any.
+        :param generation: The snapshot generation the watch was made in.
+        The event is ignored if a snapshot has been taken since.
+        :return: None.
+        """
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return
+            self.events += 1
+            self.index = event.modifiedIndex + 1
+            if path is not None:
+                self._watch_indexes[path] = event.modifiedIndex + 1
+            if event.action in DELETE_ACTIONS:
+                self._delete(event.key)
+            elif not event.dir:
+                self._set(event.key, event.value, churn=True)
+
+    def watch(self, path):
+        """
+        Apply watch events for one of the paths to the view until the process
+        exits.  Takes a snapshot first if there isn't one, and a new one if
+        etcd no longer has the events since the last one seen.
+
+        :param path: The path to watch, one of self.paths.
+        :return: Never returns.
+        """
+        while True:
+            if not self.has_snapshot():
+                # Only one of the watches takes the snapshot.
+                with self._snapshot_lock:
+                    if not self.has_snapshot():
+                        try:
+                            self.snapshot()
+                        except EtcdException:
+                            _log.exception("Snapshot failed, retrying")
+                            time.sleep(WATCH_RETRY_DELAY)
+                continue
+
+            with self._lock:
+                index = self._watch_indexes.get(path)
+                generation = self._generation
+            try:
+                event = self.client.etcd_client.read(path,
+                                                     recursive=True,
+                                                     wait=True,
+                                                     waitIndex=index,
+                                                     timeout=0)
+            except EtcdEventIndexCleared:
+                _log.info("Watch index %s cleared for %s, taking a new "
+                          "snapshot", index, path)
+                with self._lock:
+                    if generation == self._generation:
+                        self._needs_snapshot = True
+            except EtcdException:
+                _log.exception("Watch failed, retrying")
+                time.sleep(WATCH_RETRY_DELAY)
+            else:
+                self.apply(event, path, generation)
+
+    def start(self, snapshot=True):
+        """
+        Keep the view up to date from daemon threads, one watching each path.
+
+        :param snapshot: Whether to take a snapshot first.  Pass False to
+        continue from an existing snapshot, for example one taken before the
+        process forked.  If there is no snapshot, the threads take one,
+        retrying until etcd can be read.
+        :return: None.
+        """
+        if snapshot:
+            self.snapshot()
+        self._threads = []
+        for path in self.paths:
+            thread = threading.Thread(target=self.watch, args=(path,))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def endpoint_count(self):
+        """
+        :return: The number of endpoints on the host.
+        """
+        with self._lock:
+            return len(self._endpoints)
+
+    def churn_rate(self):
+        """
+        :return: The number of endpoints added or removed per minute, over
+        the last churn_window seconds.
+        """
+        with self._lock:
+            self._expire_churn()
+            return len(self._churn) * 60.0 / self.churn_window
+
+    def next_hops(self):
+        """
+        Get the next hop IP addresses for default routes on the host, as
+        DatastoreClient.get_default_next_hops() does.
+
+        :return: Dict of {ip_version: IPAddress}.  Raises KeyError if the
+        host's BIRD configuration has not been set.
+        """
+        with self._lock:
+            if len(self._next_hops) < 2:
+                raise KeyError("BIRD configuration for host %s not found." %
+                               self.hostname)
+            next_hops = {}
+            for version, key in ((4, "bird_ip"), (6, "bird6_ip")):
+                try:
+                    next_hops[version] = IPAddress(self._next_hops[key])
+                except (AddrFormatError, ValueError, TypeError):
+                    pass
+            return next_hops
+
+    def ip_pools(self, version):
+        """
+        :param version: "v4" for IPv4, "v6" for IPv6
+        :return: A list of the IPPools for the version.
+        """
+        with self._lock:
+            return [pool for pool_id, pool in sorted(self._pools.iteritems())
+                    if pool_id[0] == version]
+
+    def pool_usage(self):
+        """
+        :return: A list of PoolUsage for each pool, sorted by CIDR.
+        """
+        with self._lock:
+            usage = []
+            for pool_id, pool in self._pools.iteritems():
+                cidr = pool.cidr
+                host_range = _host_range(cidr)
+                capacity = host_range[1] - host_range[0] + 1 \
+                    if host_range else 0
+                hosts = {}
+                assignments = self._assignments.get(pool_id, {})
+                for host in assignments.itervalues():
+                    hosts[host] = hosts.get(host, 0) + 1
+                usage.append(PoolUsage(cidr, capacity, len(assignments),
+                                       hosts))
+            return sorted(usage, key=lambda pool: (pool.cidr.version,
+                                                   pool.cidr))
+
+    def _set(self, key, value, churn):
+        if key.startswith(self._host_path) and \
+                key[len(self._host_path):] in ("bird_ip", "bird6_ip"):
+            self._next_hops[key[len(self._host_path):]] = value
+            return
+
+        match = Endpoint.ENDPOINT_KEY_MATCH.match(key)
+        if match:
+            if match.group("hostname") == self.hostname and \
+                    key not in self._endpoints:
+                self._endpoints.add(key)
+                if churn:
+                    self._record_churn()
+            return
+
+        match = POOL_KEY_MATCH.match(key)
+        if match:
+            pool_id = (match.group("version"), match.group("pool"))
+            try:
+                self._pools[pool_id] = IPPool.from_json(value)
+            except (ValueError, KeyError, TypeError):
+                self._pools[pool_id] = IPPool(
+                    match.group("pool").replace("-", "/"))
+            return
+
+        match = ASSIGNMENT_KEY_MATCH.match(key)
+        if match and self.track_assignments:
+            pool_id = (match.group("version"), match.group("pool"))
+            self._assignments.setdefault(pool_id, {})[
+                match.group("address")] = value or ""
+
+    def _delete(self, key):
+        # A deleted directory removes everything beneath it.
+        prefix = key + "/"
+        host_path = self._host_path
+        if key.startswith(host_path) or host_path.startswith(prefix):
+            for name in self._next_hops.keys():
+                if host_path + name == key or host_path.startswith(prefix):
+                    del self._next_hops[name]
+            removed = [endpoint for endpoint in self._endpoints
+                       if endpoint == key or endpoint.startswith(prefix)]
+            for endpoint in removed:
+                self._endpoints.remove(endpoint)
+                self._record_churn()
+
+        match = POOL_KEY_MATCH.match(key)
+        if match:
+            self._pools.pop((match.group("version"), match.group("pool")),
+                            None)
+            return
+
+        for pool_id in self._assignments.keys():
+            pool_dir = IPAM_PATH + "%s/assignment/%s" % pool_id
+            if pool_dir == key or pool_dir.startswith(prefix):
+                del self._assignments[pool_id]
+            elif key.startswith(pool_dir + "/"):
+                self._assignments[pool_id].pop(key[len(pool_dir) + 1:], None)
+
+    def _record_churn(self):
+        self._churn.append(time.time())
+        self._expire_churn()
+
+    def _expire_churn(self):
+        cutoff = time.time() - self.churn_window
+        while self._churn and self._churn[0] < cutoff:
+            self._churn.popleft()
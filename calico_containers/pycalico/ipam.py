@@ -12,30 +12,143 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from etcd import EtcdKeyNotFound, EtcdAlreadyExist
+from collections import namedtuple
+import os
+import random
+import socket
+import time
+import zlib
+
+from etcd import EtcdKeyNotFound, EtcdAlreadyExist, EtcdCompareFailed
 
 from netaddr import IPAddress, IPNetwork
 
 from pycalico.datastore_datatypes import IPPool
-from pycalico.datastore import CALICO_V_PATH, DatastoreClient
+from pycalico.datastore import CALICO_V_PATH, DatastoreClient, handle_errors
+from pycalico.datastore_errors import AllocationRetriesExceeded
 
-IP_ASSIGNMENT_PATH = CALICO_V_PATH + "/ipam/%(version)s/assignment/%(pool)s"
+IP_ASSIGNMENTS_PATH = CALICO_V_PATH + "/ipam/%(version)s/assignment/"
+IP_ASSIGNMENT_PATH = IP_ASSIGNMENTS_PATH + "%(pool)s"
 IP_ASSIGNMENT_KEY = IP_ASSIGNMENT_PATH + "/%(address)s"
 
+IPAM_STRATEGY_ENV = "CALICO_IPAM_STRATEGY"
+IPAM_STRATEGY_DEFAULT = "sequential"
+
+AllocationRecord = namedtuple("AllocationRecord",
+                              ["pool", "address", "attempts", "wait_time"])
+"""
+The outcome of a single call to allocate().  address is None if the pool was
+full or the retry policy gave up.  wait_time is the time in seconds spent
+backing off between attempts.
+"""
+
+PoolUsage = namedtuple("PoolUsage", ["cidr", "capacity", "assigned", "hosts"])
+"""
+Utilization of a single pool.  capacity is the number of assignable host
+addresses, assigned the number of assignments, and hosts a dict mapping
+hostname to the number of assignments made by that host.  Assignments that
+pre-date hostname tracking are counted under the empty hostname.
+"""
+
+Assignment = namedtuple("Assignment", ["pool", "address", "hostname", "index"])
+"""
+A single address assignment as stored in the datastore.  index is the etcd
+modifiedIndex of the assignment key, used to release it safely.
+"""
+
+
+class RetryPolicy(object):
+    """
+    Controls how hard an assigner retries when its candidate addresses are
+    claimed by concurrent allocators.
+
+    Between attempts the assigner sleeps for a random time between zero and
+    an exponentially increasing ceiling ("full jitter"), so that contending
+    allocators spread out rather than retrying in lock step.
+    """
+
+    def __init__(self, max_attempts=10, base_delay=0.01, max_delay=1.0,
+                 deadline=None):
+        """
+        Constructor.
+        :param max_attempts: The maximum number of assignment attempts for a
+        single allocation, or None for no limit.
+        :param base_delay: The backoff ceiling (seconds) after the first
+        collision.  This doubles after each further collision.
+        :param max_delay: The maximum backoff (seconds) between attempts.
+        :param deadline: The maximum total time (seconds) to spend on a single
+        allocation, or None for no limit.
+        """
+        if max_attempts is not None and max_attempts <= 0:
+            raise ValueError("max_attempts must be positive, not %s" %
+                             max_attempts)
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+
+    def backoff(self, attempts):
+        """
+        Calculate the time to sleep before the next attempt.
+
+        :param attempts: The number of attempts made so far.
+        :return: The time to sleep in seconds.
+        """
+        ceiling = min(self.max_delay,
+                      self.base_delay * (2 ** min(attempts - 1, 32)))
+        return random.uniform(0, ceiling)
+
+    def should_retry(self, attempts, elapsed, delay):
+        """
+        Determine whether another attempt should be made.
+
+        :param attempts: The number of attempts made so far.
+        :param elapsed: The time (seconds) since the allocation started.
+        :param delay: The backoff that would precede the next attempt.
+        :return: True if another attempt should be made.
+        """
+        if self.max_attempts is not None and attempts >= self.max_attempts:
+            return False
+        if self.deadline is not None and elapsed + delay > self.deadline:
+            return False
+        return True
+
 
 class SequentialAssignment(object):
     """
     Assign IP addresses sequentially
     """
 
-    def __init__(self):
+    def __init__(self, retry_policy=None):
+        """
+        Constructor.
+        :param retry_policy: The RetryPolicy to use when a candidate address
+        is claimed by a concurrent allocator.  Defaults to RetryPolicy().
+        """
         # Init an etcd client.
         self.etcd = IPAMClient()
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.hostname = socket.gethostname()
+
+        # Contention statistics, accumulated over the lifetime of this
+        # assigner.  A collision is a candidate address that another
+        # allocator claimed between us reading the assignments and writing
+        # our own.
+        self.allocations = 0
+        self.attempts = 0
+        self.collisions = 0
+        self.wait_time = 0.0
+
+        # The AllocationRecord of the most recent call to allocate().
+        self.last_allocation = None
 
     def allocate(self, pool):
         """
         Attempt to allocate an IP address from the provided pool.
 
+        Raises AllocationRetriesExceeded if every attempt permitted by the
+        retry policy collided with a concurrent allocator.
+
         :param IPPool or IPNetwork pool: The pool to allocate from
         :return: An IP address which has been allocated or None
         if allocation failed.
@@ -45,18 +158,53 @@ class SequentialAssignment(object):
             pool = pool.cidr
         assert isinstance(pool, IPNetwork)
 
+        start = time.time()
+        attempts = 0
+        wait_time = 0.0
         while True:
             assigned_addresses = self.etcd.get_assigned_addresses(pool)
 
             candidate_address = self._get_next(pool, assigned_addresses)
             if candidate_address is None:
                 # the pool is full, we can't allocate an address
+                self.last_allocation = AllocationRecord(pool, None, attempts,
+                                                        wait_time)
                 return None
-            else:
-                # We've found an address to try.
-                if self.etcd.assign_address(pool,
-                                            IPAddress(candidate_address)):
-                    return candidate_address
+
+            # We've found an address to try.
+            attempts += 1
+            self.attempts += 1
+            if self.etcd.assign_address(pool, IPAddress(candidate_address),
+                                        hostname=self.hostname):
+                self.allocations += 1
+                self.last_allocation = AllocationRecord(pool,
+                                                        candidate_address,
+                                                        attempts, wait_time)
+                return candidate_address
+            self.collisions += 1
+
+            # Someone else got there first.  Back off before re-reading the
+            # assignments, unless the retry policy says to give up.
+            delay = self.retry_policy.backoff(attempts)
+            if not self.retry_policy.should_retry(attempts,
+                                                  time.time() - start,
+                                                  delay):
+                self.last_allocation = AllocationRecord(pool, None, attempts,
+                                                        wait_time)
+                raise AllocationRetriesExceeded(pool, attempts)
+            time.sleep(delay)
+            wait_time += delay
+            self.wait_time += delay
+
+    def collision_rate(self):
+        """
+        :return: The fraction of assignment attempts that collided with
+        another allocator, or 0.0 if no attempts have been made.
+        :rtype float:
+        """
+        if not self.attempts:
+            return 0.0
+        return float(self.collisions) / self.attempts
 
     def _get_next(self, pool, assigned):
         """
@@ -67,15 +215,139 @@ class SequentialAssignment(object):
                  is full.
         """
         assert isinstance(pool, IPNetwork)
-        for addr in pool.iter_hosts():
+        host_range = _host_range(pool)
+        if host_range is None:
+            return None
+        first, last = host_range
+
+        # Scan from the start offset to the end of the pool, then wrap round
+        # to the beginning.
+        size = last - first + 1
+        start = self._start_offset(pool, size)
+        # Not xrange(), which can't count past a C long, as the offsets in an
+        # IPv6 pool do.
+        index = 0
+        while index < size:
+            addr = IPAddress(first + (start + index) % size, pool.version)
             addr_string = str(addr)
             if addr_string not in assigned:
                 return addr_string
+            index += 1
         return None
 
+    def _start_offset(self, pool, size):
+        """
+        The offset into the pool's host addresses at which to start searching
+        for a free address.
+
+        :param IPNetwork pool: The pool to allocate from.
+        :param size: The number of host addresses in the pool.
+        :return: An offset in the range [0, size).
+        """
+        return 0
+
+
+class RandomAssignment(SequentialAssignment):
+    """
+    Assign IP addresses by probing from a random point in the pool, so that
+    concurrent allocators rarely propose the same candidate.
+    """
+
+    def _start_offset(self, pool, size):
+        return random.randrange(size)
+
+
+class StripedAssignment(SequentialAssignment):
+    """
+    Assign IP addresses by probing from a point in the pool derived from a
+    hash of the hostname.  Allocators on different hosts start from
+    different points, while allocations from a single host stay clustered.
+    """
+
+    def __init__(self, key=None, retry_policy=None):
+        """
+        :param key: The string to hash to choose the start point.  Defaults
+        to the hostname.
+        :param retry_policy: See SequentialAssignment.
+        """
+        super(StripedAssignment, self).__init__(retry_policy=retry_policy)
+        if key is None:
+            key = socket.gethostname()
+        # Use crc32 rather than hash() so that the stripe is stable across
+        # processes and Python builds.
+        self.stripe = zlib.crc32(key) & 0xffffffff
+
+    def _start_offset(self, pool, size):
+        return self.stripe % size
+
+
+ASSIGNMENT_STRATEGIES = {"sequential": SequentialAssignment,
+                         "random": RandomAssignment,
+                         "striped": StripedAssignment}
+
+
+def get_assigner_class(strategy=None):
+    """
+    Look up the class of IP assigner for the named allocation strategy.
+
+    :param strategy: One of the keys of ASSIGNMENT_STRATEGIES.  If None, the
+    strategy is read from the CALICO_IPAM_STRATEGY environment variable,
+    defaulting to sequential.
+    :return: The assigner class.  Raises ValueError if the strategy is
+    unknown.
+    """
+    if strategy is None:
+        strategy = os.getenv(IPAM_STRATEGY_ENV, IPAM_STRATEGY_DEFAULT)
+    try:
+        return ASSIGNMENT_STRATEGIES[strategy]
+    except KeyError:
+        raise ValueError("Unknown IPAM strategy %s.  Valid strategies are: "
+                         "%s" % (strategy,
+                                 ", ".join(sorted(ASSIGNMENT_STRATEGIES))))
+
+
+def get_assigner(strategy=None, retry_policy=None):
+    """
+    Create an IP assigner using the named allocation strategy.
+
+    :param strategy: See get_assigner_class().
+    :param retry_policy: The RetryPolicy for the assigner, or None for the
+    default policy.
+    :return: An assigner with an allocate(pool) method.
+    """
+    return get_assigner_class(strategy)(retry_policy=retry_policy)
+
+
+def _host_range(pool):
+    """
+    Get the range of addresses in the pool that may be assigned to hosts.
+    This matches IPNetwork.iter_hosts() without building the addresses.
+
+    :param IPNetwork pool: The pool.
+    :return: A tuple of (first, last) as integers, or None if the pool has no
+    host addresses.
+    """
+    if pool.version == 4:
+        if pool.size < 4:
+            return None
+        return pool.first + 1, pool.last - 1
+    else:
+        if pool.size < 2:
+            return None
+        return pool.first + 1, pool.last
+
+
+def _assignment_dir(pool):
+    """
+    :param IPNetwork pool: The pool.
+    :return: The etcd directory holding the assignments for the pool.
+    """
+    return IP_ASSIGNMENT_PATH % {"version": "v%s" % pool.version,
+                                 "pool": str(pool).replace("/", "-")}
+
 
 class IPAMClient(DatastoreClient):
-    def assign_address(self, pool, address):
+    def assign_address(self, pool, address, hostname=None):
         """
         Attempt to assign an IPAddress in a pool.
         Fails if the address is already assigned.
@@ -83,6 +355,8 @@ class IPAMClient(DatastoreClient):
 
         :param IPPool or IPNetwork pool: The pool that the assignment is from.
         :param IPAddress address: The address to assign.
+        :param hostname: Optional name of the host making the assignment.
+        This is stored as the value of the assignment for usage reporting.
 
         :return: True if the allocation succeeds, false otherwise. An
         exception is thrown for any error conditions.
@@ -97,7 +371,7 @@ class IPAMClient(DatastoreClient):
                                    "pool": str(pool).replace("/", "-"),
                                    "address": address}
         try:
-            self.etcd_client.write(key, "", prevExist=False)
+            self.etcd_client.write(key, hostname or "", prevExist=False)
         except EtcdAlreadyExist:
             return False
         else:
@@ -129,6 +403,50 @@ class IPAMClient(DatastoreClient):
         else:
             return True
 
+    def release_address(self, address):
+        """
+        Unassign an IP from whichever configured pool it was assigned from.
+        If pools are nested, each pool containing the address is tried, most
+        specific first.
+
+        :param IPAddress address: The address to unassign.
+
+        :return: True if the address was unassigned, false otherwise. An
+        exception is thrown for any error conditions.
+        :rtype: bool
+        """
+        for pool in self.find_pools(address):
+            if self.unassign_address(pool, address):
+                return True
+        return False
+
+    def unassign_addresses(self, pool, addresses):
+        """
+        Unassign a batch of IPs from a pool.
+
+        :param IPPool or IPNetwork pool: The pool that the assignments are
+        from.
+        :param addresses: The IPAddresses to unassign.
+
+        :return: The set of IPAddresses that were unassigned.  An exception
+        is thrown for any error conditions.
+        """
+        if isinstance(pool, IPPool):
+            pool = pool.cidr
+        assert isinstance(pool, IPNetwork)
+
+        directory = _assignment_dir(pool)
+        unassigned = set()
+        for address in addresses:
+            assert isinstance(address, IPAddress)
+            try:
+                self.etcd_client.delete("%s/%s" % (directory, address))
+            except EtcdKeyNotFound:
+                pass
+            else:
+                unassigned.add(address)
+        return unassigned
+
     def get_assigned_addresses(self, pool):
         """
         :param IPPool or IPNetwork pool: The pool to get assignments for.
@@ -139,8 +457,7 @@ class IPAMClient(DatastoreClient):
             pool = pool.cidr
         assert isinstance(pool, IPNetwork)
 
-        directory = IP_ASSIGNMENT_PATH % {"version": "v%s" % pool.version,
-                                          "pool": str(pool).replace("/", "-")}
+        directory = _assignment_dir(pool)
         try:
             nodes = self.etcd_client.read(directory).children
         except EtcdKeyNotFound:
@@ -151,5 +468,122 @@ class IPAMClient(DatastoreClient):
             addresses = {}
             for child in nodes:
                 if not child.dir:
-                    addresses[child.key.split("/")[-1]] = ""
+                    addresses[child.key.split("/")[-1]] = child.value or ""
             return addresses
+
+    @handle_errors
+    def get_pool_usage(self, pool):
+        """
+        Get the utilization of a pool from a single read of its assignment
+        directory.  The cost is proportional to the number of assignments,
+        not the size of the pool.
+
+        :param IPPool or IPNetwork pool: The pool to get the usage for.
+        :return: A PoolUsage.
+        """
+        if isinstance(pool, IPPool):
+            pool = pool.cidr
+        assert isinstance(pool, IPNetwork)
+
+        host_range = _host_range(pool)
+        capacity = host_range[1] - host_range[0] + 1 if host_range else 0
+
+        assigned = 0
+        hosts = {}
+        try:
+            nodes = self.etcd_client.read(_assignment_dir(pool)).children
+        except EtcdKeyNotFound:
+            # Nothing has ever been assigned from this pool.
+            pass
+        else:
+            for child in nodes:
+                if not child.dir:
+                    assigned += 1
+                    host = child.value or ""
+                    hosts[host] = hosts.get(host, 0) + 1
+        return PoolUsage(pool, capacity, assigned, hosts)
+
+    @handle_errors
+    def get_assignments(self, version):
+        """
+        Get every address assignment for an IP version, across all pools,
+        from a single recursive read.
+
+        :param version: "v4" for IPv4, "v6" for IPv6
+        :return: A list of Assignment.
+        """
+        assert version in ("v4", "v6")
+        path = IP_ASSIGNMENTS_PATH % {"version": version}
+        try:
+            leaves = self.etcd_client.read(path, recursive=True).leaves
+        except EtcdKeyNotFound:
+            return []
+
+        assignments = []
+        for leaf in leaves:
+            # Empty directories are returned as leaves, so skip them.
+            if leaf.dir:
+                continue
+            pool, address = leaf.key[len(path):].split("/", 1)
+            assignments.append(Assignment(IPNetwork(pool.replace("-", "/")),
+                                          IPAddress(address),
+                                          leaf.value or "",
+                                          leaf.modifiedIndex))
+        return assignments
+
+    @handle_errors
+    def release_assignment(self, assignment):
+        """
+        Release an assignment, provided it has not been modified since it was
+        read.  This makes it safe to release assignments that appear leaked
+        while other allocators are running: if the address has since been
+        released and re-assigned, it is left alone.
+
+        :param Assignment assignment: The assignment to release.
+        :return: True if the assignment was released, False otherwise.
+        """
+        key = IP_ASSIGNMENT_KEY % {
+            "version": "v%s" % assignment.pool.version,
+            "pool": str(assignment.pool).replace("/", "-"),
+            "address": assignment.address}
+        try:
+            self.etcd_client.delete(key, prevIndex=assignment.index)
+        except (EtcdKeyNotFound, EtcdCompareFailed):
+            return False
+        else:
+            return True
+
+    @handle_errors
+    def get_leaked_assignments(self, version, endpoints=None):
+        """
+        Find assignments whose address is not used by any endpoint.
+
+        An address that has been assigned but whose endpoint has not been
+        written yet is reported, as is one whose endpoint was written after
+        the endpoints passed in were read.  So callers must re-check the
+        endpoints after a grace period, and release only the assignments
+        reported both times, using release_assignment: an assignment that is
+        still unchanged after the grace period has outlived the creation of
+        its endpoint, and the compare on its etcd index stops an address
+        released and re-assigned in the meantime being released.
+
+        :param version: "v4" for IPv4, "v6" for IPv6
+        :param endpoints: The endpoints to check against, or None to read all
+        endpoints from the datastore.
+        :return: A list of Assignment.
+        """
+        assert version in ("v4", "v6")
+        assignments = self.get_assignments(version)
+        if not assignments:
+            return []
+
+        if endpoints is None:
+            endpoints = self.get_endpoints()
+        in_use = set()
+        for endpoint in endpoints:
+            nets = (endpoint.ipv4_nets if version == "v4"
+                    else endpoint.ipv6_nets)
+            in_use.update(net.ip for net in nets)
+
+        return [assignment for assignment in assignments
+                if assignment.address not in in_use]
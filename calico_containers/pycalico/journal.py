@@ -0,0 +1,202 @@
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from collections import OrderedDict
+import errno
+import json
+import logging
+import os
+import threading
+
+_log = logging.getLogger(__name__)
+
+JOURNAL_PREFIX = "journal."
+RECOVERING_SUFFIX = ".recovering"
+
+COMPLETE = "complete"
+"""The phase recorded when an operation has finished, or been rolled back."""
+
+COMPACT_THRESHOLD = 1000
+"""The number of records after which an idle journal is truncated."""
+
+
+class IntentJournal(object):
+    """
+    An append-only log of the phases of multi-step operations, so that the
+    side effects of an operation interrupted by the death of the process can
+    be rolled back later.
+
+    Each process writes its own file, named after its PID, in the journal
+    directory.  Records are written to the file as soon as they are made, so
+    they survive the process being killed.  sync() makes them survive the
+    host crashing too; threads that sync at the same time share one fsync.
+    """
+
+    def __init__(self, directory, pid=None):
+        """
+        Constructor.
+        :param directory: The journal directory.  Created if it doesn't
+        exist.
+        :param pid: The PID to name the file after.  Defaults to this
+        process's.
+        """
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.path = os.path.join(directory,
+                                 JOURNAL_PREFIX + str(pid or os.getpid()))
+        self._fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_APPEND,
+                           0644)
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        self._open = set()
+        self._written = 0
+        self._synced = 0
+
+    def record(self, op_id, phase, **data):
+        """
+        Record a phase of an operation.
+        :param op_id: Identifies the operation.
+        :param phase: The phase.
+        :param data: Anything needed to roll the phase back.
+        :return: The sequence number of the record, for sync().
+        """
+        data["id"] = op_id
+        data["phase"] = phase
+        line = json.dumps(data) + "\n"
+        with self._lock:
+            os.write(self._fd, line)
+            self._written += 1
+            if phase == COMPLETE:
+                self._open.discard(op_id)
+            else:
+                self._open.add(op_id)
+            return self._written
+
+    def sync(self, seq=None):
+        """
+        Make records durable.
+        :param seq: The sequence number of the last record that must be
+        durable, or None for all of them.
+        :return: None.
+        """
+        if seq is None:
+            seq = self._written
+        with self._sync_lock:
+            # Another thread's fsync may already have covered this record.
+            if self._synced >= seq:
+                return
+            written = self._written
+            os.fsync(self._fd)
+            self._synced = written
+
+    def complete(self, op_id):
+        """
+        Record that an operation has finished, and make it durable.  The
+        journal is truncated if no operations are open and it has grown past
+        COMPACT_THRESHOLD records.
+        :param op_id: Identifies the operation.
+        :return: None.
+        """
+        self.sync(self.record(op_id, COMPLETE))
+        with self._lock:
+            if not self._open and self._written >= COMPACT_THRESHOLD:
+                with self._sync_lock:
+                    os.ftruncate(self._fd, 0)
+                    os.fsync(self._fd)
+                    self._written = 0
+                    self._synced = 0
+
+    def close(self):
+        os.close(self._fd)
+
+
+def read_journal(path):
+    """
+    Read the operations in a journal file that didn't complete.
+    :param path: The journal file.
+    :return: An OrderedDict of {op_id: [record dict]}, in order of the first
+    record of each operation.  A truncated final record is ignored.
+    """
+    operations = OrderedDict()
+    with open(path) as journal:
+        for line in journal:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                _log.warning("Ignoring unreadable record in %s: %r",
+                             path, line)
+                continue
+            if record["phase"] == COMPLETE:
+                operations.pop(record["id"], None)
+            else:
+                operations.setdefault(record["id"], []).append(record)
+    return operations
+
+
+def claim_journals(directory, skip_pids=(), live=False):
+    """
+    Claim the journal files of other processes for recovery.
+
+    A file is claimed by renaming it, so when several processes try to
+    recover the same file, only one of them does.
+
+    :param directory: The journal directory.
+    :param skip_pids: PIDs whose journals should be left alone.
+    :param live: Whether to claim the journals of processes that are still
+    running, and journals left half recovered.  Only safe when no other
+    process can be using the directory, for example at startup, when any
+    running PIDs are left over from before a restart.
+    :return: A list of the paths of the claimed files.  Delete them once
+    they've been recovered.
+    """
+    try:
+        names = os.listdir(directory)
+    except OSError as e:
+        if e.errno == errno.ENOENT:
+            return []
+        raise
+
+    claimed = []
+    for name in sorted(names):
+        if not name.startswith(JOURNAL_PREFIX):
+            continue
+        try:
+            pid = int(name[len(JOURNAL_PREFIX):].split(".")[0])
+        except ValueError:
+            continue
+        path = os.path.join(directory, name)
+        if RECOVERING_SUFFIX in name:
+            if live:
+                claimed.append(path)
+            continue
+        if pid in skip_pids or (not live and _pid_running(pid)):
+            continue
+
+        recovering = "%s%s.%d" % (path, RECOVERING_SUFFIX, os.getpid())
+        try:
+            os.rename(path, recovering)
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                # Another process claimed it first.
+                continue
+            raise
+        claimed.append(recovering)
+    return claimed
+
+
+def _pid_running(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
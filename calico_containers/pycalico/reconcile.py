@@ -0,0 +1,212 @@
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Bulk cleanup of the Calico state on a host: the host ends of veths whose
+endpoints no longer exist, and all the endpoints on a host being drained.
+
+Run as a module to reconcile periodically:
+
+    python -m pycalico.reconcile
+
+The interval in seconds is read from the CALICO_RECONCILE_INTERVAL
+environment variable.
+"""
+from subprocess import Popen, PIPE
+import logging
+import os
+import socket
+import sys
+import time
+
+from pycalico.datastore import DatastoreClient, IF_PREFIX, \
+    LIBNETWORK_ORCHESTRATOR_ID
+from pycalico.datastore_errors import DataStoreError
+
+_log = logging.getLogger(__name__)
+
+SYS_CLASS_NET = "/sys/class/net"
+"""Where the kernel lists the links in the current network namespace."""
+
+RECONCILE_INTERVAL_ENV = "CALICO_RECONCILE_INTERVAL"
+RECONCILE_INTERVAL_DEFAULT = 300
+
+
+def list_calico_links(sys_class_net=SYS_CLASS_NET):
+    """
+    :param sys_class_net: The sysfs directory listing the links.
+    :return: A set of the names of the Calico links on the host.
+    """
+    return set(name for name in os.listdir(sys_class_net)
+               if name.startswith(IF_PREFIX))
+
+
+def delete_links(names):
+    """
+    Delete links with a single ip command.  A link that can't be deleted
+    doesn't stop the others being deleted.
+
+    :param names: The names of the links to delete.
+    :return: True if every link was deleted.
+    """
+    if not names:
+        return True
+    process = Popen(["ip", "-force", "-batch", "-"], stdin=PIPE)
+    process.communicate("".join("link delete %s\n" % name
+                                for name in names))
+    return process.returncode == 0
+
+
+def drain_host(client, hostname,
+               orchestrator_id=LIBNETWORK_ORCHESTRATOR_ID):
+    """
+    Remove all of an orchestrator's endpoints from a host: their datastore
+    entries, their veths and their IP assignments.
+
+    The endpoints are read with one recursive read, and removed with one
+    recursive delete per workload.  The veths are deleted with one ip
+    command, and the IPs are released a pool at a time.  If pools are
+    nested, an IP that wasn't assigned from its most specific pool is
+    released from the pools enclosing it in turn.  The IPs are released
+    last, so they can't be reassigned while still in use.
+
+    :param client: The IPAMClient.
+    :param hostname: The host to drain.
+    :param orchestrator_id: The orchestrator whose endpoints are removed.
+    :return: The list of Endpoints removed.
+    """
+    endpoints = client.get_endpoints(hostname=hostname,
+                                     orchestrator_id=orchestrator_id)
+
+    for workload_id in set(endpoint.workload_id for endpoint in endpoints):
+        try:
+            client.remove_workload(hostname, orchestrator_id, workload_id)
+        except KeyError:
+            # Already removed.
+            pass
+
+    links = list_calico_links() & set(endpoint.name for endpoint in endpoints)
+    if not delete_links(sorted(links)):
+        _log.warning("Failed to delete some links while draining %s",
+                     hostname)
+
+    # {IPAddress: the pools containing it that are still to be tried}
+    candidates = {}
+    for endpoint in endpoints:
+        for net in endpoint.ipv4_nets.union(endpoint.ipv6_nets):
+            candidates[net.ip] = list(client.find_pools(net.ip))
+    while candidates:
+        addresses = {}
+        for address, pools in sorted(candidates.items()):
+            if pools:
+                addresses.setdefault(pools.pop(0).cidr, []).append(address)
+            else:
+                del candidates[address]
+        for pool, pool_addresses in addresses.iteritems():
+            for address in client.unassign_addresses(pool, pool_addresses):
+                del candidates[address]
+
+    return endpoints
+
+
+class VethReconciler(object):
+    """
+    Finds and deletes the Calico links on a host that don't belong to any of
+    its endpoints.
+
+    An endpoint's veth is created before the endpoint is written to the
+    datastore, so a link only counts as an orphan once it has been missing
+    an endpoint in two consecutive passes.
+    """
+
+    def __init__(self, client, hostname, sys_class_net=SYS_CLASS_NET):
+        """
+        Constructor.
+        :param client: The DatastoreClient to read endpoints with.
+        :param hostname: The host to reconcile.
+        :param sys_class_net: The sysfs directory listing the links.
+        """
+        self.client = client
+        self.hostname = hostname
+        self.sys_class_net = sys_class_net
+        self._suspects = set()
+
+    def find_orphans(self):
+        """
+        Run one pass: list the links and read the host's endpoints once each.
+
+        :return: A sorted list of the names of the links that have been
+        missing an endpoint in this pass and the previous one.
+        """
+        links = list_calico_links(self.sys_class_net)
+        endpoints = self.client.get_endpoints(hostname=self.hostname)
+        suspects = links - set(endpoint.name for endpoint in endpoints)
+        orphans = suspects & self._suspects
+        self._suspects = suspects
+        return sorted(orphans)
+
+    def reconcile(self, dry_run=False):
+        """
+        Run one pass, deleting the orphans found.
+
+        :param dry_run: Find the orphans, but don't delete them.
+        :return: A sorted list of the names of the orphans.
+        """
+        orphans = self.find_orphans()
+        if orphans and not dry_run:
+            _log.info("Deleting %d orphaned links: %s", len(orphans),
+                      ", ".join(orphans))
+            if not delete_links(orphans):
+                _log.warning("Failed to delete some orphaned links")
+        return orphans
+
+    def run(self, interval):
+        """
+        Reconcile every interval seconds until the process exits.
+
+        :param interval: The time between passes, in seconds.
+        :return: Never returns.
+        """
+        while True:
+            try:
+                self.reconcile()
+            except (DataStoreError, OSError) as e:
+                _log.exception(e)
+            time.sleep(interval)
+
+
+def get_reconcile_interval():
+    """
+    Read the reconcile interval from the environment.
+
+    :return: The interval in seconds.  Raises ValueError if it isn't a
+    positive integer.
+    """
+    value = os.getenv(RECONCILE_INTERVAL_ENV, RECONCILE_INTERVAL_DEFAULT)
+    try:
+        interval = int(value)
+        if interval <= 0:
+            raise ValueError()
+    except ValueError:
+        raise ValueError("Invalid %s %s." % (RECONCILE_INTERVAL_ENV, value))
+    return interval
+
+
+if __name__ == "__main__":
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+    try:
+        interval = get_reconcile_interval()
+    except ValueError as e:
+        _log.error(e.message)
+        sys.exit(1)
+    VethReconciler(DatastoreClient(), socket.gethostname()).run(interval)
@@ -0,0 +1,69 @@
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Benchmark of calicoctl's startup imports.
+
+Each measurement runs a fresh interpreter that imports calicoctl and the
+modules a subcommand needs, as calicoctl does before dispatching.  The
+"all" row imports every subcommand module and creates the clients, as
+calicoctl used to do for every command.
+
+Usage, from the calico_containers directory:
+    python tests/benchmark/calicoctl_import_benchmark.py [<RUNS>]
+"""
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, ".")
+from calicoctl import COMMANDS
+
+IMPORT_COMMAND = """
+import sys, importlib
+sys.argv = ["calicoctl"]
+import calicoctl
+for command in %r:
+    importlib.import_module("calico_ctl." + command)
+if %r:
+    from calico_ctl import utils
+    utils.client.etcd_client
+    utils.docker_client.base_url
+"""
+
+
+def time_imports(commands, create_clients, runs):
+    """
+    :return: The median time in seconds to start an interpreter and import
+    calicoctl and the commands.
+    """
+    times = []
+    for _ in range(runs):
+        start = time.time()
+        subprocess.check_call([sys.executable, "-c",
+                               IMPORT_COMMAND % (commands, create_clients)])
+        times.append(time.time() - start)
+    return sorted(times)[len(times) / 2]
+
+
+def main(runs):
+    baseline = time_imports([], False, runs)
+    print "%-12s %7.1f ms" % ("calicoctl", baseline * 1000)
+    for command in COMMANDS:
+        print "%-12s %7.1f ms" % (command,
+                                  time_imports([command], False, runs) * 1000)
+    print "%-12s %7.1f ms" % ("all", time_imports(COMMANDS, True, runs) * 1000)
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5)
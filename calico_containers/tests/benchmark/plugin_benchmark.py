@@ -0,0 +1,86 @@
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Benchmark of the plugin's request handling overhead.
+
+Compares the plugin's dispatcher with handling the same requests as Flask
+views using request.get_json() and jsonify().  No datastore is needed: Join
+is served from the endpoint cache.
+
+Usage, from the calico_containers directory:
+    python tests/benchmark/plugin_benchmark.py [<REQUESTS>]
+"""
+import sys
+import timeit
+
+from flask import jsonify, request
+from netaddr import IPAddress
+from werkzeug.test import EnvironBuilder
+
+sys.path.insert(0, ".")
+import docker_plugin
+from pycalico.datastore_datatypes import Endpoint
+
+EP_ID = "0123456789abcdef"
+REQUESTS = [("/Plugin.Activate", ""),
+            ("/NetworkDriver.Join", '{"EndpointID": "%s"}' % EP_ID),
+            ("/NetworkDriver.EndpointOperInfo", '{"EndpointID": "%s"}' % EP_ID),
+            ("/NetworkDriver.Leave", '{"EndpointID": "%s"}' % EP_ID)]
+
+
+def flask_app():
+    """
+    :return: A WSGI app serving the plugin's handlers as ordinary Flask views.
+    """
+    app = docker_plugin.make_json_app("plugin_benchmark")
+    for path, (handler, parse) in docker_plugin.plugin.handlers.iteritems():
+        def view(handler=handler, parse=parse):
+            json_data = request.get_json(force=True) if parse else None
+            response = handler(json_data)
+            if isinstance(response, basestring):
+                response = docker_plugin.json_codec.loads(response)
+            return jsonify(response)
+        app.add_url_rule(path, handler.__name__, view, methods=["POST"])
+    return app
+
+
+def run(wsgi_app, environs):
+    def start_response(status, headers):
+        pass
+    for environ in environs:
+        environ["wsgi.input"].seek(0)
+        "".join(wsgi_app(environ, start_response))
+
+
+def main(count):
+    endpoint = Endpoint(docker_plugin.hostname, "docker", "libnetwork",
+                        EP_ID, "active", docker_plugin.FIXED_MAC)
+    endpoint.ipv4_gateway = IPAddress("10.0.0.1")
+    docker_plugin.endpoint_cache.add(endpoint)
+    docker_plugin.app.logger.disabled = True
+
+    environs = [EnvironBuilder(path=path, method="POST",
+                               data=data).get_environ()
+                for path, data in REQUESTS]
+    for name, wsgi_app in [("flask", flask_app()),
+                           ("dispatcher", docker_plugin.app)]:
+        seconds = timeit.timeit(lambda: run(wsgi_app, environs),
+                                number=count)
+        print "%-12s %8.1f us/request" % (
+            name, seconds * 1e6 / (count * len(environs)))
+    print "JSON codec: %s" % docker_plugin.json_codec.__name__
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000)
@@ -13,8 +13,11 @@
 # limitations under the License.
 
 from etcd import Client as EtcdClient
-from etcd import EtcdKeyNotFound, EtcdResult, EtcdException
+from etcd import EtcdKeyNotFound, EtcdResult, EtcdException, \
+    EtcdCompareFailed, EtcdAlreadyExist
+import copy
 import json
+from StringIO import StringIO
 import unittest
 
 from mock import ANY
@@ -23,11 +26,13 @@ from nose.tools import *
 from mock import patch, Mock, call
 
 from pycalico.datastore import (DatastoreClient,
-                                                  CALICO_V_PATH)
+                                                  CALICO_V_PATH,
+                                                  _profile_ids_from_json)
 from pycalico.datastore_errors import DataStoreError, ProfileNotInEndpoint, ProfileAlreadyInEndpoint, \
-    MultipleEndpointsMatch
+    MultipleEndpointsMatch, ProfileRulesConflict
 from pycalico.datastore_datatypes import Rules, BGPPeer, IPPool, \
-    Endpoint, Profile, Rule
+    IPPoolIndex, Endpoint, Profile, Rule, RuleList, MAX_PORTS_PER_RULE, \
+    TagIndex, TagReference
 
 TEST_HOST = "TEST_HOST"
 TEST_ORCH_ID = "docker"
@@ -40,6 +45,19 @@ IPV4_POOLS_PATH = CALICO_V_PATH + "/ipam/v4/pool/"
 IPV6_POOLS_PATH = CALICO_V_PATH + "/ipam/v6/pool/"
 BGP_PEERS_PATH = CALICO_V_PATH + "/config/bgp_peer_v4/"
 TEST_PROFILE_PATH = CALICO_V_PATH + "/policy/profile/TEST/"
+TEST_PROFILE_VALUES = {
+    "tags": '["TAG1", "TAG2", "TAG3"]',
+    "rules": """
+{
+  "id": "TEST",
+  "inbound_rules": [
+    {"action": "allow", "src_net": "192.168.1.0/24", "src_ports": [200,2001]}
+  ],
+  "outbound_rules": [
+    {"action": "allow", "src_tag": "TEST", "src_ports": [200,2001]}
+  ]
+}
+"""}
 ALL_PROFILES_PATH = CALICO_V_PATH + "/policy/profile/"
 ALL_ENDPOINTS_PATH = CALICO_V_PATH + "/host/"
 ALL_HOSTS_PATH = CALICO_V_PATH + "/host/"
@@ -222,6 +240,215 @@ class TestRules(unittest.TestCase):
         assert_equal(inbound_rule["icmp_type"], 30)
         assert_equal(inbound_rule["action"], "deny")
 
+    def test_rule_lists(self):
+        """
+        Test the rules are held in indexed RuleLists.
+        """
+        rules = Rules.from_json(RULES_JSON)
+        assert_is_instance(rules.inbound_rules, RuleList)
+        assert_is_instance(rules.outbound_rules, RuleList)
+        assert_true(Rule(action="allow", src_net="192.168.77.5/24") in
+                    rules.inbound_rules)
+        assert_false(Rule(action="deny") in rules.inbound_rules)
+        assert_equal(rules.inbound_rules.index(
+            Rule(action="allow", src_tag="PROF_GROUP1")), 0)
+
+    def test_optimize_shadowed(self):
+        """
+        Test optimize drops rules that are covered by an earlier rule.
+        """
+        rules = Rules(id="PROF", inbound_rules=[
+            Rule(action="deny", protocol="tcp", src_net="10.0.0.0/8"),
+            Rule(action="allow", protocol="tcp", src_net="10.1.0.0/16"),
+            Rule(action="allow", protocol="udp", src_net="10.1.0.0/16"),
+            Rule(action="allow", protocol="udp", src_net="10.1.0.0/16",
+                 dst_ports=[53]),
+            Rule(action="allow", protocol="tcp", dst_ports=["1:1024"]),
+            Rule(action="deny", protocol="tcp", dst_ports=[80, 443]),
+            Rule(action="deny", protocol="tcp", dst_ports=[8080]),
+        ], outbound_rules=[
+            Rule(action="allow"),
+            Rule(action="deny", protocol="icmp", icmp_type=8),
+        ])
+        optimized = rules.optimize()
+        assert_equal(optimized.id, "PROF")
+        assert_equal(list(optimized.inbound_rules), [
+            Rule(action="deny", protocol="tcp", src_net="10.0.0.0/8"),
+            Rule(action="allow", protocol="udp", src_net="10.1.0.0/16"),
+            Rule(action="allow", protocol="tcp", dst_ports=["1:1024"]),
+            Rule(action="deny", protocol="tcp", dst_ports=[8080]),
+        ])
+        assert_equal(list(optimized.outbound_rules), [Rule(action="allow")])
+
+        # The original rules are unchanged.
+        assert_equal(len(rules.inbound_rules), 7)
+
+    def test_optimize_merge(self):
+        """
+        Test optimize merges neighbouring CIDRs and ports with the same
+        action, but not across a rule with a different action.
+        """
+        rules = Rules(id="PROF", inbound_rules=[
+            Rule(action="allow", src_net="10.0.0.0/24"),
+            Rule(action="allow", src_net="10.0.2.0/24"),
+            Rule(action="allow", src_net="10.0.1.0/24"),
+            Rule(action="allow", src_net="10.0.3.0/24"),
+            Rule(action="deny", src_net="10.0.5.0/24"),
+            Rule(action="allow", src_net="10.0.4.0/24"),
+            Rule(action="allow", protocol="tcp", dst_ports=[80, 81, 82]),
+            Rule(action="allow", protocol="tcp", dst_ports=["83:90", 443]),
+        ], outbound_rules=[])
+        optimized = rules.optimize()
+        assert_equal(list(optimized.inbound_rules), [
+            Rule(action="allow", src_net="10.0.0.0/22"),
+            Rule(action="deny", src_net="10.0.5.0/24"),
+            Rule(action="allow", src_net="10.0.4.0/24"),
+            Rule(action="allow", protocol="tcp", dst_ports=["80:90", 443]),
+        ])
+
+        # Already optimal rules are left alone.
+        again = optimized.optimize()
+        assert_equal(list(again.inbound_rules),
+                     list(optimized.inbound_rules))
+
+    def test_optimize_port_limit(self):
+        """
+        Test combined port lists are split to respect MAX_PORTS_PER_RULE.
+        """
+        inbound = [Rule(action="allow", protocol="udp", dst_ports=[port])
+                   for port in range(100, 140, 2)]
+        optimized = Rules(id="PROF", inbound_rules=inbound,
+                          outbound_rules=[]).optimize()
+        assert_equal([len(rule["dst_ports"])
+                      for rule in optimized.inbound_rules],
+                     [MAX_PORTS_PER_RULE, 20 - MAX_PORTS_PER_RULE])
+
+
+class TestRuleList(unittest.TestCase):
+
+    def test_canonical(self):
+        """
+        Test equal rules have equal canonical forms, and unequal rules don't.
+        """
+        rule1 = Rule(action="allow", src_net="10.0.0.1/8", dst_ports=[1, 2])
+        rule2 = Rule(dst_ports=[1, 2], src_net=IPNetwork("10.0.0.0/8"),
+                     action="allow")
+        rule3 = Rule(action="allow", src_net="10.0.0.0/8", dst_ports=[2, 1])
+        assert_equal(rule1.canonical(), rule2.canonical())
+        assert_equal(hash(rule1.canonical()), hash(rule2.canonical()))
+        assert_not_equal(rule1.canonical(), rule3.canonical())
+
+    def test_mutation(self):
+        """
+        Test the index is maintained as the list is changed.
+        """
+        allow = Rule(action="allow")
+        deny = Rule(action="deny")
+        tagged = Rule(action="allow", src_tag="TAG")
+        rules = RuleList([allow, deny])
+
+        rules.insert(0, tagged)
+        assert_equal(rules.index(deny), 2)
+        rules.append(allow)
+        assert_equal(rules.count(allow), 2)
+        rules.remove(allow)
+        assert_equal(rules, [tagged, deny, allow])
+        assert_equal(rules.index(allow), 2)
+        assert_equal(rules.pop(1), deny)
+        assert_false(deny in rules)
+        assert_raises(ValueError, rules.index, deny)
+        assert_raises(ValueError, rules.remove, deny)
+        rules[0] = deny
+        assert_true(deny in rules)
+        assert_false(tagged in rules)
+        rules[:] = [tagged]
+        assert_equal(rules.index(tagged), 0)
+        assert_false(allow in rules)
+        rules += [allow, allow]
+        del rules[0]
+        assert_false(tagged in rules)
+        assert_equal(rules.count(allow), 2)
+
+    def test_dedupe(self):
+        """
+        Test removing duplicate rules preserves the order of the first
+        occurrences.
+        """
+        allow = Rule(action="allow")
+        deny = Rule(action="deny")
+        rules = RuleList([deny, allow, Rule(action="deny"), allow])
+        assert_equal(rules.dedupe(), 2)
+        assert_equal(rules, [deny, allow])
+        assert_equal(rules.count(deny), 1)
+        assert_equal(rules.dedupe(), 0)
+
+    def test_copy(self):
+        """
+        Test a copied RuleList has its own, correct, index.
+        """
+        allow = Rule(action="allow")
+        rules = RuleList([allow])
+        copied = copy.deepcopy(rules)
+        assert_is_instance(copied, RuleList)
+        assert_equal(copied.count(allow), 1)
+        copied.remove(allow)
+        assert_true(allow in rules)
+
+
+class TestProfile(unittest.TestCase):
+
+    def test_to_from_json(self):
+        """
+        Test a Profile converted to JSON and back is unchanged.
+        """
+        profile = Profile("PROF")
+        profile.tags = set(["TAG1", "TAG2"])
+        profile.rules = Rules.from_json(RULES_JSON.replace("PROF_GROUP1",
+                                                           "PROF"))
+        new_profile = Profile.from_json(profile.to_json())
+        assert_equal(new_profile.name, "PROF")
+        assert_equal(new_profile.tags, profile.tags)
+        assert_equal(new_profile.rules, profile.rules)
+        assert_equal(new_profile.to_json(), profile.to_json())
+
+    def test_from_json_defaults(self):
+        """
+        Test the tags and rules are optional in the JSON.
+        """
+        profile = Profile.from_json('{"name": "PROF"}')
+        assert_equal(profile.tags, set())
+        assert_equal(profile.rules, Rules("PROF", [], []))
+
+
+class TestTagIndex(unittest.TestCase):
+
+    def test_index(self):
+        """
+        Test looking up the profiles with a tag and the rules referring to it.
+        """
+        web = Profile("WEB")
+        web.tags = set(["WEB", "FRONTEND"])
+        web.rules = Rules("WEB",
+                          [Rule(action="allow", src_tag="FRONTEND"),
+                           Rule(action="allow", src_tag="DB",
+                                dst_tag="DB")],
+                          [Rule(action="allow", dst_tag="FRONTEND")])
+        api = Profile("API")
+        api.tags = set(["FRONTEND"])
+        index = TagIndex([web, api])
+
+        assert_equal(index.profiles_with_tag("FRONTEND"), ["API", "WEB"])
+        assert_equal(index.profiles_with_tag("DB"), [])
+        assert_equal(index.rules_referencing("FRONTEND"), [
+            TagReference("WEB", "inbound", 1, web.rules.inbound_rules[0]),
+            TagReference("WEB", "outbound", 1, web.rules.outbound_rules[0])])
+
+        # A rule referring to a tag twice is listed once.
+        assert_equal(index.rules_referencing("DB"), [
+            TagReference("WEB", "inbound", 2, web.rules.inbound_rules[1])])
+        assert_equal(index.rules_referencing("WEB"), [])
+        assert_set_equal(index.tags(), {"WEB", "FRONTEND", "DB"})
+
 
 class TestEndpoint(unittest.TestCase):
 
@@ -374,6 +601,54 @@ class TestIPPool(unittest.TestCase):
                       str(IPPool("1.2.3.4/24", ipip=True, masquerade=True)))
 
 
+class TestIPPoolIndex(unittest.TestCase):
+    def test_find(self):
+        """
+        Test finding the pool containing an address.
+        """
+        pools = [IPPool("10.0.0.0/8"),
+                 IPPool("10.1.0.0/16"),
+                 IPPool("10.1.2.0/24"),
+                 IPPool("10.2.0.0/16"),
+                 IPPool("192.168.0.0/16")]
+        index = IPPoolIndex(reversed(pools))
+        assert_equal(len(index), 5)
+        assert_equal(index.find(IPAddress("10.1.2.3")), pools[2])
+        assert_equal(index.find(IPAddress("10.1.3.3")), pools[1])
+        assert_equal(index.find(IPAddress("10.1.255.255")), pools[1])
+        assert_equal(index.find("10.3.0.1"), pools[0])
+        assert_equal(index.find(IPAddress("192.168.255.255")), pools[4])
+        assert_is_none(index.find(IPAddress("9.255.255.255")))
+        assert_is_none(index.find(IPAddress("11.0.0.0")))
+        assert_is_none(index.find(IPAddress("192.169.0.0")))
+
+    def test_find_empty(self):
+        """
+        Test finding an address in an empty index.
+        """
+        assert_is_none(IPPoolIndex([]).find(IPAddress("fd80::1")))
+        assert_equal(IPPoolIndex([]).find_all(IPAddress("fd80::1")), [])
+
+    def test_find_all(self):
+        """
+        Test finding every pool containing an address, most specific first.
+        """
+        pools = [IPPool("10.0.0.0/8"),
+                 IPPool("10.1.0.0/16"),
+                 IPPool("10.1.2.0/24"),
+                 IPPool("10.1.2.0/25"),
+                 IPPool("10.2.0.0/16")]
+        index = IPPoolIndex(pools)
+        assert_equal(index.find_all(IPAddress("10.1.2.3")),
+                     [pools[3], pools[2], pools[1], pools[0]])
+        assert_equal(index.find_all(IPAddress("10.1.2.200")),
+                     [pools[2], pools[1], pools[0]])
+        assert_equal(index.find_all(IPAddress("10.1.3.1")),
+                     [pools[1], pools[0]])
+        assert_equal(index.find_all(IPAddress("10.3.0.1")), [pools[0]])
+        assert_equal(index.find_all(IPAddress("11.0.0.0")), [])
+
+
 class TestDatastoreClient(unittest.TestCase):
 
     @patch("pycalico.datastore.os.getenv", autospec=True)
@@ -426,31 +701,18 @@ class TestDatastoreClient(unittest.TestCase):
         Test getting a named profile that doesn't exist raises a KeyError.
         """
 
-        def mock_read(path):
-            result = Mock(spec=EtcdResult)
+        def mock_read(path, recursive=False):
+            assert recursive
             if path == TEST_PROFILE_PATH:
-                return result
-            elif path == TEST_PROFILE_PATH + "tags":
-                result.value = '["TAG1", "TAG2", "TAG3"]'
-                return result
-            elif path == TEST_PROFILE_PATH + "rules":
-                result.value = """
-{
-  "id": "TEST",
-  "inbound_rules": [
-    {"action": "allow", "src_net": "192.168.1.0/24", "src_ports": [200,2001]}
-  ],
-  "outbound_rules": [
-    {"action": "allow", "src_tag": "TEST", "src_ports": [200,2001]}
-  ]
-}
-"""
-                return result
+                return mock_profile_result(TEST_PROFILE_PATH,
+                                           TEST_PROFILE_VALUES)
             else:
                 raise EtcdKeyNotFound()
         self.etcd_client.read.side_effect = mock_read
 
         profile = self.datastore.get_profile("TEST")
+        self.etcd_client.read.assert_called_once_with(TEST_PROFILE_PATH,
+                                                      recursive=True)
         assert_equal(profile.name, "TEST")
         assert_set_equal({"TAG1", "TAG2", "TAG3"}, profile.tags)
         assert_equal(Rule(action="allow",
@@ -469,10 +731,10 @@ class TestDatastoreClient(unittest.TestCase):
         Test getting a named profile that exists, but has no tags or rules.
         """
 
-        def mock_read(path):
-            result = Mock(spec=EtcdResult)
+        def mock_read(path, recursive=False):
             if path == TEST_PROFILE_PATH:
-                return result
+                # An empty directory is returned as its own only child.
+                return mock_profile_result(TEST_PROFILE_PATH[:-1], {"": None})
             else:
                 raise EtcdKeyNotFound()
         self.etcd_client.read.side_effect = mock_read
@@ -540,6 +802,78 @@ class TestDatastoreClient(unittest.TestCase):
             TEST_PROFILE_PATH + "rules",
             profile.rules.to_json())
 
+    def test_profile_update_rules_overwrite(self):
+        """
+        Test rules are overwritten by default, even on a profile read from
+        the datastore.
+        """
+        profile = Profile("TEST")
+        profile._original_rules_json = "ORIGINAL"
+        self.datastore.profile_update_rules(profile)
+        self.etcd_client.write.assert_called_once_with(
+            TEST_PROFILE_PATH + "rules",
+            profile.rules.to_json())
+
+    def test_profile_update_rules_created_concurrently(self):
+        """
+        Test atomically writing rules on a profile that had none fails if
+        another client writes rules first.
+        """
+        self.datastore.profile_update_rules(Profile("TEST"), atomic=True)
+        self.etcd_client.write.assert_called_once_with(
+            TEST_PROFILE_PATH + "rules",
+            Profile("TEST").rules.to_json(),
+            prevExist=False)
+
+        self.etcd_client.write.side_effect = EtcdAlreadyExist
+        assert_raises(ProfileRulesConflict,
+                      self.datastore.profile_update_rules, Profile("TEST"),
+                      atomic=True)
+
+    def test_profile_update_rules_atomic(self):
+        """
+        Test atomically updating rules on a profile read from the datastore
+        only succeeds if the rules are unchanged.
+        """
+        profile = Profile("TEST")
+        profile._original_rules_json = "ORIGINAL"
+        self.datastore.profile_update_rules(profile, atomic=True)
+        self.etcd_client.write.assert_called_once_with(
+            TEST_PROFILE_PATH + "rules",
+            profile.rules.to_json(),
+            prevValue="ORIGINAL")
+        assert_equal(profile._original_rules_json, profile.rules.to_json())
+
+        self.etcd_client.write.side_effect = EtcdCompareFailed
+        assert_raises(ProfileRulesConflict,
+                      self.datastore.profile_update_rules, profile,
+                      atomic=True)
+
+    @patch("pycalico.datastore.DatastoreClient.get_profile", autospec=True)
+    def test_modify_profile_rules(self, m_get):
+        """
+        Test modify_profile_rules re-reads and re-applies the change on a
+        conflict, and gives up after the maximum number of attempts.
+        """
+        def get_profile(_, name):
+            profile = Profile(name)
+            profile._original_rules_json = "ORIGINAL"
+            return profile
+        m_get.side_effect = get_profile
+        modify = Mock(return_value="RESULT")
+        self.etcd_client.write.side_effect = [EtcdCompareFailed, None]
+
+        assert_equal(self.datastore.modify_profile_rules("TEST", modify),
+                     ("RESULT", 2))
+        assert_equal(modify.call_count, 2)
+        assert_equal(m_get.call_count, 2)
+
+        self.etcd_client.write.side_effect = EtcdCompareFailed
+        assert_raises(ProfileRulesConflict,
+                      self.datastore.modify_profile_rules, "TEST", modify,
+                      attempts=3)
+        assert_equal(modify.call_count, 5)
+
     @patch("pycalico.datastore.DatastoreClient.get_endpoint", autospec=True)
     @patch("pycalico.datastore.DatastoreClient.update_endpoint", autospec=True)
     def test_append_profiles_to_endpoint(self, m_update, m_get):
@@ -742,6 +1076,27 @@ class TestDatastoreClient(unittest.TestCase):
         assert_list_equal([IPPool("192.168.3.0/24"), IPPool("192.168.5.0/24")],
                           pools)
 
+    @patch("pycalico.datastore.time.time", autospec=True)
+    def test_find_pool(self, m_time):
+        """
+        Test finding a pool uses a cached index until it expires, or until
+        the pools are changed.
+        """
+        m_time.return_value = 100
+        self.etcd_client.read.side_effect = mock_read_2_pools
+        assert_equal(self.datastore.find_pool(IPAddress("192.168.5.1")),
+                     IPPool("192.168.5.0/24"))
+        assert_is_none(self.datastore.find_pool(IPAddress("192.168.4.1")))
+        assert_equal(self.etcd_client.read.call_count, 1)
+
+        m_time.return_value = 106
+        self.datastore.find_pool(IPAddress("192.168.5.1"))
+        assert_equal(self.etcd_client.read.call_count, 2)
+
+        self.datastore.add_ip_pool("v4", IPPool("192.168.4.0/24"))
+        self.datastore.find_pool(IPAddress("192.168.5.1"))
+        assert_equal(self.etcd_client.read.call_count, 3)
+
     def test_get_ip_pools_no_key(self):
         """
         Test getting IP pools from the datastore when the key doesn't exist.
@@ -891,6 +1246,38 @@ class TestDatastoreClient(unittest.TestCase):
         profiles = self.datastore.get_profile_names()
         assert_set_equal(profiles, {"UNIT", "TEST"})
 
+    def test_get_profiles(self):
+        """
+        Test get_profiles() reads all profiles at once, and returns those
+        requested.
+        """
+        children = []
+        for name in ("TEST", "UNIT"):
+            path = ALL_PROFILES_PATH + name + "/"
+            children.extend(
+                mock_profile_result(path, TEST_PROFILE_VALUES).children)
+        children.extend(
+            mock_profile_result(ALL_PROFILES_PATH + "EMPTY", {"": None}).children)
+        results = Mock(spec=EtcdResult)
+        results.children = children
+        self.etcd_client.read.return_value = results
+
+        profiles = self.datastore.get_profiles()
+        self.etcd_client.read.assert_called_once_with(ALL_PROFILES_PATH,
+                                                      recursive=True)
+        assert_set_equal(set(profiles), {"TEST", "UNIT", "EMPTY"})
+        assert_set_equal(profiles["UNIT"].tags, {"TAG1", "TAG2", "TAG3"})
+        assert_equal(len(profiles["UNIT"].rules.inbound_rules), 1)
+        assert_equal(profiles["UNIT"]._original_rules_json,
+                     TEST_PROFILE_VALUES["rules"])
+        assert_set_equal(profiles["EMPTY"].tags, set())
+
+        profiles = self.datastore.get_profiles(["TEST", "MISSING"])
+        assert_set_equal(set(profiles), {"TEST"})
+
+        self.etcd_client.read.side_effect = EtcdKeyNotFound
+        assert_equal(self.datastore.get_profiles(), {})
+
     def test_get_profile_names_no_key(self):
         """
         Test get_profile_names() when the key hasn't been set up.  Should
@@ -923,6 +1310,32 @@ class TestDatastoreClient(unittest.TestCase):
         members = self.datastore.get_profile_members("UNIT_TEST")
         assert_list_equal(members, [])
 
+    def test_get_profile_member_counts(self):
+        """
+        Test get_profile_member_counts() counts endpoints and hosts for each
+        profile.
+        """
+        self.etcd_client.read.side_effect = mock_read_4_endpoints
+        counts = self.datastore.get_profile_member_counts()
+        assert_dict_equal(counts, {"TEST": (2, 2), "UNIT": (2, 2)})
+
+        self.etcd_client.read.side_effect = mock_read_endpoints_key_error
+        assert_dict_equal(self.datastore.get_profile_member_counts(), {})
+
+    def test_profile_ids_from_json(self):
+        """
+        Test profile IDs are extracted from endpoint JSON, including IDs that
+        the fast path can't handle.
+        """
+        endpoint = EP_56.copy()
+        endpoint.profile_ids = ["A", "B", "A"]
+        assert_set_equal(_profile_ids_from_json(endpoint.to_json()),
+                         {"A", "B"})
+        endpoint.profile_ids = ["[A]", "B"]
+        assert_set_equal(_profile_ids_from_json(endpoint.to_json()),
+                         {"[A]", "B"})
+        assert_set_equal(_profile_ids_from_json("{}"), set())
+
     def test_get_profile_members_no_key(self):
         """
         Test get_profile_members() when the endpoints path has not been
@@ -951,7 +1364,7 @@ class TestDatastoreClient(unittest.TestCase):
         Test get_endpoint() for an endpoint that doesn't exist.
         """
         def mock_read(path, recursive=None):
-            assert_true(recursive)
+            assert_false(recursive)
             assert_equal(path, TEST_ENDPOINT_PATH)
             raise EtcdKeyNotFound()
         self.etcd_client.read.side_effect = mock_read
@@ -960,6 +1373,39 @@ class TestDatastoreClient(unittest.TestCase):
                       hostname=TEST_HOST, orchestrator_id=TEST_ORCH_ID,
                       workload_id=TEST_CONT_ID, endpoint_id=TEST_ENDPOINT_ID)
 
+    def test_get_endpoint_libnetwork(self):
+        """
+        Test get_endpoint() with just the hostname and endpoint ID reads the
+        libnetwork endpoint key, and falls back to searching the host.
+        """
+        libnetwork_path = TEST_HOST_PATH + "/workload/docker/libnetwork/" \
+                          "endpoint/" + TEST_ENDPOINT_ID
+        ep = Endpoint(TEST_HOST, "docker", "libnetwork", TEST_ENDPOINT_ID,
+                      "active", "11-22-33-44-55-66")
+        result = Mock(spec=EtcdResult)
+        result.value = ep.to_json()
+        self.etcd_client.read.return_value = result
+        ep2 = self.datastore.get_endpoint(hostname=TEST_HOST,
+                                          endpoint_id=TEST_ENDPOINT_ID)
+        self.etcd_client.read.assert_called_once_with(libnetwork_path)
+        assert_equal(ep2.workload_id, "libnetwork")
+        assert_equal(ep.to_json(), ep2.to_json())
+
+        ep = EP_12.copy()
+        leaf = Mock(spec=EtcdResult)
+        leaf.key = TEST_ENDPOINT_PATH
+        leaf.value = ep.to_json()
+        results = Mock(spec=EtcdResult)
+        results.leaves = iter([leaf])
+        self.etcd_client.read.reset_mock()
+        self.etcd_client.read.side_effect = [EtcdKeyNotFound(), results]
+        ep2 = self.datastore.get_endpoint(hostname=TEST_HOST,
+                                          endpoint_id=TEST_ENDPOINT_ID)
+        assert_equal(self.etcd_client.read.call_args_list,
+                     [call(libnetwork_path),
+                      call(TEST_HOST_PATH + "/", recursive=True)])
+        assert_equal(ep2.workload_id, TEST_CONT_ID)
+
     def test_get_endpoints_multiple(self):
         """
         Test get_endpoints() with more than a single result.
@@ -1136,6 +1582,54 @@ class TestDatastoreClient(unittest.TestCase):
         self.etcd_client.delete.side_effect = EtcdKeyNotFound
         self.datastore.remove_all_data()  # should not throw exception.
 
+    def test_dump_data(self):
+        """
+        Test dump_data() reads a directory at a time and writes the keys in
+        order.
+        """
+        def leaf(key, value=None, dir=False):
+            return EtcdResult(None, {"key": key, "value": value, "dir": dir,
+                                     "modifiedIndex": 7})
+
+        tree = {
+            "/calico": [leaf("/calico/v1", dir=True),
+                        leaf("/calico/a", dir=True)],
+            "/calico/v1": [leaf("/calico/v1/Ready", "true"),
+                           leaf("/calico/v1/empty", dir=True)],
+            "/calico/v1/empty": [leaf("/calico/v1/empty", dir=True)],
+            "/calico/a": [leaf("/calico/a/key", "value")],
+        }
+
+        def mock_read(path):
+            if path not in tree:
+                raise EtcdKeyNotFound()
+            result = Mock(spec=EtcdResult)
+            result.key = path
+            result.leaves = iter(tree[path])
+            return result
+        self.etcd_client.read.side_effect = mock_read
+
+        output = StringIO()
+        assert_equal(self.datastore.dump_data(output), 2)
+        lines = [json.loads(line) for line in output.getvalue().splitlines()]
+        assert_equal(lines, [{"key": "/calico/a/key", "value": "value",
+                              "modifiedIndex": 7, "ttl": None},
+                             {"key": "/calico/v1/Ready", "value": "true",
+                              "modifiedIndex": 7, "ttl": None}])
+        self.etcd_client.read.assert_has_calls([call("/calico"),
+                                                call("/calico/a"),
+                                                call("/calico/v1"),
+                                                call("/calico/v1/empty")])
+
+    def test_dump_data_missing(self):
+        """
+        Test dump_data() writes nothing when the path does not exist.
+        """
+        self.etcd_client.read.side_effect = EtcdKeyNotFound
+        output = StringIO()
+        assert_equal(self.datastore.dump_data(output), 0)
+        assert_equal(output.getvalue(), "")
+
     def test_remove_workload(self):
         """
         Test remove_workload()
@@ -1462,15 +1956,28 @@ def mock_read_no_node_bgppeers(path):
     return result
 
 
-def mock_read_2_profiles(path, recursive):
+def mock_profile_result(path, values):
+    """
+    Create a mock result of a recursive read of a profile.
+
+    :param path: The profile path.
+    :param values: A dict of the key under the profile path to its value.
+    """
+    children = []
+    for key, value in values.iteritems():
+        result = Mock(spec=EtcdResult)
+        result.key = path + key
+        result.value = value
+        children.append(result)
+    results = Mock(spec=EtcdResult)
+    results.children = children
+    return results
+
+
+def mock_read_2_profiles(path):
     assert path == ALL_PROFILES_PATH
-    assert recursive
     nodes = [CALICO_V_PATH + "/policy/profile/TEST",
-             CALICO_V_PATH + "/policy/profile/TEST/tags",
-             CALICO_V_PATH + "/policy/profile/TEST/rules",
-             CALICO_V_PATH + "/policy/profile/UNIT",
-             CALICO_V_PATH + "/policy/profile/UNIT/tags",
-             CALICO_V_PATH + "/policy/profile/UNIT/rules"]
+             CALICO_V_PATH + "/policy/profile/UNIT"]
     children = []
     for node in nodes:
         result = Mock(spec=EtcdResult)
@@ -1481,17 +1988,15 @@ def mock_read_2_profiles(path, recursive):
     return results
 
 
-def mock_read_no_profiles(path, recursive):
+def mock_read_no_profiles(path):
     assert path == ALL_PROFILES_PATH
-    assert recursive
     results = Mock(spec=EtcdResult)
     results.children = iter([])
     return results
 
 
-def mock_read_profiles_key_error(path, recursive):
+def mock_read_profiles_key_error(path):
     assert path == ALL_PROFILES_PATH
-    assert recursive
     raise EtcdKeyNotFound()
 
 
@@ -1534,13 +2039,11 @@ def mock_read_endpoints_key_error(path, recursive):
 
 def mock_read_for_endpoint(ep):
     def mock_read_get_endpoint(path, recursive=None):
-        assert recursive
+        assert not recursive
         assert path == TEST_ENDPOINT_PATH
-        leaf = Mock(spec=EtcdResult)
-        leaf.key = TEST_ENDPOINT_PATH
-        leaf.value = ep.to_json()
         result = Mock(spec=EtcdResult)
-        result.leaves = iter([leaf])
+        result.key = TEST_ENDPOINT_PATH
+        result.value = ep.to_json()
         return result
     return mock_read_get_endpoint
 
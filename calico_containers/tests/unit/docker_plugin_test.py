@@ -13,14 +13,19 @@
 # limitations under the License.
 
 import json
+import threading
+import time
 import unittest
 
-from mock import Mock, ANY
+from etcd import EtcdConnectionFailed
+from mock import Mock, ANY, patch
 from netaddr import IPAddress, IPNetwork
-from nose.tools import assert_equal, assert_dict_equal
+from nose.tools import assert_equal, assert_dict_equal, assert_false, \
+    assert_is, assert_is_none, assert_raises
 
 import docker_plugin
 from pycalico.datastore_datatypes import Endpoint
+from pycalico.datastore_errors import AllocationRetriesExceeded
 
 TEST_ID = "TEST_ID"
 
@@ -28,6 +33,7 @@ class TestPlugin(unittest.TestCase):
 
     def setUp(self):
         self.app = docker_plugin.app.test_client()
+        docker_plugin.endpoint_cache.clear()
 
     def tearDown(self):
         pass
@@ -38,8 +44,9 @@ class TestPlugin(unittest.TestCase):
 
     def test_activate(self):
         rv = self.app.post('/Plugin.Activate')
-        activate_response = '{\n  "Implements": [\n    "NetworkDriver"\n  ]\n}'
-        assert_equal(rv.data, activate_response)
+        assert_dict_equal(json.loads(rv.data),
+                          {"Implements": ["NetworkDriver"]})
+        assert_equal(rv.mimetype, "application/json")
 
     def test_create_network(self):
         docker_plugin.client.create_profile = Mock()
@@ -60,7 +67,44 @@ class TestPlugin(unittest.TestCase):
     def test_oper_info(self):
         rv = self.app.post('/NetworkDriver.EndpointOperInfo',
                            data='{"EndpointID": "%s"}' % TEST_ID)
-        assert_equal(rv.data, '{\n  "Value": {}\n}')
+        assert_dict_equal(json.loads(rv.data), {"Value": {}})
+
+    def test_bad_json(self):
+        """
+        Test malformed JSON gets a JSON 400 response, as from Flask.
+        """
+        rv = self.app.post('/NetworkDriver.Leave', data='{"EndpointID"')
+        assert_equal(rv.status_code, 400)
+        assert_dict_equal(json.loads(rv.data), {"message": "400: Bad Request"})
+
+    def test_wrong_method(self):
+        """
+        Test a plugin route is only served for POSTs.
+        """
+        rv = self.app.get('/NetworkDriver.Leave')
+        assert_equal(rv.status_code, 405)
+        assert_dict_equal(json.loads(rv.data),
+                          {"message": "405: Method Not Allowed"})
+
+    def test_handler_error(self):
+        """
+        Test an unexpected error gets a JSON 500 response with the error's
+        message, as from Flask.
+        """
+        docker_plugin.client.create_profile = Mock(
+            side_effect=ValueError("Bad profile"))
+        rv = self.app.post('/NetworkDriver.CreateNetwork',
+                           data='{"NetworkID": "%s"}' % TEST_ID)
+        assert_equal(rv.status_code, 500)
+        assert_dict_equal(json.loads(rv.data), {"message": "Bad profile"})
+
+    def test_handler_key_error(self):
+        """
+        Test a request missing a field gets the KeyError's message.
+        """
+        rv = self.app.post('/NetworkDriver.Join', data='{}')
+        assert_equal(rv.status_code, 500)
+        assert_dict_equal(json.loads(rv.data), {"message": "'EndpointID'"})
 
     def test_join(self):
         endpoint_mock = Mock()
@@ -111,9 +155,280 @@ class TestPlugin(unittest.TestCase):
         assert_dict_equal(json.loads(rv.data),
                           json.loads(expected_response))
 
+    def test_join_cached(self):
+        """
+        Test Join doesn't read an endpoint created by this process from the
+        datastore.
+        """
+        endpoint = Endpoint("hostname", "docker", "libnetwork", TEST_ID,
+                            "active", "mac")
+        endpoint.ipv4_gateway = IPAddress("1.2.3.4")
+        docker_plugin.endpoint_cache.add(endpoint)
+        docker_plugin.client.get_endpoint = Mock()
+
+        rv = self.app.post('/NetworkDriver.Join',
+                           data='{"EndpointID": "%s"}' % TEST_ID)
+        assert_false(docker_plugin.client.get_endpoint.called)
+        assert_equal(json.loads(rv.data)["Gateway"], "1.2.3.4")
+
+    def test_delete_endpoint_drained(self):
+        """
+        Test DeleteEndpoint doesn't release the IPs of a cached endpoint that
+        has since been removed from the datastore.
+        """
+        endpoint = Endpoint("hostname", "docker", "libnetwork", TEST_ID,
+                            "active", "mac")
+        endpoint.ipv4_nets.add(IPNetwork("10.0.0.1"))
+        docker_plugin.endpoint_cache.add(endpoint)
+        docker_plugin.client.get_endpoint = Mock(side_effect=KeyError)
+        docker_plugin.client.remove_endpoint = Mock()
+        with patch("docker_plugin.unassign_ip", autospec=True) as m_unassign, \
+                patch("docker_plugin.remove_veth", autospec=True) as m_remove:
+            rv = self.app.post('/NetworkDriver.DeleteEndpoint',
+                               data='{"EndpointID": "%s"}' % TEST_ID)
+            assert_false(m_unassign.called)
+            assert_false(m_remove.called)
+        assert_false(docker_plugin.client.remove_endpoint.called)
+        assert_is_none(docker_plugin.endpoint_cache.get(TEST_ID))
+        assert_equal(rv.data, '{}')
+
     def test_leave(self):
         rv = self.app.post('/NetworkDriver.Leave',
                            data='{"EndpointID": "%s"}' % TEST_ID)
         assert_equal(rv.data, '{}')
 
-# TODO - test_delete_endpoint and test_create_endpoint
\ No newline at end of file
+    def test_inventory(self):
+        """
+        Test the pools and next hops are read from the inventory when there
+        is one, rather than from the datastore.
+        """
+        docker_plugin.client.get_ip_pools = Mock()
+        docker_plugin.client.get_default_next_hops = Mock()
+        inventory = Mock()
+        inventory.has_snapshot.return_value = True
+        inventory.ip_pools.return_value = ["POOL"]
+        inventory.next_hops.return_value = {4: IPAddress("1.2.3.4")}
+        with patch("docker_plugin.inventory", inventory):
+            assert_equal(docker_plugin.get_ip_pools("v4"), ["POOL"])
+            assert_dict_equal(docker_plugin.get_default_next_hops(),
+                              {4: IPAddress("1.2.3.4")})
+        inventory.ip_pools.assert_called_once_with("v4")
+        assert_false(docker_plugin.client.get_ip_pools.called)
+        assert_false(docker_plugin.client.get_default_next_hops.called)
+
+    def test_snapshot_datastore_unreachable(self):
+        """
+        Test the plugin starts with an empty inventory if etcd can't be read,
+        and reads the pools from the datastore until it has a snapshot.
+        """
+        docker_plugin.client.get_ip_pools = Mock(return_value=["POOL"])
+        with patch.object(docker_plugin.client, "etcd_client") as m_etcd, \
+                patch("docker_plugin.inventory", None):
+            m_etcd.read.side_effect = EtcdConnectionFailed()
+            docker_plugin.snapshot_datastore()
+            assert_false(docker_plugin.inventory.has_snapshot())
+            assert_equal(docker_plugin.get_ip_pools("v4"), ["POOL"])
+        docker_plugin.client.get_ip_pools.assert_called_once_with("v4")
+
+    def test_assign_ip_contended_pool(self):
+        """
+        Test a pool that exceeds its allocation retries is skipped in favour
+        of the next one.
+        """
+        assigner = Mock()
+        assigner.collisions = 0
+        assigner.allocate.side_effect = [
+            AllocationRetriesExceeded(IPNetwork("10.0.0.0/24"), 5),
+            "10.0.1.1"]
+        with patch("docker_plugin.get_ip_pools", autospec=True) as m_pools, \
+                patch("docker_plugin.assigner_class", return_value=assigner):
+            m_pools.return_value = ["POOL1", "POOL2"]
+            assert_equal(docker_plugin.assign_ip("v4"),
+                         IPAddress("10.0.1.1"))
+        assert_equal([call[0][0] for call in
+                      assigner.allocate.call_args_list], ["POOL1", "POOL2"])
+
+    def test_create_endpoint_existing(self):
+        """
+        Test a repeated CreateEndpoint returns the existing endpoint without
+        assigning IPs or creating a veth.
+        """
+        endpoint = Endpoint("hostname", "docker", "libnetwork", TEST_ID,
+                            "active", "mac")
+        endpoint.ipv4_nets.add(IPNetwork("10.0.0.1/32"))
+        docker_plugin.client.get_endpoint = Mock(return_value=endpoint)
+        docker_plugin.client.set_endpoint = Mock()
+
+        with patch("docker_plugin.add_endpoint", autospec=True) as m_add:
+            rv = self.app.post('/NetworkDriver.CreateEndpoint',
+                               data='{"EndpointID": "%s", '
+                                    '"NetworkID": "NET"}' % TEST_ID)
+            assert_false(m_add.called)
+        assert_dict_equal(json.loads(rv.data),
+                          {"Interfaces": [{"ID": 0,
+                                           "Address": "10.0.0.1/32",
+                                           "MacAddress": "mac"}]})
+        assert_false(docker_plugin.client.set_endpoint.called)
+
+    def test_rollback_endpoint(self):
+        """
+        Test the journalled phases of an interrupted CreateEndpoint are
+        rolled back, unless the endpoint was written to the datastore.
+        """
+        records = [{"id": TEST_ID, "phase": "ips", "ips": ["10.0.0.1"]},
+                   {"id": TEST_ID, "phase": "veth", "name": "cali" + TEST_ID}]
+        with patch("docker_plugin.find_endpoint", autospec=True) as m_find, \
+                patch("docker_plugin.unassign_ip", autospec=True) as m_unassign, \
+                patch("docker_plugin.remove_veth", autospec=True) as m_remove:
+            m_find.return_value = Mock()
+            docker_plugin.rollback_endpoint(TEST_ID, records)
+            assert_false(m_unassign.called)
+            assert_false(m_remove.called)
+
+            m_find.return_value = None
+            docker_plugin.rollback_endpoint(TEST_ID, records)
+            m_unassign.assert_called_once_with(IPAddress("10.0.0.1"))
+            assert_equal(m_remove.call_args[0][0].endpoint_id, TEST_ID)
+
+    def test_add_endpoint_unexpected_error(self):
+        """
+        Test an unexpected error in a phase of CreateEndpoint backs out the
+        phases so far and completes the journal record.
+        """
+        def assign(ep):
+            ep.ipv4_nets.add(IPNetwork("10.0.0.1/32"))
+
+        journal = Mock()
+        with patch("docker_plugin.journal", journal), \
+                patch("docker_plugin.ipv4_and_gateway", autospec=True,
+                      side_effect=assign), \
+                patch("docker_plugin.ipv6_and_gateway", autospec=True), \
+                patch("docker_plugin.create_veth", autospec=True,
+                      side_effect=OSError("timed out")), \
+                patch("docker_plugin.unassign_ip", autospec=True) as m_unassign, \
+                patch("docker_plugin.remove_veth", autospec=True) as m_remove:
+            assert_raises(OSError, docker_plugin.add_endpoint, TEST_ID, "NET")
+            m_unassign.assert_called_once_with(IPAddress("10.0.0.1"))
+            assert_equal(m_remove.call_count, 1)
+        journal.complete.assert_called_once_with(TEST_ID)
+
+    def test_ipv4_and_gateway_journals(self):
+        """
+        Test an IPv4 address is journalled as soon as it is assigned, before
+        the IPv6 address is assigned.
+        """
+        endpoint = Endpoint("hostname", "docker", "libnetwork", TEST_ID,
+                            "active", "mac")
+        journal = Mock()
+        with patch("docker_plugin.journal", journal), \
+                patch("docker_plugin.get_default_next_hops", autospec=True,
+                      return_value={4: IPAddress("1.2.3.4")}), \
+                patch("docker_plugin.assign_ip", autospec=True,
+                      return_value=IPAddress("10.0.0.1")):
+            docker_plugin.ipv4_and_gateway(endpoint)
+        journal.record.assert_called_once_with(TEST_ID, "ips",
+                                               ips=["10.0.0.1"])
+        journal.sync.assert_called_once_with(journal.record.return_value)
+        assert_equal(endpoint.ipv4_nets, set([IPNetwork("10.0.0.1/32")]))
+
+    def test_drain(self):
+        """
+        Test the drain route drains this host and forgets the endpoints.
+        """
+        endpoint = Endpoint("hostname", "docker", "libnetwork", TEST_ID,
+                            "active", "mac")
+        docker_plugin.endpoint_cache.add(endpoint)
+        with patch("docker_plugin.drain_host", autospec=True) as m_drain:
+            m_drain.return_value = [endpoint]
+            rv = self.app.post('/Calico.Drain', data='{}')
+            m_drain.assert_called_once_with(docker_plugin.client,
+                                            docker_plugin.hostname)
+        assert_dict_equal(json.loads(rv.data), {"EndpointIDs": [TEST_ID]})
+        assert_is_none(docker_plugin.endpoint_cache.get(TEST_ID))
+
+
+class TestEndpointCache(unittest.TestCase):
+
+    def endpoint(self, ep_id):
+        return Endpoint("hostname", "docker", "libnetwork", ep_id, "active",
+                        "mac")
+
+    def test_size_limit(self):
+        """
+        Test the oldest endpoints are evicted when the cache is full.
+        """
+        cache = docker_plugin.EndpointCache(max_size=2, ttl=60)
+        endpoints = [self.endpoint("EP%d" % i) for i in range(3)]
+        for endpoint in endpoints:
+            cache.add(endpoint)
+        assert_equal(len(cache), 2)
+        assert_is_none(cache.get("EP0"))
+        assert_is(cache.get("EP2"), endpoints[2])
+
+        cache.remove("EP2")
+        assert_is_none(cache.get("EP2"))
+
+    def test_ttl(self):
+        """
+        Test endpoints expire after the TTL.
+        """
+        cache = docker_plugin.EndpointCache(max_size=10, ttl=60)
+        with patch("docker_plugin.time.time", autospec=True) as m_time:
+            m_time.return_value = 1000
+            cache.add(self.endpoint("EP0"))
+            m_time.return_value = 1030
+            cache.add(self.endpoint("EP1"))
+            assert_equal(cache.get("EP0").endpoint_id, "EP0")
+
+            m_time.return_value = 1070
+            assert_is_none(cache.get("EP0"))
+            assert_equal(cache.get("EP1").endpoint_id, "EP1")
+
+            # Adding an endpoint evicts expired ones.
+            m_time.return_value = 1100
+            cache.add(self.endpoint("EP2"))
+            assert_equal(len(cache), 1)
+
+
+class TestInFlightRequests(unittest.TestCase):
+
+    def test_shared(self):
+        """
+        Test concurrent requests for the same key share one operation.
+        """
+        in_flight = docker_plugin.InFlightRequests()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def operation():
+            calls.append(1)
+            started.set()
+            release.wait()
+            return "RESULT"
+
+        results = []
+        threads = [threading.Thread(
+            target=lambda: results.append(in_flight.run("KEY", operation)))
+            for _ in range(3)]
+        threads[0].start()
+        started.wait()
+        for thread in threads[1:]:
+            thread.start()
+        while in_flight._operations["KEY"]["waiters"] < 2:
+            time.sleep(0.01)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        assert_equal(len(calls), 1)
+        assert_equal(results, ["RESULT"] * 3)
+        assert_equal(len(in_flight), 0)
+
+    def test_exception(self):
+        """
+        Test an operation's exception is raised, and the key is released.
+        """
+        in_flight = docker_plugin.InFlightRequests()
+        assert_raises(KeyError, in_flight.run, "KEY", Mock(side_effect=KeyError))
+        assert_equal(in_flight.run("KEY", lambda: "RESULT"), "RESULT")
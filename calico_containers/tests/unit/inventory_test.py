@@ -0,0 +1,232 @@
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import unittest
+
+from etcd import EtcdResult, EtcdKeyNotFound, EtcdConnectionFailed
+from mock import Mock, patch
+from netaddr import IPAddress, IPNetwork
+from nose.tools import *
+
+from pycalico.datastore import CALICO_V_PATH
+from pycalico.datastore_datatypes import IPPool
+from pycalico.inventory import Inventory
+
+HOST = "TEST_HOST"
+HOST_PATH = CALICO_V_PATH + "/host/TEST_HOST/"
+ENDPOINT_KEY = HOST_PATH + "workload/docker/%s/endpoint/%s"
+OTHER_ENDPOINT_KEY = CALICO_V_PATH + \
+                     "/host/OTHER/workload/docker/1234/endpoint/5678"
+POOL_KEY = CALICO_V_PATH + "/ipam/v4/pool/10.0.0.0-24"
+ASSIGNMENT_KEY = CALICO_V_PATH + "/ipam/v4/assignment/10.0.0.0-24/%s"
+POOL_JSON = IPPool("10.0.0.0/24", ipip=True).to_json()
+
+
+def mock_result(key, value=None, action="get", index=0, dir=False):
+    result = Mock(spec=EtcdResult)
+    result.key = key
+    result.value = value
+    result.action = action
+    result.modifiedIndex = index
+    result.dir = dir
+    return result
+
+
+def mock_read(path, recursive):
+    assert recursive
+    if path == HOST_PATH:
+        leaves = [mock_result(HOST_PATH + "bird_ip", "1.2.3.4"),
+                  mock_result(HOST_PATH + "bird6_ip", ""),
+                  mock_result(ENDPOINT_KEY % ("w1", "e1"), "{}"),
+                  mock_result(ENDPOINT_KEY % ("w2", "e2"), "{}")]
+        index = 12
+    elif path == CALICO_V_PATH + "/ipam/":
+        leaves = [mock_result(POOL_KEY, POOL_JSON),
+                  mock_result(ASSIGNMENT_KEY % "10.0.0.1", HOST),
+                  mock_result(ASSIGNMENT_KEY % "10.0.0.2", "OTHER")]
+        index = 10
+    elif path == CALICO_V_PATH + "/ipam/v4/pool/":
+        leaves = [mock_result(POOL_KEY, POOL_JSON)]
+        index = 11
+    else:
+        raise EtcdKeyNotFound()
+    result = Mock(spec=EtcdResult)
+    result.leaves = iter(leaves)
+    result.etcd_index = index
+    return result
+
+
+class TestInventory(unittest.TestCase):
+
+    def setUp(self):
+        self.client = Mock()
+        self.client.etcd_client.read.side_effect = mock_read
+        self.inventory = Inventory(self.client, HOST)
+        self.inventory.snapshot()
+
+    def test_snapshot(self):
+        """
+        Test the snapshot reads the host's endpoints and the pool usage, and
+        watches from the oldest read.
+        """
+        assert_equal(self.inventory.endpoint_count(), 2)
+        assert_equal(self.inventory.churn_rate(), 0)
+        assert_equal(self.inventory.index, 11)
+        usage = self.inventory.pool_usage()
+        assert_equal(len(usage), 1)
+        assert_equal(usage[0].cidr, IPNetwork("10.0.0.0/24"))
+        assert_equal(usage[0].capacity, 254)
+        assert_equal(usage[0].assigned, 2)
+        assert_dict_equal(usage[0].hosts, {HOST: 1, "OTHER": 1})
+
+    def test_apply(self):
+        """
+        Test watch events update the view.
+        """
+        inventory = self.inventory
+        inventory.apply(mock_result(ENDPOINT_KEY % ("w3", "e3"), "{}",
+                                    action="set", index=20))
+        inventory.apply(mock_result(OTHER_ENDPOINT_KEY, "{}",
+                                    action="set", index=21))
+        assert_equal(inventory.endpoint_count(), 3)
+        assert_equal(inventory.index, 22)
+
+        # Updating an existing endpoint isn't churn.
+        inventory.apply(mock_result(ENDPOINT_KEY % ("w3", "e3"), "{}",
+                                    action="compareAndSwap", index=22))
+        assert_equal(inventory.churn_rate(), 1)
+
+        # Deleting a workload directory removes its endpoints.
+        inventory.apply(mock_result(HOST_PATH + "workload/docker/w1",
+                                    action="delete", index=23, dir=True))
+        assert_equal(inventory.endpoint_count(), 2)
+        assert_equal(inventory.churn_rate(), 2)
+        assert_equal(inventory.events, 4)
+
+        inventory.apply(mock_result(ASSIGNMENT_KEY % "10.0.0.3", HOST,
+                                    action="create", index=24))
+        inventory.apply(mock_result(ASSIGNMENT_KEY % "10.0.0.2",
+                                    action="delete", index=25))
+        usage = inventory.pool_usage()[0]
+        assert_equal(usage.assigned, 2)
+        assert_dict_equal(usage.hosts, {HOST: 2})
+
+        inventory.apply(mock_result(POOL_KEY, action="delete", index=26))
+        assert_equal(inventory.pool_usage(), [])
+
+    def test_next_hops(self):
+        """
+        Test the next hops are read from the host's BIRD configuration,
+        skipping blank addresses.
+        """
+        inventory = self.inventory
+        assert_dict_equal(inventory.next_hops(), {4: IPAddress("1.2.3.4")})
+
+        inventory.apply(mock_result(HOST_PATH + "bird6_ip", "fd80::1",
+                                    action="set", index=20))
+        assert_dict_equal(inventory.next_hops(), {4: IPAddress("1.2.3.4"),
+                                                  6: IPAddress("fd80::1")})
+
+        inventory.apply(mock_result(HOST_PATH + "bird_ip", action="delete",
+                                    index=21))
+        assert_raises(KeyError, inventory.next_hops)
+
+    def test_ip_pools(self):
+        """
+        Test the pools are read from their JSON.
+        """
+        pools = self.inventory.ip_pools("v4")
+        assert_equal(pools, [IPPool("10.0.0.0/24", ipip=True)])
+        assert_equal(self.inventory.ip_pools("v6"), [])
+
+    def test_untracked_assignments(self):
+        """
+        Test the snapshot reads only the pools if assignments aren't tracked.
+        """
+        inventory = Inventory(self.client, HOST, track_assignments=False)
+        inventory.snapshot()
+        assert_equal(inventory.index, 12)
+        assert_equal(inventory.ip_pools("v4"),
+                     [IPPool("10.0.0.0/24", ipip=True)])
+
+        inventory.apply(mock_result(ASSIGNMENT_KEY % "10.0.0.3", HOST,
+                                    action="create", index=24))
+        assert_equal(inventory.pool_usage()[0].assigned, 0)
+
+    @patch("pycalico.inventory.time.sleep", autospec=True)
+    def test_watch_retries_snapshot(self, m_sleep):
+        """
+        Test the watch takes the snapshot when there isn't one, retrying
+        until etcd can be read.
+        """
+        class StopWatch(Exception):
+            pass
+
+        reads = [EtcdConnectionFailed()]
+
+        def read(path, recursive, **kwargs):
+            if reads:
+                raise reads.pop()
+            if kwargs.get("wait"):
+                raise StopWatch()
+            return mock_read(path, recursive)
+
+        self.client.etcd_client.read.side_effect = read
+        inventory = Inventory(self.client, HOST)
+        assert_false(inventory.has_snapshot())
+        assert_raises(StopWatch, inventory.watch, HOST_PATH)
+        assert_true(inventory.has_snapshot())
+        assert_equal(inventory.endpoint_count(), 2)
+        m_sleep.assert_called_once_with(1)
+
+    def test_watch_paths(self):
+        """
+        Test each path is watched from its own index, and that an event read
+        before a new snapshot is ignored.
+        """
+        class StopWatch(Exception):
+            pass
+
+        inventory = Inventory(self.client, HOST, track_assignments=False)
+        inventory.snapshot()
+        assert_equal(inventory.paths,
+                     [HOST_PATH, CALICO_V_PATH + "/ipam/v4/pool/",
+                      CALICO_V_PATH + "/ipam/v6/pool/"])
+
+        events = [mock_result(ENDPOINT_KEY % ("w3", "e3"), "{}",
+                              action="set", index=20)]
+
+        def watch(path, recursive, wait, waitIndex, timeout):
+            if not events:
+                raise StopWatch()
+            return events.pop()
+
+        self.client.etcd_client.read.side_effect = watch
+        assert_raises(StopWatch, inventory.watch, HOST_PATH)
+        self.client.etcd_client.read.assert_called_with(
+            HOST_PATH, recursive=True, wait=True, waitIndex=21, timeout=0)
+        assert_equal(inventory.endpoint_count(), 3)
+
+        events.append(mock_result(POOL_KEY, action="delete", index=30))
+        assert_raises(StopWatch, inventory.watch,
+                      CALICO_V_PATH + "/ipam/v4/pool/")
+        self.client.etcd_client.read.assert_called_with(
+            CALICO_V_PATH + "/ipam/v4/pool/", recursive=True, wait=True,
+            waitIndex=31, timeout=0)
+        assert_equal(inventory.ip_pools("v4"), [])
+
+        # An event from before the latest snapshot is ignored.
+        inventory.apply(mock_result(ENDPOINT_KEY % ("w4", "e4"), "{}",
+                                    action="set", index=40),
+                        HOST_PATH, generation=0)
+        assert_equal(inventory.endpoint_count(), 3)
@@ -11,10 +11,17 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+from etcd import EtcdKeyNotFound, EtcdCompareFailed
+from mock import patch, Mock, call
 from netaddr import IPNetwork, IPAddress
-from nose.tools import assert_equal, assert_true, assert_false
+from nose.tools import assert_equal, assert_true, assert_false, \
+    assert_raises, assert_is_instance
 
-from pycalico.ipam import SequentialAssignment, IPAMClient
+from pycalico.ipam import SequentialAssignment, RandomAssignment, \
+    StripedAssignment, IPAMClient, RetryPolicy, Assignment, get_assigner, \
+    get_assigner_class
+from pycalico.datastore_errors import AllocationRetriesExceeded
+from pycalico.datastore_datatypes import Endpoint
 from pycalico.datastore_datatypes import IPPool
 
 network = IPNetwork("192.168.0.0/16")
@@ -74,3 +81,251 @@ class TestIPAMClient:
         assert_equal("192.168.0.2", assigner.allocate(four_pool))
         assert_equal(None, assigner.allocate(four_pool))
 
+
+class TestReleaseAddress:
+    """
+    Tests for releasing an address, using a mocked-out datastore.
+    """
+    def test_release_address_nested(self):
+        """
+        Test an address assigned from an enclosing pool is released from it.
+        """
+        inner, outer = IPPool("192.168.1.0/24"), IPPool("192.168.0.0/16")
+        address = IPAddress("192.168.1.1")
+        with patch.object(client, "find_pools", return_value=[inner, outer]), \
+                patch.object(client, "unassign_address",
+                             side_effect=lambda pool, address: pool == outer) \
+                as m_unassign:
+            assert_true(client.release_address(address))
+        assert_equal(m_unassign.call_args_list,
+                     [call(inner, address), call(outer, address)])
+
+    def test_release_address_unassigned(self):
+        """
+        Test releasing an address that isn't assigned from any pool.
+        """
+        with patch.object(client, "find_pools", return_value=[pool]), \
+                patch.object(client, "unassign_address", return_value=False):
+            assert_false(client.release_address(IPAddress("192.168.1.1")))
+
+
+class TestAssignmentStrategies:
+    """
+    Tests for the allocation strategies, using a mocked-out datastore.
+    """
+    def setup(self):
+        self.assigned = {}
+        self.collide = set()
+        self.patchers = [
+            patch.object(IPAMClient, "get_assigned_addresses",
+                         side_effect=lambda pool: dict(self.assigned)),
+            patch.object(IPAMClient, "assign_address",
+                         side_effect=self._assign),
+            patch("pycalico.ipam.time.sleep", autospec=True)]
+        for patcher in self.patchers:
+            patcher.start()
+
+    def teardown(self):
+        for patcher in self.patchers:
+            patcher.stop()
+
+    def _assign(self, pool, address, hostname=None):
+        """
+        Mock assign_address.  Addresses in self.collide are claimed by
+        "another allocator" the first time they are attempted.
+        """
+        address = str(address)
+        if address in self.collide:
+            self.collide.remove(address)
+            self.assigned[address] = ""
+            return False
+        if address in self.assigned:
+            return False
+        self.assigned[address] = ""
+        return True
+
+    def test_collision_stats(self):
+        self.collide.add("192.168.0.1")
+        assigner = SequentialAssignment()
+        assert_equal("192.168.0.2", assigner.allocate(network))
+        assert_equal(assigner.attempts, 2)
+        assert_equal(assigner.collisions, 1)
+        assert_equal(assigner.allocations, 1)
+        assert_equal(assigner.collision_rate(), 0.5)
+        assert_equal(assigner.last_allocation.attempts, 2)
+        assert_equal(assigner.last_allocation.address, "192.168.0.2")
+
+    def test_no_attempts_collision_rate(self):
+        assert_equal(SequentialAssignment().collision_rate(), 0.0)
+
+    @patch("pycalico.ipam.random.randrange", autospec=True)
+    def test_random_wraps(self, m_randrange):
+        m_randrange.return_value = 1
+        four_pool = IPNetwork("192.168.0.0/30")
+        assigner = RandomAssignment()
+        assert_equal("192.168.0.2", assigner.allocate(four_pool))
+        assert_equal("192.168.0.1", assigner.allocate(four_pool))
+        assert_equal(None, assigner.allocate(four_pool))
+
+    def test_striped_stable(self):
+        a = StripedAssignment(key="host1").allocate(network)
+        self.assigned.clear()
+        b = StripedAssignment(key="host1").allocate(network)
+        assert_equal(a, b)
+        assert_true(IPAddress(a) in network)
+
+    def test_striped_ipv6(self):
+        six_pool = IPNetwork("fd80::/126")
+        assigner = StripedAssignment(key="host1")
+        allocated = set(assigner.allocate(six_pool) for _ in range(3))
+        assert_equal(allocated, {"fd80::1", "fd80::2", "fd80::3"})
+        assert_equal(None, assigner.allocate(six_pool))
+
+    def test_ipv6_64(self):
+        six_pool = IPNetwork("fd80:24e2:f998:72d6::/64")
+        self.assigned["fd80:24e2:f998:72d6::1"] = ""
+        assert_equal("fd80:24e2:f998:72d6::2",
+                     SequentialAssignment().allocate(six_pool))
+        assert_true(IPAddress(RandomAssignment().allocate(six_pool)) in
+                    six_pool)
+        assert_true(IPAddress(StripedAssignment(key="host1")
+                              .allocate(six_pool)) in six_pool)
+
+    def test_get_assigner(self):
+        assert_is_instance(get_assigner("random"), RandomAssignment)
+        assert_is_instance(get_assigner("striped"), StripedAssignment)
+        assert_raises(ValueError, get_assigner, "bogus")
+        assert_raises(ValueError, get_assigner_class, "bogus")
+
+    @patch("pycalico.ipam.os.getenv", autospec=True)
+    def test_get_assigner_default(self, m_getenv):
+        m_getenv.side_effect = lambda key, default: default
+        assert_is_instance(get_assigner(), SequentialAssignment)
+
+    def test_retries_exceeded(self):
+        self.collide.update(["192.168.0.1", "192.168.0.2"])
+        assigner = SequentialAssignment(
+            retry_policy=RetryPolicy(max_attempts=2))
+        assert_raises(AllocationRetriesExceeded, assigner.allocate, network)
+        assert_equal(assigner.last_allocation.attempts, 2)
+        assert_equal(assigner.last_allocation.address, None)
+
+        # The next allocation starts afresh.
+        assert_equal("192.168.0.3", assigner.allocate(network))
+
+    def test_retry_deadline(self):
+        self.collide.add("192.168.0.1")
+        assigner = SequentialAssignment(
+            retry_policy=RetryPolicy(max_attempts=None, deadline=5.0))
+        with patch("pycalico.ipam.time.time", autospec=True) as m_time:
+            m_time.side_effect = [0.0, 10.0]
+            assert_raises(AllocationRetriesExceeded, assigner.allocate,
+                          network)
+
+    def test_backoff_bounds(self):
+        policy = RetryPolicy(base_delay=0.1, max_delay=0.3)
+        for attempts in range(1, 10):
+            delay = policy.backoff(attempts)
+            assert_true(0 <= delay <= min(0.3, 0.1 * 2 ** (attempts - 1)))
+        assert_false(policy.should_retry(10, 0, 0))
+        assert_true(policy.should_retry(9, 0, 0))
+
+    def test_invalid_max_attempts(self):
+        assert_raises(ValueError, RetryPolicy, max_attempts=0)
+
+
+class TestPoolUsage:
+    def setup(self):
+        self.client = IPAMClient()
+        self.client.etcd_client = Mock()
+
+    def _children(self, assignments):
+        children = [Mock(dir=True, key="/assignment/192.168.0.0-16",
+                         value=None)]
+        for address, host in assignments:
+            children.append(Mock(dir=False,
+                                 key="/assignment/192.168.0.0-16/" + address,
+                                 value=host))
+        return children
+
+    def test_get_pool_usage(self):
+        self.client.etcd_client.read.return_value.children = self._children(
+            [("192.168.0.1", "host1"),
+             ("192.168.0.2", "host1"),
+             ("192.168.0.3", "host2"),
+             ("192.168.0.4", "")])
+        usage = self.client.get_pool_usage(pool)
+        assert_equal(usage.cidr, network)
+        assert_equal(usage.capacity, 65534)
+        assert_equal(usage.assigned, 4)
+        assert_equal(usage.hosts, {"host1": 2, "host2": 1, "": 1})
+        self.client.etcd_client.read.assert_called_once_with(
+            "/calico/v1/ipam/v4/assignment/192.168.0.0-16")
+
+    def test_get_pool_usage_no_assignments(self):
+        self.client.etcd_client.read.side_effect = EtcdKeyNotFound
+        usage = self.client.get_pool_usage(IPNetwork("fd80::/64"))
+        assert_equal(usage.capacity, 2 ** 64 - 1)
+        assert_equal(usage.assigned, 0)
+        assert_equal(usage.hosts, {})
+        assert_false(self.client.etcd_client.write.called)
+
+    def test_get_pool_usage_tiny_pool(self):
+        self.client.etcd_client.read.return_value.children = []
+        assert_equal(
+            self.client.get_pool_usage(IPNetwork("10.0.0.0/31")).capacity, 0)
+
+
+class TestLeakedAssignments:
+    def setup(self):
+        self.client = IPAMClient()
+        self.client.etcd_client = Mock()
+        path = "/calico/v1/ipam/v4/assignment/"
+        self.client.etcd_client.read.return_value.leaves = [
+            Mock(dir=True, key=path + "10.0.0.0-8", value=None),
+            Mock(dir=False, key=path + "192.168.0.0-16/192.168.0.1",
+                 value="host1", modifiedIndex=5),
+            Mock(dir=False, key=path + "192.168.0.0-16/192.168.0.2",
+                 value="", modifiedIndex=6)]
+
+    def test_get_assignments(self):
+        assert_equal(self.client.get_assignments("v4"),
+                     [Assignment(network, IPAddress("192.168.0.1"),
+                                 "host1", 5),
+                      Assignment(network, IPAddress("192.168.0.2"), "", 6)])
+        self.client.etcd_client.read.assert_called_once_with(
+            "/calico/v1/ipam/v4/assignment/", recursive=True)
+
+    def test_get_assignments_no_key(self):
+        self.client.etcd_client.read.side_effect = EtcdKeyNotFound
+        assert_equal(self.client.get_assignments("v6"), [])
+
+    def test_get_leaked_assignments(self):
+        endpoint = Endpoint("host1", "docker", "workload", "1234567890ab",
+                            "active", "mac")
+        endpoint.ipv4_nets.add(IPNetwork("192.168.0.1/32"))
+        leaked = self.client.get_leaked_assignments("v4", [endpoint])
+        assert_equal(leaked,
+                     [Assignment(network, IPAddress("192.168.0.2"), "", 6)])
+
+    def test_release_assignment(self):
+        assignment = Assignment(network, IPAddress("192.168.0.2"), "", 6)
+        assert_true(self.client.release_assignment(assignment))
+        self.client.etcd_client.delete.assert_called_once_with(
+            "/calico/v1/ipam/v4/assignment/192.168.0.0-16/192.168.0.2",
+            prevIndex=6)
+
+        # Re-assigned since it was read.
+        self.client.etcd_client.delete.side_effect = EtcdCompareFailed
+        assert_false(self.client.release_assignment(assignment))
+
+    def test_unassign_addresses(self):
+        delete = self.client.etcd_client.delete
+        delete.side_effect = [None, EtcdKeyNotFound]
+        unassigned = self.client.unassign_addresses(
+            pool, [IPAddress("192.168.0.1"), IPAddress("192.168.0.2")])
+        assert_equal(unassigned, set([IPAddress("192.168.0.1")]))
+        delete.assert_any_call(
+            "/calico/v1/ipam/v4/assignment/192.168.0.0-16/192.168.0.1")
+        delete.assert_any_call(
+            "/calico/v1/ipam/v4/assignment/192.168.0.0-16/192.168.0.2")
@@ -0,0 +1,96 @@
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import os
+import shutil
+import tempfile
+import unittest
+
+from mock import patch
+from nose.tools import *
+
+from pycalico.journal import IntentJournal, read_journal, claim_journals
+
+DEAD_PID = 999999
+
+
+class TestIntentJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_read_incomplete(self):
+        """
+        Test only the operations that didn't complete are read back, and a
+        torn final record is ignored.
+        """
+        intents = IntentJournal(self.directory, pid=DEAD_PID)
+        intents.record("EP1", "ips", ips=["10.0.0.1"])
+        intents.record("EP2", "ips", ips=["10.0.0.2"])
+        intents.record("EP1", "veth", name="caliEP1")
+        intents.complete("EP2")
+        intents.close()
+        with open(intents.path, "a") as f:
+            f.write('{"id": "EP3", "pha')
+
+        operations = read_journal(intents.path)
+        assert_equal(operations.keys(), ["EP1"])
+        assert_equal([record["phase"] for record in operations["EP1"]],
+                     ["ips", "veth"])
+        assert_equal(operations["EP1"][0]["ips"], ["10.0.0.1"])
+
+    def test_sync_batched(self):
+        """
+        Test a sync covers every record written before it.
+        """
+        intents = IntentJournal(self.directory, pid=DEAD_PID)
+        with patch("pycalico.journal.os.fsync", autospec=True) as m_fsync:
+            first = intents.record("EP1", "ips", ips=[])
+            second = intents.record("EP2", "ips", ips=[])
+            intents.sync(second)
+            intents.sync(first)
+            assert_equal(m_fsync.call_count, 1)
+        intents.close()
+
+    def test_compact(self):
+        """
+        Test the journal is truncated once it is idle and large.
+        """
+        intents = IntentJournal(self.directory, pid=DEAD_PID)
+        with patch("pycalico.journal.COMPACT_THRESHOLD", 4):
+            intents.record("EP1", "ips", ips=[])
+            intents.record("EP2", "ips", ips=[])
+            intents.complete("EP1")
+            intents.complete("EP2")
+        intents.close()
+        assert_equal(os.path.getsize(intents.path), 0)
+
+    def test_claim(self):
+        """
+        Test only the journals of dead processes are claimed, unless the
+        plugin is starting up.
+        """
+        IntentJournal(self.directory, pid=DEAD_PID).close()
+        IntentJournal(self.directory, pid=os.getpid()).close()
+
+        claimed = claim_journals(self.directory)
+        assert_equal(len(claimed), 1)
+        assert_true(os.path.basename(claimed[0]).startswith(
+            "journal.%d.recovering" % DEAD_PID))
+        assert_equal(claim_journals(self.directory), [])
+
+        claimed = claim_journals(self.directory, live=True)
+        assert_equal(len(claimed), 2)
@@ -0,0 +1,165 @@
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import os
+import shutil
+import tempfile
+import unittest
+
+from mock import Mock, call, patch
+from netaddr import IPAddress, IPNetwork
+from nose.tools import *
+
+from pycalico.datastore_datatypes import Endpoint, IPPool
+from pycalico.reconcile import VethReconciler, delete_links, drain_host, \
+    get_reconcile_interval, RECONCILE_INTERVAL_ENV
+
+HOST = "TEST_HOST"
+
+
+class TestVethReconciler(unittest.TestCase):
+
+    def setUp(self):
+        self.sys_class_net = tempfile.mkdtemp()
+        for name in ["lo", "eth0", "cali1234", "caliORPHAN", "caliNEW"]:
+            os.mkdir(os.path.join(self.sys_class_net, name))
+        self.client = Mock()
+        self.client.get_endpoints.return_value = [
+            Endpoint(HOST, "docker", "W1", "1234", "active", "mac")]
+        self.reconciler = VethReconciler(self.client, HOST,
+                                         sys_class_net=self.sys_class_net)
+
+    def tearDown(self):
+        shutil.rmtree(self.sys_class_net)
+
+    def test_orphans_need_two_passes(self):
+        """
+        Test a link is only an orphan once it has been without an endpoint in
+        two consecutive passes.
+        """
+        assert_equal(self.reconciler.find_orphans(), [])
+        self.client.get_endpoints.assert_called_once_with(hostname=HOST)
+
+        # The new link's endpoint has now been written.
+        self.client.get_endpoints.return_value.append(
+            Endpoint(HOST, "docker", "W2", "NEW", "active", "mac"))
+        assert_equal(self.reconciler.find_orphans(), ["caliORPHAN"])
+
+    def test_reconcile(self):
+        """
+        Test orphans are deleted in one batch, unless it's a dry run.
+        """
+        with patch("pycalico.reconcile.delete_links",
+                   autospec=True) as m_delete:
+            self.reconciler.reconcile(dry_run=True)
+            assert_equal(self.reconciler.reconcile(dry_run=True),
+                         ["caliNEW", "caliORPHAN"])
+            assert_false(m_delete.called)
+
+            self.reconciler.reconcile()
+            m_delete.assert_called_once_with(["caliNEW", "caliORPHAN"])
+
+    def test_delete_links(self):
+        """
+        Test links are deleted with a single ip command.
+        """
+        with patch("pycalico.reconcile.Popen", autospec=True) as m_popen:
+            m_popen.return_value.returncode = 0
+            assert_true(delete_links(["cali1", "cali2"]))
+            m_popen.return_value.communicate.assert_called_once_with(
+                "link delete cali1\nlink delete cali2\n")
+            assert_equal(m_popen.call_count, 1)
+            assert_true(delete_links([]))
+            assert_equal(m_popen.call_count, 1)
+
+    def test_get_reconcile_interval(self):
+        """
+        Test the interval is read from the environment, and must be a
+        positive integer.
+        """
+        with patch.dict(os.environ, {RECONCILE_INTERVAL_ENV: "60"}):
+            assert_equal(get_reconcile_interval(), 60)
+        with patch.dict(os.environ, clear=True):
+            assert_equal(get_reconcile_interval(), 300)
+        for value in ("0", "-5", "ten"):
+            with patch.dict(os.environ, {RECONCILE_INTERVAL_ENV: value}):
+                assert_raises(ValueError, get_reconcile_interval)
+
+
+class TestDrainHost(unittest.TestCase):
+
+    def test_drain_host(self):
+        """
+        Test a host is drained with one read, one delete per workload, one ip
+        command and one batch of releases per pool.
+        """
+        endpoints = []
+        for workload_id, endpoint_id, ip in [("W1", "EP1", "10.0.0.1"),
+                                             ("W1", "EP2", "10.0.1.1"),
+                                             ("W2", "EP3", "10.0.0.2")]:
+            endpoint = Endpoint(HOST, "docker", workload_id, endpoint_id,
+                                "active", "mac")
+            endpoint.ipv4_nets.add(IPNetwork(ip))
+            endpoints.append(endpoint)
+        pools = [IPPool("10.0.0.0/24"), IPPool("10.0.1.0/24")]
+        client = Mock()
+        client.get_endpoints.return_value = endpoints
+        client.find_pools.side_effect = \
+            lambda ip: [pools[0]] if ip in pools[0] else [pools[1]]
+        client.unassign_addresses.side_effect = \
+            lambda pool, addresses: set(addresses)
+
+        with patch("pycalico.reconcile.list_calico_links", autospec=True) \
+                as m_list, \
+                patch("pycalico.reconcile.delete_links",
+                      autospec=True) as m_delete:
+            m_list.return_value = set(["caliEP1", "caliEP3", "caliOTHER"])
+            assert_equal(drain_host(client, HOST), endpoints)
+            m_delete.assert_called_once_with(["caliEP1", "caliEP3"])
+
+        client.get_endpoints.assert_called_once_with(hostname=HOST,
+                                                     orchestrator_id="docker")
+        assert_equal(sorted(call[0] for call in
+                            client.remove_workload.call_args_list),
+                     [(HOST, "docker", "W1"), (HOST, "docker", "W2")])
+        assert_equal(client.unassign_addresses.call_count, 2)
+        client.unassign_addresses.assert_any_call(
+            IPNetwork("10.0.0.0/24"),
+            [IPAddress("10.0.0.1"), IPAddress("10.0.0.2")])
+
+    def test_drain_host_nested_pools(self):
+        """
+        Test an address that wasn't assigned from its most specific pool is
+        released from the pool enclosing it.
+        """
+        endpoint = Endpoint(HOST, "docker", "W1", "EP1", "active", "mac")
+        endpoint.ipv4_nets.add(IPNetwork("10.0.1.1"))
+        endpoint.ipv4_nets.add(IPNetwork("10.0.1.2"))
+        inner, outer = IPPool("10.0.1.0/24"), IPPool("10.0.0.0/16")
+        client = Mock()
+        client.get_endpoints.return_value = [endpoint]
+        client.find_pools.return_value = [inner, outer]
+        # 10.0.1.2 was assigned from the outer pool.
+        client.unassign_addresses.side_effect = \
+            lambda pool, addresses: set(addresses) - \
+            set([IPAddress("10.0.1.2")]) if pool == inner.cidr \
+            else set(addresses)
+
+        with patch("pycalico.reconcile.list_calico_links", autospec=True), \
+                patch("pycalico.reconcile.delete_links", autospec=True):
+            drain_host(client, HOST)
+
+        assert_equal(client.unassign_addresses.call_args_list,
+                     [call(inner.cidr, [IPAddress("10.0.1.1"),
+                                        IPAddress("10.0.1.2")]),
+                      call(outer.cidr, [IPAddress("10.0.1.2")])])
@@ -0,0 +1,45 @@
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Gunicorn configuration for the Calico libnetwork plugin.
+
+The app is loaded, and the datastore snapshotted, once in the master.  Each
+worker is forked from it with the snapshot already in memory, and keeps its
+copy up to date with its own etcd watch.
+
+Each worker journals the endpoints it is creating.  Endpoint creations
+interrupted by a worker dying are rolled back by its replacement, or, if the
+whole plugin stopped, when it next starts.
+
+The number of worker processes, and of request threads in each, are set by
+the CALICO_PLUGIN_WORKERS and CALICO_PLUGIN_THREADS environment variables.
+"""
+import os
+
+preload_app = True
+workers = int(os.getenv("CALICO_PLUGIN_WORKERS", "1"))
+threads = int(os.getenv("CALICO_PLUGIN_THREADS", "4"))
+
+
+def when_ready(server):
+    import docker_plugin
+    docker_plugin.recover_journals(startup=True)
+    docker_plugin.snapshot_datastore()
+
+
+def post_fork(server, worker):
+    import docker_plugin
+    docker_plugin.start_datastore_watch()
+    docker_plugin.recover_journals()
+    docker_plugin.open_journal()